@@ -8,7 +8,7 @@ import sys
 import os
 from datetime import datetime
 import logging
-from threading import Thread
+from threading import Lock, Thread
 import time
 
 # Add parent directory to path
@@ -16,8 +16,20 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 from modules.mail_fetcher import MailFetcher
 from modules.mail_sender import MailSender
-from modules.ticket_processor_simple import TicketProcessorSimple
+from modules.llm_router import ROUTER_CONFIG_KEYS, create_router
+from modules.processor_registry import ProcessorRegistry
+from modules.ticket_history_index import TicketHistoryIndex
+from modules.rate_limiter import get_rate_limit_stats
+from modules.timeseries import RESOLUTIONS, get_timeseries
+from modules.tracing import span, trace, tracer
+from modules.prom_metrics import (REGISTRY, EMAILS_FAILED, EMAILS_FETCHED, EMAILS_FORWARDED,
+                                  EMAILS_PROCESSED, render_metrics)
+from modules.health import (DOWN, SKIPPED, HealthChecker, backlog_check, imap_check,
+                            llm_router_check, smtp_check)
+from modules.imap_actions import DEFAULT_RETRY_FOLDER, DEFAULT_ROUTED_FOLDER, ImapActions
 from modules.process_mail import read_pdf_attachment
+from modules.ticket_sink import get_ticket_sink, record_ticket
+from modules.parsed_message import parse_message
 from modules.config_manager import ConfigManager
 from modules.reparti_manager import RepartiManager
 from modules.stats_manager import StatsManager
@@ -34,8 +46,9 @@ logger = logging.getLogger(__name__)
 config_manager = ConfigManager('config_api.json')
 reparti_manager = RepartiManager('reparti_api.json')
 stats_manager = StatsManager('email_stats.json')
-email_storage = EmailStorage('emails.json')
-ticket_processor = None
+history_index = TicketHistoryIndex('ticket_index')
+timeseries = get_timeseries()
+email_storage = EmailStorage('emails.json', history_index=history_index)
 automation_thread = None
 automation_enabled = False
 
@@ -45,23 +58,92 @@ logger.info(f"Departments file: reparti_api.json")
 logger.info(f"Initial departments loaded: {reparti_manager.get_all()}")
 logger.info(f"Number of departments: {len(reparti_manager.get_all())}")
 
+# Index emails routed before this start (only new ones are embedded)
+Thread(target=email_storage.sync_history_index, daemon=True).start()
+
+def _router_config_get(key, default=None):
+    if key == 'OLLAMA_URL':
+        return config_manager.get(key, '') or 'http://localhost:11434/v1'
+    return config_manager.get(key, default)
+
+# Long-lived LLM router (Groq/Ollama with failover): rebuilt only when its settings
+# or the departments change, so statistics and rendered prompts survive across requests
+processor_registry = ProcessorRegistry(
+    lambda: create_router(_router_config_get, default_ollama_model='gemma3:4b', history_index=history_index),
+    config_manager,
+    ROUTER_CONFIG_KEYS,
+    reparti_manager
+)
+
 def get_ticket_processor():
-    """Initialize ticket processor with current settings - Ollama only"""
-    global ticket_processor
-    
-    ollama_url = config_manager.get('OLLAMA_URL', 'http://localhost:11434/v1')
-    ollama_model = config_manager.get('OLLAMA_MODEL', 'gemma3:4b')
-    
-    logger.info(f"Using Ollama: {ollama_url} with model {ollama_model}")
-    
-    ticket_processor = TicketProcessorSimple(
-        api_key="ollama",
-        provider="ollama",
-        model=ollama_model,
-        api_base=ollama_url
+    """Return the LLM router for the current settings"""
+    return processor_registry.processor
+
+# Forwarded messages are filed on the IMAP server in background batches,
+# one queue per account and folder settings (messages keep the credentials they were fetched with)
+_imap_actions = {}
+_imap_actions_lock = Lock()
+
+def _imap_actions_for_settings():
+    """ImapActions of the current IMAP account and folder settings"""
+    settings = (
+        config_manager.get('IMAP'),
+        config_manager.get('EMAIL'),
+        config_manager.get('EMAIL_PASSWORD'),
+        config_manager.get('IMAP_ROUTED_FOLDER', DEFAULT_ROUTED_FOLDER),
+        config_manager.get('IMAP_RETRY_FOLDER', DEFAULT_RETRY_FOLDER),
+        config_manager.get_bool('IMAP_ACTIONS', True),
     )
-    
-    return ticket_processor
+    with _imap_actions_lock:
+        actions = _imap_actions.get(settings)
+        if actions is None:
+            # Le code delle impostazioni precedenti restano finché non sono vuote
+            for old_settings, old in list(_imap_actions.items()):
+                if not old.pending():
+                    old.close()
+                    del _imap_actions[old_settings]
+            host, user, password, routed_folder, retry_folder, file_messages = settings
+            actions = ImapActions(host, user, password, routed_folder=routed_folder, retry_folder=retry_folder,
+                                  file_messages=file_messages,
+                                  flush_interval=float(os.getenv('IMAP_FLUSH_INTERVAL', 10)))
+            _imap_actions[settings] = actions
+    return actions
+
+def _imap_actions_pending():
+    with _imap_actions_lock:
+        queues = list(_imap_actions.values())
+    return sum(actions.pending() for actions in queues)
+
+def file_source_message(uid, department=None):
+    """Mark a source message seen and queue its move: Routed/<department>, or Retry if department is None"""
+    if not uid:
+        return
+    actions = _imap_actions_for_settings()
+    if department is None:
+        actions.fail(uid)
+    else:
+        actions.route(uid, department)
+
+# Dependency checks behind /api/health (results cached for HEALTH_TTL seconds)
+health_checker = HealthChecker(ttl=float(os.getenv('HEALTH_TTL', 30)))
+health_checker.register('imap', lambda: imap_check(
+    config_manager.get('IMAP'), config_manager.get('EMAIL'), config_manager.get('EMAIL_PASSWORD')))
+health_checker.register('smtp', lambda: smtp_check(
+    config_manager.get('SMTP'), config_manager.get('EMAIL'), config_manager.get('EMAIL_PASSWORD')))
+health_checker.register('llm', lambda: llm_router_check(get_ticket_processor()))
+health_checker.register('backlog', lambda: backlog_check(
+    lambda: email_storage.status_counts().get('not_processed', 0),
+    int(os.getenv('BACKLOG_WARN', 100))), critical=False, ttl=5)
+
+# Gauges read at scrape time
+REGISTRY.gauge('emails_stored', 'Stored emails by status', ('status',), callback=email_storage.status_counts)
+REGISTRY.gauge('imap_actions_pending', 'Source messages waiting to be filed on IMAP', callback=_imap_actions_pending)
+REGISTRY.gauge('tickets_pending', 'Routed tickets waiting to be written to the database',
+               callback=lambda: get_ticket_sink().pending())
+REGISTRY.gauge('automation_enabled', 'Automatic processing loop running', callback=lambda: int(automation_enabled))
+REGISTRY.gauge('dependency_up', 'Last cached result of the health checks (1 up, 0 down)', ('check',),
+               callback=lambda: {name: int(r.status != DOWN) for name, r in health_checker.cached().items()
+                                 if r.status != SKIPPED})
 
 # ============= SETTINGS ENDPOINTS =============
 
@@ -71,7 +153,7 @@ def get_settings():
     try:
         logger.info(f"GET /api/settings called")
         logger.info(f"reparti_manager instance: {id(reparti_manager)}")
-        logger.info(f"reparti_manager._reparti: {reparti_manager._reparti}")
+        logger.info(f"reparti_manager version: {reparti_manager.version}")
         
         departments = reparti_manager.get_all()
         logger.info(f"GET /api/settings - Departments returned: {departments}")
@@ -156,20 +238,10 @@ def save_settings():
             
             # Only update if departments list is not empty or if explicitly clearing
             if data['departments'] or data.get('clearDepartments', False):
-                # Clear and re-add departments
-                for dept in reparti_manager.get_all():
-                    reparti_manager.remove_reparto(dept['nome'])
-                
-                for dept in data['departments']:
-                    reparti_manager.add_reparto(
-                        dept['nome'],
-                        dept['descrizione'],
-                        dept['email'],
-                        dept.get('icon'),
-                        dept.get('color')
-                    )
+                # Replace all departments in one step
+                count = reparti_manager.replace_all(data['departments'])
                 reparti_manager.save()
-                logger.info(f"Departments updated. New count: {len(reparti_manager.get_all())}")
+                logger.info(f"Departments updated. New count: {count}")
             else:
                 logger.warning("Received empty departments list - keeping existing departments")
         
@@ -237,21 +309,25 @@ def check_emails():
         
         # Fetch emails
         fetcher = MailFetcher(imap, email, password)
-        email_messages = fetcher.fetch_unread_emails()
+        with span('fetch'):
+            email_messages = fetcher.fetch_unread_emails()
         
         # Convert to JSON format
         emails = []
         for msg, metadata in email_messages:
             # Extract PDF if present
-            pdf_content = read_pdf_attachment(msg)
+            with span('pdf'):
+                pdf_content = read_pdf_attachment(msg)
             
             email_data = {
                 'id': f"{metadata['from']}-{metadata['subject']}-{metadata['date']}",
+                'uid': metadata.get('uid'),
+                'messageId': msg.get('Message-ID'),
                 'sender': metadata['from'],
                 'subject': metadata['subject'],
                 'body': metadata['body'],
                 'timestamp': metadata['date'],
-                'attachments': [],  # TODO: Extract attachment info
+                'attachments': [a.filename for a in parse_message(msg).attachments if a.filename],
                 'status': 'not_processed',
                 'pdfContent': pdf_content,
                 # Store raw message for later processing
@@ -263,6 +339,7 @@ def check_emails():
             
             emails.append(email_data)
         
+        EMAILS_FETCHED.inc(len(emails))
         return jsonify({
             'success': True,
             'count': len(emails),
@@ -270,6 +347,7 @@ def check_emails():
         }), 200
         
     except Exception as e:
+        EMAILS_FAILED.inc(stage='fetch')
         logger.error(f"Error checking emails: {e}")
         return jsonify({'error': str(e)}), 500
 
@@ -280,11 +358,10 @@ def process_email():
         data = request.json
         email_data = data['email']
         
-        # Get processor
-        processor = get_ticket_processor()
-        
-        # Get departments
-        reparti = reparti_manager.get_all()
+        # Get processor and the departments it was prepared with
+        snapshot = processor_registry.get()
+        processor = snapshot.processor
+        reparti = snapshot.reparti
         logger.info(f"Departments loaded: {reparti}")
         logger.info(f"Number of departments: {len(reparti)}")
         
@@ -295,17 +372,23 @@ def process_email():
         # Analyze with AI
         # Note: We don't have the original email.message.Message object in API
         # Pass None for email_message as it's not used in analyze_email
-        analysis, reparto = processor.process_ticket(
-            email_message=None,
-            subject=email_data['subject'],
-            body=email_data['body'],
-            pdf_content=email_data.get('pdfContent', ''),
-            reparti=reparti
-        )
+        with trace(email_data.get('id') or email_data['subject']), span('analyze') as analyze_span:
+            analysis, reparto = processor.process_ticket(
+                email_message=None,
+                subject=email_data['subject'],
+                body=email_data['body'],
+                pdf_content=email_data.get('pdfContent', ''),
+                reparti=reparti,
+                email_id=email_data.get('id')
+            )
+            if not analysis or not reparto:
+                analyze_span.error = 'no_result'
         
         if not analysis or not reparto:
+            EMAILS_FAILED.inc(stage='analyze')
             return jsonify({'error': 'AI analysis failed'}), 500
         
+        EMAILS_PROCESSED.inc(department=reparto['nome'])
         return jsonify({
             'success': True,
             'analysis': analysis,
@@ -337,29 +420,39 @@ def forward_email():
         # Send email
         sender = MailSender(smtp, email, password)
         
-        # Find department email
-        dept = next((d for d in reparti_manager.get_all() if d['nome'] == department), None)
+        # Find department email (case-insensitive, like every other department lookup)
+        dept = reparti_manager.get_reparto(department)
         if not dept:
             return jsonify({'error': 'Department not found'}), 404
-        
-        success = sender.send_forwarded_mail(
-            to_email=dept['email'],
-            original_from=email_data['sender'],
-            original_subject=email_data['subject'],
-            original_body=email_data['body'],
-            original_date=email_data['timestamp'],
-            reparto_nome=department,
-            analysis_summary=analysis.get('summary'),
-            confidence=analysis.get('confidence'),
-            email_message=None  # TODO: Handle attachments
-        )
-        
+        department = dept['nome']
+        
+        with span('smtp', department=department) as smtp_span:
+            success = sender.send_forwarded_mail(
+                to_email=dept['email'],
+                original_from=email_data['sender'],
+                original_subject=email_data['subject'],
+                original_body=email_data['body'],
+                original_date=email_data['timestamp'],
+                reparto_nome=department,
+                analysis_summary=analysis.get('summary'),
+                confidence=analysis.get('confidence'),
+                email_message=None  # TODO: Handle attachments
+            )
+            if not success:
+                smtp_span.error = 'send_failed'
+        
+        file_source_message(email_data.get('uid'), department if success else None)
         if success:
+            EMAILS_FORWARDED.inc(department=department)
+            record_ticket(analysis, department, message_id=email_data.get('messageId'),
+                          mailbox=config_manager.get('EMAIL'), sender=email_data.get('sender'),
+                          subject=email_data.get('subject'))
             return jsonify({
                 'success': True,
                 'message': f'Email forwarded to {department}'
             }), 200
         else:
+            EMAILS_FAILED.inc(stage='smtp')
             return jsonify({'error': 'Failed to send email'}), 500
         
     except Exception as e:
@@ -431,6 +524,18 @@ def automation_status():
 
 # ============= STATISTICS ENDPOINTS =============
 
+@app.route('/api/tickets', methods=['GET'])
+def get_tickets():
+    """Latest routed tickets (?department=...&since=<epoch>&limit=100)"""
+    try:
+        since = request.args.get('since', type=float)
+        limit = min(request.args.get('limit', 100, type=int), 1000)
+        tickets = get_ticket_sink().query(request.args.get('department'), since, limit)
+        return jsonify({'tickets': tickets, 'stats': get_ticket_sink().stats()}), 200
+    except Exception as e:
+        logger.error(f"Error getting tickets: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
     """Get email statistics"""
@@ -484,6 +589,101 @@ def reset_stats():
         logger.error(f"Error resetting stats: {e}")
         return jsonify({'error': str(e)}), 500
 
+# ============= TIME SERIES =============
+
+# Parametri della query che non sono filtri sulle etichette
+_TIMESERIES_PARAMS = {'metric', 'resolution', 'window', 'groupBy', 'end'}
+
+def _timeseries_args():
+    args = request.args
+    labels = {k: v for k, v in args.items() if k not in _TIMESERIES_PARAMS}
+    end = args.get('end', type=float)
+    return args.get('window', 3600, type=float), args.get('groupBy'), end, labels
+
+@app.route('/api/timeseries', methods=['GET'])
+def get_timeseries_points():
+    """
+    Points of a metric over a time window.
+
+    Query: metric (required), resolution (minute|hour|day), window (seconds),
+    groupBy (label name), end (unix time); other parameters filter by label,
+    e.g. /api/timeseries?metric=llm_latency&groupBy=provider&window=86400
+    """
+    try:
+        metric = request.args.get('metric')
+        if not metric:
+            return jsonify({'error': 'metric is required'}), 400
+        resolution = request.args.get('resolution', 'minute')
+        window, group_by, end, labels = _timeseries_args()
+        points = timeseries.query(metric, resolution=resolution, window=window,
+                                  group_by=group_by, end=end, **labels)
+        return jsonify({
+            'metric': metric,
+            'resolution': resolution,
+            'interval': RESOLUTIONS[resolution][0],
+            'series': points
+        }), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error querying time series: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/timeseries/summary', methods=['GET'])
+def get_timeseries_summary():
+    """
+    Aggregates over a time window (count, rate per minute, p50/p95/p99).
+
+    Without metric, returns the dashboard overview: emails/minute by
+    department, LLM latency by provider and average confidence by
+    department. Stage latencies are in /api/traces and /metrics.
+    """
+    try:
+        window, group_by, end, labels = _timeseries_args()
+        metric = request.args.get('metric')
+        if metric:
+            summary = timeseries.summary(metric, window=window, group_by=group_by, end=end, **labels)
+            return jsonify({'metric': metric, 'window': window, 'summary': summary}), 200
+        return jsonify({
+            'window': window,
+            'received': timeseries.summary('emails_received', window=window, end=end),
+            'processed': timeseries.summary('emails_processed', window=window, group_by='department', end=end),
+            'llmLatency': timeseries.summary('llm_latency', window=window, group_by='provider', end=end),
+            'llmErrors': timeseries.summary('llm_errors', window=window, group_by='provider', end=end),
+            'confidence': timeseries.summary('confidence', window=window, group_by='department', end=end),
+        }), 200
+    except Exception as e:
+        logger.error(f"Error summarizing time series: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/timeseries/series', methods=['GET'])
+def list_timeseries():
+    """Known metrics/label sets and memory used by the store"""
+    return jsonify({
+        'series': timeseries.series(),
+        'resolutions': {name: {'interval': i, 'slots': n} for name, (i, n) in RESOLUTIONS.items()},
+        'memoryBytes': timeseries.memory_bytes()
+    }), 200
+
+# ============= TRACING =============
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Counters, gauges and latency histograms in Prometheus text format"""
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/api/traces', methods=['GET'])
+def get_traces():
+    """
+    Per-stage latency summary and the most recent per-email traces.
+
+    Query: limit (default 50), id (email id or run_id to look up)
+    """
+    return jsonify({
+        'stages': tracer.stats(),
+        'traces': tracer.traces(request.args.get('limit', 50, type=int), request.args.get('id'))
+    }), 200
+
 # ============= EMAIL STORAGE =============
 
 @app.route('/api/emails/storage', methods=['GET'])
@@ -532,11 +732,37 @@ def clear_stored_emails():
 
 # ============= HEALTH CHECK =============
 
+@app.route('/api/llm/providers', methods=['GET'])
+def get_llm_providers():
+    """Rolling latency/error statistics of the LLM providers"""
+    try:
+        router = get_ticket_processor()
+        return jsonify({
+            'order': [f"{p.provider}:{p.model}" for p in router.ranked()],
+            'providers': router.get_stats(),
+            'rateLimits': get_rate_limit_stats()
+        }), 200
+    except Exception as e:
+        logger.error(f"Error getting LLM providers: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
+    """
+    Deep health check: IMAP/SMTP login, LLM providers and backlog.
+
+    Results are cached (HEALTH_TTL); ?refresh=1 re-runs every check.
+    Returns 503 when a critical dependency is down.
+    """
+    report = health_checker.report(refresh=request.args.get('refresh') == '1')
+    report['timestamp'] = datetime.now().isoformat()
+    return jsonify(report), 503 if report['status'] == 'unhealthy' else 200
+
+@app.route('/api/health/live', methods=['GET'])
+def liveness_check():
+    """Process is up (no dependency checks)"""
     return jsonify({
-        'status': 'healthy',
+        'status': 'alive',
         'timestamp': datetime.now().isoformat()
     }), 200
 
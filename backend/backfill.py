@@ -0,0 +1,366 @@
+"""
+Re-run the AI classification over the stored emails.
+
+After a change of prompt, model or departments, every email in the
+EmailStorage file is analyzed again by the same LLM router the API uses,
+on a pool of threads and within a request rate. Each result is appended
+to backfill_runs/<run>.jsonl as soon as it is ready, so an interrupted run
+resumes where it stopped; --apply stores the results in the emails file
+as a new versioned analysis (email['analyses'][<run>]). At the end the
+run is compared with a previous one (or with the departments the emails
+were actually routed to).
+
+Usage (from backend/):
+    python backfill.py --run prompt-v2 --workers 4 --rate 60
+    python backfill.py --run prompt-v2 --baseline prompt-v1 --apply
+    python backfill.py --run prompt-v2 --report
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.config_manager import ConfigManager
+from modules.llm_router import create_router
+from modules.rate_limiter import RateLimiter
+from modules.reparti_manager import RepartiManager
+from modules.email_storage import EmailStorage
+
+logger = logging.getLogger('backfill')
+
+RUNS_DIR = 'backfill_runs'
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def load_run(path: str) -> Dict[str, Dict[str, Any]]:
+    """Results of a run by email id (the last line wins if an email was retried)"""
+    results: Dict[str, Dict[str, Any]] = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # riga troncata da un'interruzione
+            results[record['id']] = record
+    return results
+
+
+def stored_department(email: Dict[str, Any]) -> Optional[str]:
+    """Department an email was routed to (or suggested for) before the backfill"""
+    return email.get('forwardedToDepartment') or email.get('suggestedDepartment') or None
+
+
+def iter_emails(storage: EmailStorage, skip: set, status: Optional[str] = None,
+                limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """Stored emails still to process, optionally only those with a given status"""
+    count = 0
+    for email in storage.get_all_emails():
+        if limit is not None and count >= limit:
+            return
+        if not email.get('id') or email['id'] in skip:
+            continue
+        if status and email.get('status') != status:
+            continue
+        count += 1
+        yield email
+
+
+class Backfill:
+    """One backfill run: analysis of stored emails with checkpointed results"""
+
+    def __init__(self, processor, reparti: List[Dict[str, str]], run_path: str,
+                 workers: int = 4, rate: Optional[float] = None):
+        """
+        Args:
+            processor: LLM router (process_ticket)
+            reparti: Departments to route to
+            run_path: JSONL file of the results (appended)
+            workers: Emails analyzed concurrently
+            rate: Maximum emails per minute, may be fractional (None: only the provider quotas apply)
+        """
+        self.processor = processor
+        self.reparti = reparti
+        self.run_path = run_path
+        self.workers = max(1, workers)
+        if rate is not None and rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        # Capacità intera di almeno 1, periodo scalato: --rate 0.5 = 1 email ogni 120 s
+        capacity = max(1, int(rate)) if rate else 0
+        self.limiter = RateLimiter('backfill', capacity, period=60.0 * capacity / rate, headroom=1.0) if rate else None
+        self.durations: List[float] = []
+        self.done = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _analyze(self, email: Dict[str, Any]) -> Dict[str, Any]:
+        if self.limiter is not None:
+            self.limiter.acquire(max_wait=float('inf'))
+        start = time.monotonic()
+        analysis, reparto = self.processor.process_ticket(
+            email_message=None,
+            subject=email.get('subject', ''),
+            body=email.get('body', ''),
+            pdf_content=email.get('pdfContent', ''),
+            reparti=self.reparti,
+            email_id=email['id']
+        )
+        record = {
+            'id': email['id'],
+            'department': reparto['nome'] if reparto else None,
+            'analysis': analysis,
+            'duration': round(time.monotonic() - start, 3),
+            'at': datetime.now().isoformat(timespec='seconds'),
+        }
+        if not analysis or not reparto:
+            record['error'] = 'AI analysis failed' if not analysis else 'department not found'
+        return record
+
+    def _record(self, out, record: Dict[str, Any]) -> None:
+        with self._lock:
+            # Una riga per email, scritta subito: è il checkpoint per la ripresa
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            out.flush()
+            self.durations.append(record['duration'])
+            if record.get('error'):
+                self.failed += 1
+            else:
+                self.done += 1
+
+    def run(self, emails: Iterator[Dict[str, Any]], total: Optional[int] = None) -> float:
+        """
+        Analyze the emails, keeping at most 2 x workers in flight.
+
+        On Ctrl-C no more emails are submitted; those in flight are finished
+        and recorded, then KeyboardInterrupt is raised again (a second Ctrl-C
+        stops at once).
+
+        Returns:
+            Elapsed seconds
+        """
+        start = time.monotonic()
+        os.makedirs(os.path.dirname(os.path.abspath(self.run_path)), exist_ok=True)
+        with open(self.run_path, 'a', encoding='utf-8') as out, \
+                ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='backfill') as executor:
+            in_flight = {}
+            emails = iter(emails)
+            exhausted = False
+            interrupted = False
+            while in_flight or not exhausted:
+                try:
+                    while not exhausted and not self._stop.is_set() and len(in_flight) < self.workers * 2:
+                        email = next(emails, None)
+                        if email is None:
+                            exhausted = True
+                            break
+                        in_flight[executor.submit(self._analyze, email)] = email
+                    if self._stop.is_set():
+                        exhausted = True
+                    if not in_flight:
+                        break
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                except KeyboardInterrupt:
+                    if interrupted:
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        raise
+                    interrupted = True
+                    self.stop()
+                    logger.info(f"⛔ Interrupted: finishing {len(in_flight)} emails in flight (Ctrl-C again to abort)")
+                    continue
+                for future in finished:
+                    email = in_flight.pop(future)
+                    try:
+                        record = future.result()
+                    except Exception as e:
+                        record = {'id': email['id'], 'department': None, 'analysis': None,
+                                  'duration': 0.0, 'error': f"{type(e).__name__}: {e}",
+                                  'at': datetime.now().isoformat(timespec='seconds')}
+                    self._record(out, record)
+                processed = self.done + self.failed
+                if processed % 25 == 0 or processed == total:
+                    elapsed = time.monotonic() - start
+                    logger.info(f"⏳ {processed}{f'/{total}' if total else ''} emails "
+                                f"({processed / elapsed if elapsed else 0:.2f}/s, {self.failed} failed)")
+        if interrupted:
+            raise KeyboardInterrupt
+        return time.monotonic() - start
+
+    def stop(self) -> None:
+        """Stop submitting emails; those in flight are finished and recorded"""
+        self._stop.set()
+
+
+def agreement(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Optional[str]]) -> Dict[str, Any]:
+    """
+    Agreement of the departments of a run with baseline departments.
+
+    Args:
+        results: Run results by email id
+        baseline: Previous department by email id
+
+    Returns:
+        compared, agreed, rate and the most frequent changes (old -> new)
+    """
+    compared = agreed = 0
+    changes: Counter = Counter()
+    for email_id, record in results.items():
+        old, new = baseline.get(email_id), record.get('department')
+        if not old or not new:
+            continue
+        compared += 1
+        if old == new:
+            agreed += 1
+        else:
+            changes[f"{old} -> {new}"] += 1
+    return {
+        'compared': compared,
+        'agreed': agreed,
+        'rate': round(agreed / compared, 4) if compared else None,
+        'changes': dict(changes.most_common(10)),
+    }
+
+
+def apply_run(storage: EmailStorage, run: str, results: Dict[str, Dict[str, Any]]) -> int:
+    """
+    Store the results of a run in the emails file as email['analyses'][run].
+
+    The current routing fields are left as they are: the run is an
+    additional, versioned analysis.
+
+    Returns:
+        Emails updated
+    """
+    emails = storage.get_all_emails()
+    updated = 0
+    for email in emails:
+        record = results.get(email.get('id'))
+        if not record or record.get('error'):
+            continue
+        analysis = record.get('analysis') or {}
+        email.setdefault('analyses', {})[run] = {
+            'department': record['department'],
+            'summary': analysis.get('summary'),
+            'reasoning': analysis.get('reasoning'),
+            'confidence': analysis.get('confidence'),
+            'provider': analysis.get('provider'),
+            'at': record.get('at'),
+        }
+        updated += 1
+    if updated:
+        storage.save_all_emails(emails)
+    return updated
+
+
+def report(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Optional[str]], baseline_name: str,
+           elapsed: Optional[float] = None, durations: Optional[List[float]] = None) -> Dict[str, Any]:
+    """Summary of a run: counts, throughput, latency and agreement with the baseline"""
+    durations = durations if durations is not None else [r.get('duration', 0.0) for r in results.values()]
+    summary = {
+        'emails': len(results),
+        'failed': sum(1 for r in results.values() if r.get('error')),
+        'departments': dict(Counter(r['department'] for r in results.values() if r.get('department'))),
+        'latency_p50_s': round(_percentile(durations, 50), 3),
+        'latency_p95_s': round(_percentile(durations, 95), 3),
+        'agreement': {'baseline': baseline_name, **agreement(results, baseline)},
+    }
+    if elapsed:
+        summary['elapsed_s'] = round(elapsed, 1)
+        summary['throughput_per_s'] = round(len(durations) / elapsed, 3)
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Re-run the AI classification over the stored emails")
+    parser.add_argument('--run', default=datetime.now().strftime('%Y%m%d-%H%M%S'),
+                        help="Name (version) of the run; an existing run is resumed")
+    parser.add_argument('--emails', default='emails.json', help="EmailStorage file")
+    parser.add_argument('--config', default='config_api.json', help="Settings file of the API")
+    parser.add_argument('--reparti', default='reparti_api.json', help="Departments file of the API")
+    parser.add_argument('--runs-dir', default=RUNS_DIR, help="Directory of the run results")
+    parser.add_argument('--workers', type=int, default=4, help="Emails analyzed concurrently")
+    parser.add_argument('--rate', type=float, help="Maximum emails per minute (e.g. 0.5: one every 2 minutes)")
+    parser.add_argument('--status', help="Only emails with this status (e.g. forwarded)")
+    parser.add_argument('--limit', type=int, help="Process at most N emails")
+    parser.add_argument('--retry-failed', action='store_true', help="Analyze again the emails that failed")
+    parser.add_argument('--baseline', help="Run to compare with (default: the stored departments)")
+    parser.add_argument('--apply', action='store_true', help="Store the results as email['analyses'][run]")
+    parser.add_argument('--report', action='store_true', help="Only print the report of an existing run")
+    args = parser.parse_args(argv)
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be positive")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    storage = EmailStorage(args.emails)
+    run_path = os.path.join(args.runs_dir, f"{args.run}.jsonl")
+    previous = load_run(run_path)
+
+    elapsed, durations = None, None
+    if not args.report:
+        config_manager = ConfigManager(args.config)
+        reparti = RepartiManager(args.reparti).get_all()
+        if not reparti:
+            logger.error("❌ No departments configured")
+            return 1
+
+        def config_get(key, default=None):
+            if key == 'OLLAMA_URL':
+                return config_manager.get(key, '') or 'http://localhost:11434/v1'
+            return config_manager.get(key, default)
+
+        # Senza indice storico: l'email troverebbe se stessa tra i ticket già instradati
+        processor = create_router(config_get, default_ollama_model='gemma3:4b')
+        processor.prepare_departments(reparti)
+
+        skip = {i for i, r in previous.items() if not (args.retry_failed and r.get('error'))}
+        pending = list(iter_emails(storage, skip, args.status, args.limit))
+        if previous:
+            logger.info(f"🔁 Resuming run '{args.run}': {len(skip)} emails already done")
+        logger.info(f"🚀 Backfill '{args.run}': {len(pending)} emails, {args.workers} workers"
+                    + (f", {args.rate:g}/min" if args.rate else ""))
+
+        backfill = Backfill(processor, reparti, run_path, args.workers, args.rate)
+        try:
+            elapsed = backfill.run(iter(pending), total=len(pending))
+        except KeyboardInterrupt:
+            backfill.stop()
+            logger.info("⛔ Interrupted: run again with the same --run to resume")
+            return 130
+        durations = backfill.durations
+        previous = load_run(run_path)
+
+    if args.baseline:
+        baseline = {i: r.get('department') for i, r in load_run(os.path.join(args.runs_dir, f"{args.baseline}.jsonl")).items()}
+        baseline_name = args.baseline
+    else:
+        baseline = {e.get('id'): stored_department(e) for e in storage.get_all_emails()}
+        baseline_name = 'stored'
+    summary = report(previous, baseline, baseline_name, elapsed, durations)
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+
+    if args.apply:
+        updated = apply_run(storage, args.run, previous)
+        logger.info(f"💾 Stored analysis '{args.run}' on {updated} emails")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
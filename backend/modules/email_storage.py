@@ -5,6 +5,7 @@ Handles persistent storage of emails
 import json
 import os
 import logging
+import threading
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 
@@ -13,14 +14,22 @@ logger = logging.getLogger(__name__)
 class EmailStorage:
     """Manages email persistence with file storage"""
     
-    def __init__(self, storage_file: str = 'emails.json'):
+    def __init__(self, storage_file: str = 'emails.json', history_index=None):
         """
         Initialize the email storage manager
         
         Args:
             storage_file: Path to the emails JSON file
+            history_index: Optional TicketHistoryIndex kept in sync with routed emails
         """
         self.storage_file = storage_file
+        self.history_index = history_index
+        self._status_counts: Optional[Dict[str, int]] = None  # aggiornato a ogni salvataggio
+        # Ultima lista salvata, indicizzata in background (conta solo la più recente)
+        self._sync_pending: Optional[List[Dict[str, Any]]] = None
+        self._sync_lock = threading.Lock()
+        self._sync_wake = threading.Event()
+        self._sync_thread: Optional[threading.Thread] = None
         logger.info(f"EmailStorage initialized with file: {self.storage_file}")
     
     def _load_emails(self) -> List[Dict[str, Any]]:
@@ -46,6 +55,53 @@ class EmailStorage:
             logger.info(f"Saved {len(emails)} emails to {self.storage_file}")
         except Exception as e:
             logger.error(f"Error saving emails to {self.storage_file}: {e}")
+            return
+        
+        self._status_counts = self._count_statuses(emails)
+        self._schedule_history_sync(emails)
+    
+    @staticmethod
+    def _count_statuses(emails: List[Dict[str, Any]]) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for email in emails:
+            status = email.get('status') or 'unknown'
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+    
+    def status_counts(self) -> Dict[str, int]:
+        """Number of stored emails per status (file read only the first time)"""
+        if self._status_counts is None:
+            self._status_counts = self._count_statuses(self._load_emails())
+        return dict(self._status_counts)
+    
+    def sync_history_index(self, emails: Optional[List[Dict[str, Any]]] = None) -> None:
+        """Update the ticket history index with new or re-routed emails"""
+        if self.history_index is None:
+            return
+        try:
+            self.history_index.sync(emails if emails is not None else self._load_emails())
+        except Exception as e:
+            logger.error(f"Error updating ticket history index: {e}")
+    
+    def _schedule_history_sync(self, emails: List[Dict[str, Any]]) -> None:
+        """Index the saved emails in a background thread, off the request path"""
+        if self.history_index is None:
+            return
+        with self._sync_lock:
+            self._sync_pending = emails
+            if self._sync_thread is None:
+                self._sync_thread = threading.Thread(target=self._sync_loop, name='history-sync', daemon=True)
+                self._sync_thread.start()
+        self._sync_wake.set()
+    
+    def _sync_loop(self) -> None:
+        while True:
+            self._sync_wake.wait()
+            self._sync_wake.clear()
+            with self._sync_lock:
+                emails, self._sync_pending = self._sync_pending, None
+            if emails is not None:
+                self.sync_history_index(emails)
     
     def get_all_emails(self) -> List[Dict[str, Any]]:
         """Get all stored emails"""
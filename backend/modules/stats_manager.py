@@ -1,27 +1,50 @@
 """
 Statistics Manager for Email Support System
 Handles persistent storage of email statistics
+
+Updates only touch the in-memory aggregate under a lock; a background
+thread writes it to disk (atomically) at most once per flush interval,
+and a final flush runs on shutdown.
 """
+import atexit
+import copy
 import json
 import os
 import logging
+import threading
 from datetime import datetime
 from typing import Dict, Any, Optional
 
+from modules.file_utils import atomic_write_json
+from modules.timeseries import get_timeseries
+
 logger = logging.getLogger(__name__)
 
 class StatsManager:
-    """Manages email statistics with file persistence"""
+    """Manages email statistics with write-behind file persistence"""
     
-    def __init__(self, stats_file: str = 'email_stats.json'):
+    def __init__(self, stats_file: str = 'email_stats.json', flush_interval: float = 2.0):
         """
         Initialize the stats manager
         
         Args:
             stats_file: Path to the stats JSON file
+            flush_interval: Seconds between background writes of pending updates
         """
         self.stats_file = stats_file
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # Snapshot e scrittura sotto lo stesso lock: una copia vecchia non sovrascrive una più recente
+        self._write_lock = threading.RLock()
+        self._dirty = False
         self._stats = self._load_stats()
+        self.timeseries = get_timeseries()
+        
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="stats-flush", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+        
         logger.info(f"StatsManager initialized with file: {self.stats_file}")
         logger.info(f"Current stats: {self._stats}")
     
@@ -52,19 +75,51 @@ class StatsManager:
             'lastUpdated': datetime.now().isoformat()
         }
     
-    def _save_stats(self, stats: Optional[Dict[str, Any]] = None) -> None:
-        """Save stats to JSON file"""
+    def _save_stats(self, stats: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        Save stats to JSON file (atomic write-rename).
+        
+        Returns:
+            True if the file was written, False on error (logged)
+        """
         try:
-            stats_to_save = stats if stats is not None else self._stats
-            with open(self.stats_file, 'w', encoding='utf-8') as f:
-                json.dump(stats_to_save, f, indent=2, ensure_ascii=False)
-            logger.info(f"Stats saved to {self.stats_file}")
+            with self._write_lock:
+                if stats is None:
+                    with self._lock:
+                        stats = copy.deepcopy(self._stats)
+                atomic_write_json(self.stats_file, stats, indent=2, ensure_ascii=False)
+            logger.debug(f"Stats saved to {self.stats_file}")
+            return True
         except Exception as e:
             logger.error(f"Error saving stats to {self.stats_file}: {e}")
+            return False
+    
+    def flush(self) -> None:
+        """Write pending updates to disk"""
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                stats = copy.deepcopy(self._stats)
+                self._dirty = False
+            if not self._save_stats(stats):
+                # Scrittura fallita (es. disco pieno): riprova al prossimo flush o alla chiusura
+                with self._lock:
+                    self._dirty = True
+    
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+    
+    def close(self) -> None:
+        """Stop the background writer and flush pending updates"""
+        self._stop.set()
+        self.flush()
     
     def get_stats(self) -> Dict[str, Any]:
         """Get current statistics"""
-        return self._stats.copy()
+        with self._lock:
+            return copy.deepcopy(self._stats)
     
     def update_received_count(self, count: int) -> Dict[str, Any]:
         """
@@ -76,10 +131,13 @@ class StatsManager:
         Returns:
             Updated stats
         """
-        self._stats['totalReceived'] = self._stats.get('totalReceived', 0) + count
-        self._stats['lastUpdated'] = datetime.now().isoformat()
-        self._save_stats()
-        logger.info(f"Updated received count: +{count} (total: {self._stats['totalReceived']})")
+        with self._lock:
+            self._stats['totalReceived'] = self._stats.get('totalReceived', 0) + count
+            self._stats['lastUpdated'] = datetime.now().isoformat()
+            self._dirty = True
+            total = self._stats['totalReceived']
+        self.timeseries.increment('emails_received', count)
+        logger.debug(f"Updated received count: +{count} (total: {total})")
         return self.get_stats()
     
     def update_processed_email(self, department: str, confidence: float = 0.0) -> Dict[str, Any]:
@@ -93,35 +151,36 @@ class StatsManager:
         Returns:
             Updated stats
         """
-        # Increment total processed
-        self._stats['totalProcessed'] = self._stats.get('totalProcessed', 0) + 1
-        
-        # Increment department count
-        if 'byDepartment' not in self._stats:
-            self._stats['byDepartment'] = {}
-        
-        self._stats['byDepartment'][department] = self._stats['byDepartment'].get(department, 0) + 1
-        
-        # Update confidence for department
-        if 'confidenceByDepartment' not in self._stats:
-            self._stats['confidenceByDepartment'] = {}
-        
-        if department not in self._stats['confidenceByDepartment']:
-            self._stats['confidenceByDepartment'][department] = {'total': 0.0, 'count': 0}
-        
-        self._stats['confidenceByDepartment'][department]['total'] += confidence
-        self._stats['confidenceByDepartment'][department]['count'] += 1
-        
-        self._stats['lastUpdated'] = datetime.now().isoformat()
-        self._save_stats()
+        with self._lock:
+            # Increment total processed
+            self._stats['totalProcessed'] = self._stats.get('totalProcessed', 0) + 1
+            
+            # Increment department count
+            by_department = self._stats.setdefault('byDepartment', {})
+            by_department[department] = by_department.get(department, 0) + 1
+            
+            # Update confidence for department
+            confidence_stats = self._stats.setdefault('confidenceByDepartment', {}).setdefault(
+                department, {'total': 0.0, 'count': 0}
+            )
+            confidence_stats['total'] += confidence
+            confidence_stats['count'] += 1
+            
+            self._stats['lastUpdated'] = datetime.now().isoformat()
+            self._dirty = True
+            total = self._stats['totalProcessed']
         
-        logger.info(f"Updated processed stats: {department} (confidence: {confidence}, total: {self._stats['totalProcessed']})")
+        self.timeseries.increment('emails_processed', department=department)
+        self.timeseries.gauge('confidence', confidence, department=department)
+        logger.debug(f"Updated processed stats: {department} (confidence: {confidence}, total: {total})")
         return self.get_stats()
     
     def reset_stats(self) -> Dict[str, Any]:
         """Reset all statistics"""
-        self._stats = self._get_default_stats()
-        self._save_stats()
+        with self._lock:
+            self._stats = self._get_default_stats()
+            self._dirty = True
+        self.flush()
         logger.info("Stats reset to default")
         return self.get_stats()
     
@@ -135,8 +194,10 @@ class StatsManager:
         Returns:
             Updated stats
         """
-        self._stats = stats
-        self._stats['lastUpdated'] = datetime.now().isoformat()
-        self._save_stats()
+        with self._lock:
+            self._stats = stats
+            self._stats['lastUpdated'] = datetime.now().isoformat()
+            self._dirty = True
+        self.flush()
         logger.info("Stats manually updated")
         return self.get_stats()
@@ -0,0 +1,116 @@
+"""
+Microbenchmark for modules.html_text against the previous per-call HTMLParser
+implementation, using newsletter-sized HTML built from emails.json.
+
+Usage:
+    python benchmarks/bench_html_to_text.py [--emails emails.json] [--repeat 5]
+"""
+import argparse
+import html
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from modules.html_text import html_to_text
+
+_URL_RE = re.compile(r'\((https?://[^\s)]+)\s*\)')
+
+
+def legacy_html_to_text(html_content):
+    """Previous implementation (new parser class and uncompiled regex per call)"""
+    from html.parser import HTMLParser
+
+    class HTMLTextExtractor(HTMLParser):
+        def __init__(self):
+            super().__init__()
+            self.text = []
+            self.skip_tags = {'script', 'style', 'head', 'title', 'meta', '[document]'}
+            self.current_tag = None
+
+        def handle_starttag(self, tag, attrs):
+            self.current_tag = tag
+
+        def handle_endtag(self, tag):
+            self.current_tag = None
+            if tag in {'p', 'div', 'br', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}:
+                self.text.append('\n')
+
+        def handle_data(self, data):
+            if self.current_tag not in self.skip_tags:
+                text = data.strip()
+                if text:
+                    self.text.append(text + ' ')
+
+    parser = HTMLTextExtractor()
+    parser.feed(html_content)
+    text = ''.join(parser.text)
+    text = re.sub(r'\n\s*\n', '\n\n', text)
+    text = re.sub(r' +', ' ', text)
+    return text.strip()
+
+
+def build_newsletter(body):
+    """Render a stored plain-text newsletter as table-based marketing HTML"""
+    rows = []
+    for line in body.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        match = _URL_RE.search(line)
+        label = html.escape(_URL_RE.sub('', line).strip() or 'link')
+        if match:
+            cell = f'<a href="{html.escape(match.group(1))}" style="color:#f65b66">{label}</a>'
+        else:
+            cell = f'<span style="font-family:Arial">{label}</span>'
+        rows.append(f'<tr><td class="c" width="600">{cell}</td><td>&nbsp;</td></tr>')
+
+    return (
+        '<html><head><title>Newsletter</title>'
+        '<style>' + 'td.c{padding:0 24px;font-size:14px}' * 50 + '</style>'
+        '<script>window.dataLayer=[];function t(a){return a<1&&a>0}</script></head>'
+        '<body><center><table><tbody>' + ''.join(rows) + '</tbody></table>'
+        '<img src="https://track.example.com/open.gif" width="1" height="1"/>'
+        '</center></body></html>'
+    )
+
+
+def bench(func, documents, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for doc in documents:
+            func(doc)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--emails', default=os.path.join(os.path.dirname(__file__), '..', 'emails.json'))
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with open(args.emails, encoding='utf-8') as f:
+        emails = json.load(f)
+
+    documents = [build_newsletter(e.get('body', '')) for e in emails if e.get('body')]
+    total_mb = sum(len(d) for d in documents) / (1024 * 1024)
+    print(f"Documents: {len(documents)} ({total_mb:.2f} MB of HTML)")
+
+    for name, func in (
+        ('legacy', legacy_html_to_text),
+        ('html_text', html_to_text),
+        ('html_text (links)', lambda d: html_to_text(d, include_links=True)),
+        ('html_text (cap 4000)', lambda d: html_to_text(d, max_chars=4000)),
+    ):
+        elapsed = bench(func, documents, args.repeat)
+        print(f"{name:<22} {elapsed * 1000:8.1f} ms  {total_mb / elapsed:6.1f} MB/s  "
+              f"{len(documents) / elapsed:8.1f} docs/s")
+
+
+if __name__ == '__main__':
+    main()
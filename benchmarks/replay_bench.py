@@ -0,0 +1,571 @@
+"""
+Offline replay benchmark of the whole mail pipeline against local stub services.
+
+A corpus of raw RFC822 messages (seeded from emails.json, with synthetic
+HTML bodies and PDF attachments, or a directory of recorded .eml files) is
+served by a stub IMAP server and replayed through the real code:
+MailFetcher parsing, read_pdf_attachment, TicketProcessorSimple,
+get_location_details and MailSender. IMAP, SMTP, the LLM
+(OpenAI-compatible /chat/completions) and Azure Maps are simulated by stub
+servers in a child process, each with its own latency and error rate, so
+the numbers measure this code and not the network.
+
+Clients are pointed at the stubs without touching the modules: IMAP4_SSL
+and SMTP_SSL are replaced by plain-socket subclasses, Azure Maps URLs are
+rewritten to the stub. The Azure Maps rate limit still applies
+(RATE_LIMIT_AZURE_MAPS_REQUESTS to change it).
+
+Reports per-stage and end-to-end emails/s, p50/p99 latency and peak RSS.
+
+Usage:
+    python benchmarks/replay_bench.py [--messages 500] [--workers 8] [--llm-latency 0.3]
+    python benchmarks/replay_bench.py --record corpus/      # write the seeded corpus as .eml
+    python benchmarks/replay_bench.py --corpus corpus/      # replay recorded messages
+"""
+import argparse
+import email
+import html
+import imaplib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import smtplib
+import socketserver
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from email.utils import format_datetime, make_msgid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# config.py valida queste variabili all'import: bastano valori fittizi, i servizi sono stub
+for _key, _value in (('EMAIL', 'bench@bench.local'), ('EMAIL_PASSWORD', 'secret'), ('AZURE_API_KEY', 'bench-key')):
+    os.environ.setdefault(_key, _value)
+
+import requests
+
+from modules import azure_maps_full
+from modules.azure_maps_full import get_location_details
+from modules.mail_fetcher import MailFetcher
+from modules.mail_sender import MailSender
+from modules.process_mail import read_pdf_attachment
+from modules.ticket_processor_simple import TicketProcessorSimple
+from modules.tracing import LatencyHistogram
+
+# Picco di memoria residente: resource su Unix, psutil se installato altrove
+try:
+    import resource
+    RESOURCE_AVAILABLE = True
+except ImportError:
+    RESOURCE_AVAILABLE = False
+
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+AZURE_MAPS_BASE = 'https://atlas.microsoft.com'
+ADDRESS_HEADER = 'X-Bench-Address'
+STAGES = ('fetch', 'pdf', 'llm', 'geocode', 'smtp')
+
+DEPARTMENTS = [
+    {'nome': 'Technical Support', 'descrizione': 'Faults, repairs and technical problems', 'email': 'tech@bench.local'},
+    {'nome': 'Administration', 'descrizione': 'Invoices, payments and contracts', 'email': 'admin@bench.local'},
+    {'nome': 'Sales', 'descrizione': 'Quotes, orders and new customers', 'email': 'sales@bench.local'},
+    {'nome': 'Service Notifications', 'descrizione': 'Automatic notifications and newsletters', 'email': 'notify@bench.local'},
+]
+
+ADDRESSES = [
+    ('Via Roma 10, Milano, Italy', 'Milano', 'MI', 'Lombardia'),
+    ('Corso Vittorio Emanuele 5, Torino, Italy', 'Torino', 'TO', 'Piemonte'),
+    ('Via dei Calzaiuoli 3, Firenze, Italy', 'Firenze', 'FI', 'Toscana'),
+    ('Via Toledo 120, Napoli, Italy', 'Napoli', 'NA', 'Campania'),
+    ('Via Maqueda 200, Palermo, Italy', 'Palermo', 'PA', 'Sicilia'),
+]
+
+
+# ============= CORPUS =============
+
+def minimal_pdf(text: str) -> bytes:
+    """Single-page PDF with one line of Helvetica text (no PDF library needed)"""
+    escaped = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    stream = f"BT /F1 11 Tf 50 780 Td ({escaped}) Tj ET".encode('latin-1', errors='replace')
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+        b"/Resources << /Font << /F1 5 0 R >> >> /Contents 4 0 R >>",
+        b"<< /Length " + str(len(stream)).encode() + b" >>\nstream\n" + stream + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+
+def _html_body(text: str) -> str:
+    paragraphs = ''.join(f'<p style="font-family:Arial">{html.escape(line)}</p>'
+                         for line in text.splitlines() if line.strip())
+    return (f'<html><head><style>{"td{padding:0 12px}" * 20}</style></head>'
+            f'<body><table><tr><td>{paragraphs}</td></tr></table></body></html>')
+
+
+def seed_corpus(emails_path: str, size: int, seed: int = 0) -> List[bytes]:
+    """
+    RFC822 messages built from the stored emails, cycled up to size.
+
+    One in three gets an HTML alternative, one in four a PDF attachment;
+    each carries a street address (ADDRESS_HEADER) for the geocode stage.
+    """
+    with open(emails_path, encoding='utf-8') as f:
+        stored = [e for e in json.load(f) if e.get('body')]
+    if not stored:
+        raise SystemExit(f"No emails with a body in {emails_path}")
+
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        source = stored[i % len(stored)]
+        address = ADDRESSES[i % len(ADDRESSES)][0]
+        text = f"{source['body']}\n\nIndirizzo intervento: {address}"
+        msg = EmailMessage()
+        # Intestazioni salvate già decodificate: possono contenere a capo
+        msg['From'] = ' '.join((source.get('sender') or 'customer@example.com').split())
+        msg['To'] = 'support@bench.local'
+        msg['Subject'] = ' '.join((source.get('subject') or f'Ticket {i}').split())
+        msg['Date'] = format_datetime(email.utils.localtime())
+        msg['Message-ID'] = make_msgid(f'bench{i}')
+        msg[ADDRESS_HEADER] = address
+        msg.set_content(text)
+        if i % 3 == 0:
+            msg.add_alternative(_html_body(text), subtype='html')
+        if i % 4 == 0:
+            pdf = minimal_pdf(f"Rapporto intervento {i}: guasto caldaia presso {address} "
+                              f"codice {rng.randint(1000, 9999)}")
+            msg.add_attachment(pdf, maintype='application', subtype='pdf', filename=f'rapporto_{i}.pdf')
+        corpus.append(msg.as_bytes())
+    return corpus
+
+
+def load_corpus(directory: str, size: Optional[int]) -> List[bytes]:
+    """Recorded .eml files, cycled up to size"""
+    names = sorted(n for n in os.listdir(directory) if n.endswith('.eml'))
+    if not names:
+        raise SystemExit(f"No .eml files in {directory}")
+    messages = []
+    for name in names:
+        with open(os.path.join(directory, name), 'rb') as f:
+            messages.append(f.read())
+    size = size or len(messages)
+    return [messages[i % len(messages)] for i in range(size)]
+
+
+def record_corpus(corpus: List[bytes], directory: str) -> None:
+    os.makedirs(directory, exist_ok=True)
+    for i, raw in enumerate(corpus):
+        with open(os.path.join(directory, f'{i:06d}.eml'), 'wb') as f:
+            f.write(raw)
+
+
+# ============= STUB SERVERS =============
+
+class _Faults:
+    """Latency (mean seconds, +/-50% jitter) and error rate of a stub service"""
+
+    def __init__(self, latency: float, error_rate: float, seed: int):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self) -> None:
+        if self.latency > 0:
+            with self._lock:
+                value = self.latency * self._rng.uniform(0.5, 1.5)
+            time.sleep(value)
+
+    def fail(self) -> bool:
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+
+class _ImapHandler(socketserver.StreamRequestHandler):
+    """Minimal IMAP4rev1: LOGIN, SELECT, UID SEARCH UNSEEN, UID FETCH, CLOSE, LOGOUT"""
+
+    def _send(self, line: str) -> None:
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self) -> None:
+        server = self.server
+        self._send('* OK [CAPABILITY IMAP4rev1 AUTH=PLAIN UIDPLUS] stub ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.decode(errors='replace').strip().split(' ')
+            tag, command = parts[0], ' '.join(parts[1:3]).upper()
+            if command.startswith('CAPABILITY'):
+                self._send('* CAPABILITY IMAP4rev1 AUTH=PLAIN UIDPLUS')
+            elif command.startswith('SELECT'):
+                self._send(f'* {len(server.messages)} EXISTS')
+                self._send('* OK [UIDVALIDITY 1] UIDs valid')
+                self._send(f'{tag} OK [READ-WRITE] SELECT completed')
+                continue
+            elif command == 'UID SEARCH':
+                # Ogni ricerca consegna il lotto successivo di messaggi "non letti"
+                with server.lock:
+                    batch = server.unseen[:server.batch_size]
+                    del server.unseen[:server.batch_size]
+                self._send('* SEARCH ' + ' '.join(str(uid) for uid in batch))
+            elif command == 'UID FETCH':
+                server.faults.delay()
+                if server.faults.fail():
+                    self._send(f'{tag} NO [UNAVAILABLE] stub fetch error')
+                    continue
+                uid = int(parts[3])
+                raw = server.messages[uid - 1]
+                self.wfile.write(f'* {uid} FETCH (UID {uid} BODY[] {{{len(raw)}}}\r\n'.encode() + raw + b')\r\n')
+            elif command.startswith('LOGOUT'):
+                self._send('* BYE stub closing')
+                self._send(f'{tag} OK LOGOUT completed')
+                return
+            self._send(f'{tag} OK {command or "NOOP"} completed')
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    """Minimal ESMTP with AUTH PLAIN; DATA is read and discarded"""
+
+    def _send(self, line: str) -> None:
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self) -> None:
+        server = self.server
+        self._send('220 stub ESMTP ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self._send('250-stub')
+                self._send('250-AUTH PLAIN')
+                self._send('250 SIZE 52428800')
+            elif command.startswith('AUTH'):
+                self._send('235 2.7.0 Authentication successful')
+            elif command.startswith('DATA'):
+                self._send('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b'.\n', b''):
+                    pass
+                server.faults.delay()
+                if server.faults.fail():
+                    self._send('451 4.3.0 stub temporary failure')
+                else:
+                    server.delivered += 1
+                    self._send('250 2.0.0 queued')
+            elif command.startswith('QUIT'):
+                self._send('221 2.0.0 bye')
+                return
+            else:
+                self._send('250 2.0.0 OK')
+
+
+class _HttpStubHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible /chat/completions and Azure Maps search endpoints"""
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _reply(self, status: int, payload: Dict) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        request = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.faults.delay()
+        if self.server.faults.fail():
+            self._reply(503, {'error': {'message': 'stub overloaded'}})
+            return
+        # Reparto deterministico per lo stesso prompt
+        department = DEPARTMENTS[zlib.crc32(request) % len(DEPARTMENTS)]['nome']
+        content = json.dumps({'reparto_suggerito': department, 'confidence': 85,
+                              'summary': 'Replayed ticket', 'reasoning': 'stub response'})
+        self._reply(200, {'choices': [{'message': {'role': 'assistant', 'content': content}}],
+                          'usage': {'prompt_tokens': len(request) // 4, 'completion_tokens': 40,
+                                    'total_tokens': len(request) // 4 + 40}})
+
+    def do_GET(self) -> None:
+        self.server.faults.delay()
+        if self.server.faults.fail():
+            self._reply(500, {'error': 'stub error'})
+            return
+        query = self.path.partition('query=')[2]
+        if self.path.startswith('/search/address/reverse/json'):
+            index = int(float(query.split('%2C')[0].split(',')[0] or 0)) % len(ADDRESSES)
+            _, comune, provincia, regione = ADDRESSES[index]
+            self._reply(200, {'addresses': [{'address': {'municipality': comune,
+                                                         'countrySecondarySubdivision': provincia,
+                                                         'countrySubdivision': regione}}]})
+        elif self.path.startswith('/search/address/json'):
+            # Latitudine = indice dell'indirizzo, così il reverse geocode lo ritrova
+            index = next((i for i, a in enumerate(ADDRESSES)
+                          if a[1].lower() in requests.utils.unquote(query).lower()), 0)
+            self._reply(200, {'results': [{'position': {'lat': index + 0.5, 'lon': 9.0}}]})
+        else:
+            self._reply(404, {'error': 'not found'})
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _serve_stubs(config: Dict, corpus: List[bytes], ready, stop) -> None:
+    """Child process: run the four stub servers until stop is set"""
+    servers = {}
+    for name, factory in (
+        ('imap', lambda: _ThreadingTCPServer(('127.0.0.1', 0), _ImapHandler)),
+        ('smtp', lambda: _ThreadingTCPServer(('127.0.0.1', 0), _SmtpHandler)),
+        ('llm', lambda: ThreadingHTTPServer(('127.0.0.1', 0), _HttpStubHandler)),
+        ('maps', lambda: ThreadingHTTPServer(('127.0.0.1', 0), _HttpStubHandler)),
+    ):
+        server = factory()
+        server.daemon_threads = True
+        server.faults = _Faults(config[f'{name}_latency'], config[f'{name}_error_rate'], seed=len(servers))
+        servers[name] = server
+    imap = servers['imap']
+    imap.messages = corpus
+    imap.unseen = list(range(1, len(corpus) + 1))
+    imap.batch_size = config['batch_size']
+    imap.lock = threading.Lock()
+    servers['smtp'].delivered = 0
+
+    for server in servers.values():
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    ready.put({name: server.server_address[1] for name, server in servers.items()})
+    stop.wait()
+    for server in servers.values():
+        server.shutdown()
+
+
+def _point_clients_at(ports: Dict[str, int]) -> None:
+    """Redirect the IMAP, SMTP and Azure Maps clients of the pipeline to the stubs"""
+
+    class StubIMAP(imaplib.IMAP4):
+        def __init__(self, host='', port=None, **kwargs):
+            super().__init__('127.0.0.1', ports['imap'])
+
+    class StubSMTP(smtplib.SMTP):
+        def __init__(self, host='', port=0, **kwargs):
+            super().__init__('127.0.0.1', ports['smtp'], timeout=kwargs.get('timeout', 30))
+
+    class AzureRedirect:
+        def get(self, url, **kwargs):
+            return requests.get(url.replace(AZURE_MAPS_BASE, f"http://127.0.0.1:{ports['maps']}"), **kwargs)
+
+    imaplib.IMAP4_SSL = StubIMAP
+    smtplib.SMTP_SSL = StubSMTP
+    azure_maps_full.requests = AzureRedirect()
+
+
+# ============= REPLAY =============
+
+class StageStats:
+    """Latency histogram, busy time and errors of one stage"""
+
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, ok: bool = True) -> None:
+        self.histogram.record(seconds)
+        if not ok:
+            with self._lock:
+                self.errors += 1
+
+    def summary(self) -> Dict:
+        h = self.histogram
+        return {
+            'count': h.count,
+            'errors': self.errors,
+            # Capacità di un singolo thread: email elaborate per secondo di lavoro dello stadio
+            'emails_per_s': round(h.count / h.sum, 1) if h.sum else None,
+            'p50_ms': round((h.percentile(50) or 0) * 1000, 2),
+            'p99_ms': round((h.percentile(99) or 0) * 1000, 2),
+        }
+
+
+def peak_rss_mb() -> Optional[float]:
+    if RESOURCE_AVAILABLE:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # KB su Linux, byte su macOS
+        return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    if PSUTIL_AVAILABLE:
+        info = psutil.Process().memory_info()
+        return round(getattr(info, 'peak_wset', info.rss) / (1024 * 1024), 1)
+    return None
+
+
+def replay(ports: Dict[str, int], workers: int) -> Dict:
+    """Fetch every message from the stub IMAP and run the pipeline on a thread pool"""
+    _point_clients_at(ports)
+    fetcher = MailFetcher('imap.bench.local', 'bench@bench.local', 'secret')
+    sender = MailSender('smtp.bench.local', 'bench@bench.local', 'secret')
+    processor = TicketProcessorSimple('ollama', provider='ollama', model='llama3.1',
+                                      api_base=f"http://127.0.0.1:{ports['llm']}/v1", timeout=30)
+    processor.prepare_departments(DEPARTMENTS)
+    stages = {name: StageStats() for name in STAGES}
+    end_to_end = LatencyHistogram()
+    routed: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    def timed(stage: str, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            stages[stage].record(time.perf_counter() - start, ok=False)
+            raise
+        return result, time.perf_counter() - start
+
+    def process(msg, metadata, fetched_at: float) -> None:
+        try:
+            pdf_content, elapsed = timed('pdf', read_pdf_attachment, msg)
+            stages['pdf'].record(elapsed)
+
+            (analysis, reparto), elapsed = timed('llm', processor.process_ticket, msg, metadata['subject'],
+                                                 metadata['body'], pdf_content, DEPARTMENTS)
+            stages['llm'].record(elapsed, ok=bool(reparto))
+            if not reparto:
+                return
+
+            address = msg.get(ADDRESS_HEADER)
+            if address:
+                location, elapsed = timed('geocode', get_location_details, address, 'bench-key')
+                stages['geocode'].record(elapsed, ok='error' not in (location or {'error': True}))
+
+            sent, elapsed = timed('smtp', sender.send_forwarded_mail, reparto['email'], metadata['from'],
+                                  metadata['subject'], metadata['body'], metadata['date'], reparto['nome'],
+                                  analysis.get('summary'), analysis.get('confidence'), msg)
+            stages['smtp'].record(elapsed, ok=sent)
+            if sent:
+                end_to_end.record(time.perf_counter() - fetched_at)
+                with lock:
+                    routed[reparto['nome']] = routed.get(reparto['nome'], 0) + 1
+        except Exception as e:
+            logging.getLogger(__name__).error(f"Replay error: {e}")
+
+    start = time.perf_counter()
+    total = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='replay') as executor:
+        while True:
+            batch_start = time.perf_counter()
+            batch = fetcher.fetch_unread_emails()
+            if not batch:
+                break
+            fetch_time = time.perf_counter() - batch_start
+            for msg, metadata in batch:
+                # Il tempo del lotto diviso tra i suoi messaggi
+                stages['fetch'].record(fetch_time / len(batch))
+                executor.submit(process, msg, metadata, batch_start)
+            total += len(batch)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'messages': total,
+        'forwarded': end_to_end.count,
+        'elapsed_s': round(elapsed, 2),
+        'end_to_end': {
+            'emails_per_s': round(end_to_end.count / elapsed, 1) if elapsed else None,
+            'p50_ms': round((end_to_end.percentile(50) or 0) * 1000, 1),
+            'p99_ms': round((end_to_end.percentile(99) or 0) * 1000, 1),
+        },
+        'stages': {name: stats.summary() for name, stats in stages.items()},
+        'departments': routed,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--emails', default=os.path.join(os.path.dirname(__file__), '..', 'emails.json'),
+                        help="Stored emails the corpus is seeded from")
+    parser.add_argument('--corpus', help="Directory of recorded .eml messages to replay instead")
+    parser.add_argument('--record', help="Write the seeded corpus to this directory and exit")
+    parser.add_argument('--messages', type=int, default=200, help="Messages to replay (corpus is cycled)")
+    parser.add_argument('--workers', type=int, default=8, help="Pipeline threads")
+    parser.add_argument('--batch-size', type=int, default=50, help="Messages per IMAP fetch")
+    parser.add_argument('--seed', type=int, default=0)
+    for name, latency in (('imap', 0.002), ('smtp', 0.02), ('llm', 0.3), ('maps', 0.05)):
+        parser.add_argument(f'--{name}-latency', type=float, default=latency,
+                            help=f"Mean {name.upper()} stub latency in seconds (default {latency})")
+        parser.add_argument(f'--{name}-error-rate', type=float, default=0.0,
+                            help=f"Fraction of {name.upper()} stub requests that fail")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    parser.add_argument('--verbose', action='store_true', help="Show the pipeline logs")
+    args = parser.parse_args()
+
+    # Gli errori simulati sono contati nel report: i log solo con --verbose
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    if args.corpus:
+        corpus = load_corpus(args.corpus, args.messages)
+    else:
+        corpus = seed_corpus(args.emails, args.messages, args.seed)
+    if args.record:
+        record_corpus(corpus, args.record)
+        print(f"Recorded {len(corpus)} messages in {args.record}")
+        return
+
+    config = {k: v for k, v in vars(args).items() if k.endswith(('_latency', '_error_rate'))}
+    config['batch_size'] = args.batch_size
+    # I server stub girano in un altro processo: RSS e CPU misurati sono della sola pipeline
+    ready, stop = multiprocessing.Queue(), multiprocessing.Event()
+    stubs = multiprocessing.Process(target=_serve_stubs, args=(config, corpus, ready, stop), daemon=True)
+    stubs.start()
+    try:
+        ports = ready.get(timeout=30)
+        corpus_mb = sum(len(m) for m in corpus) / (1024 * 1024)
+        print(f"Corpus: {len(corpus)} messages ({corpus_mb:.2f} MB), {args.workers} workers, "
+              f"stubs on ports {ports}")
+        report = replay(ports, args.workers)
+    finally:
+        stop.set()
+        stubs.join(timeout=10)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    e2e = report['end_to_end']
+    print(f"Forwarded {report['forwarded']}/{report['messages']} in {report['elapsed_s']} s")
+    print(f"{'end-to-end':<12} {e2e['emails_per_s'] or 0:10.1f} emails/s  "
+          f"p50 {e2e['p50_ms']:9.1f} ms  p99 {e2e['p99_ms']:9.1f} ms")
+    for name, stats in report['stages'].items():
+        print(f"{name:<12} {stats['emails_per_s'] or 0:10.1f} emails/s  "
+              f"p50 {stats['p50_ms']:9.1f} ms  p99 {stats['p99_ms']:9.1f} ms  "
+              f"({stats['count']} runs, {stats['errors']} errors)")
+    rss = report['peak_rss_mb']
+    print(f"Peak RSS: {f'{rss} MB' if rss is not None else 'n/a'}")
+
+
+if __name__ == '__main__':
+    main()
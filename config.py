@@ -11,6 +11,12 @@ class Config:
     SMTP_HOST = os.getenv('SMTP', 'smtp.gmail.com')
     CONTROL_EMAIL = os.getenv('CONTROL_EMAIL', EMAIL_ACCOUNT)
     
+    # Archiviazione IMAP dopo l'inoltro
+    IMAP_ACTIONS = os.getenv('IMAP_ACTIONS', 'true').lower() == 'true'
+    IMAP_ROUTED_FOLDER = os.getenv('IMAP_ROUTED_FOLDER', 'Routed')
+    IMAP_RETRY_FOLDER = os.getenv('IMAP_RETRY_FOLDER', 'Retry')
+    IMAP_REVIEW_FOLDER = os.getenv('IMAP_REVIEW_FOLDER', 'Review')
+    
     # Recipients
     USE_TEST = os.getenv('USE_TEST_RECIPIENTS', 'false').lower() == 'true'
     suffix = '_TEST' if USE_TEST else '_PROD'
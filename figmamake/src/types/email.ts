@@ -1,5 +1,7 @@
 export interface Email {
   id: string;
+  uid?: string; // IMAP UID of the source message
+  messageId?: string; // Message-ID header, key of the stored ticket
   sender: string;
   subject: string;
   body: string;
@@ -9,6 +9,7 @@ import tkinter as tk
 from tkinter import ttk, messagebox
 import json
 from datetime import datetime
+from functools import partial
 import logging
 
 logger = logging.getLogger(__name__)
@@ -18,8 +19,15 @@ from modules.config_manager import ConfigManager
 from modules.reparti_manager import RepartiManager
 from modules.mail_fetcher import MailFetcher
 from modules.mail_sender import MailSender
-from modules.ticket_processor_simple import TicketProcessorSimple
+from modules.imap_actions import DEFAULT_RETRY_FOLDER, DEFAULT_ROUTED_FOLDER, ImapActions
+from modules.llm_router import ROUTER_CONFIG_KEYS, create_router
+from modules.processor_registry import ProcessorRegistry
 from modules.process_mail import read_pdf_attachment
+from modules.task_runner import DEFAULT_WORKERS, CancelToken, TaskRunner
+from modules.ticket_sink import record_ticket
+from modules.mail_table_model import COLUMNS, NOT_PROCESSED, MailTableModel
+from modules.raw_message_store import RawMessageStore
+from modules.parsed_message import parse_message
 
 
 class ConfigFrame(ttk.LabelFrame):
@@ -182,249 +190,654 @@ class DepartmentsFrame(ttk.LabelFrame):
         messagebox.showinfo("Departments", "Departments saved successfully!")
 
 
+class BatchConfirmDialog(tk.Toplevel):
+    """Single confirmation of the AI routing of a batch of emails"""
+    
+    CHECKED = "☑"
+    UNCHECKED = "☐"
+    
+    def __init__(self, master, rows):
+        """
+        Args:
+            master: Parent widget
+            rows: List of (MailRow, analysis, reparto)
+        """
+        super().__init__(master)
+        self.title("Confirm AI Routing")
+        self.geometry("900x400")
+        self.transient(master)
+        self.result = None
+        
+        ttk.Label(self, text=f"{len(rows)} emails analyzed. Uncheck the ones you don't want to forward "
+                             f"(click or space to toggle).").pack(anchor="w", padx=10, pady=5)
+        
+        columns = ("Send", "Subject", "Department", "Confidence", "Summary")
+        self.tree = ttk.Treeview(self, columns=columns, show="headings", height=12)
+        for col, width in zip(columns, (50, 220, 140, 90, 360)):
+            self.tree.heading(col, text=col)
+            self.tree.column(col, width=width, anchor="center" if col in ("Send", "Confidence") else "w")
+        self.tree.pack(fill="both", expand=True, padx=10, pady=5)
+        
+        for row, analysis, reparto in rows:
+            confidence = analysis.get('confidence', 0)
+            icon = "✅" if confidence >= 70 else "⚠️"
+            self.tree.insert('', 'end', iid=row.key, values=(
+                self.CHECKED,
+                row.subject[:60],
+                reparto['nome'],
+                f"{icon} {confidence}%",
+                (analysis.get('summary') or 'N/A')[:120]
+            ))
+        
+        self.tree.bind("<Button-1>", self._on_click)
+        self.tree.bind("<space>", lambda e: self._toggle(self.tree.selection()))
+        
+        btn_frame = ttk.Frame(self)
+        btn_frame.pack(fill="x", padx=10, pady=5)
+        ttk.Button(btn_frame, text="Select all", command=lambda: self._set_all(self.CHECKED)).pack(side="left", padx=5)
+        ttk.Button(btn_frame, text="Select none", command=lambda: self._set_all(self.UNCHECKED)).pack(side="left", padx=5)
+        ttk.Button(btn_frame, text="Cancel", command=self.destroy).pack(side="right", padx=5)
+        ttk.Button(btn_frame, text="📤 Send selected", command=self._confirm).pack(side="right", padx=5)
+        
+        self.protocol("WM_DELETE_WINDOW", self.destroy)
+        self.grab_set()
+    
+    def _on_click(self, event):
+        item = self.tree.identify_row(event.y)
+        if item and self.tree.identify_column(event.x) == "#1":
+            self._toggle([item])
+    
+    def _toggle(self, items):
+        for item in items:
+            checked = self.tree.set(item, "Send") == self.CHECKED
+            self.tree.set(item, "Send", self.UNCHECKED if checked else self.CHECKED)
+    
+    def _set_all(self, mark):
+        for item in self.tree.get_children():
+            self.tree.set(item, "Send", mark)
+    
+    def _confirm(self):
+        self.result = [item for item in self.tree.get_children() if self.tree.set(item, "Send") == self.CHECKED]
+        self.destroy()
+    
+    @classmethod
+    def ask(cls, master, rows):
+        """Show the dialog and wait; returns the confirmed item ids (None if cancelled)"""
+        dialog = cls(master, rows)
+        master.wait_window(dialog)
+        return dialog.result
+
+
+class VirtualMailTable(ttk.Frame):
+    """
+    Treeview that renders only the rows on screen.
+    
+    Rows come from a MailTableModel; scrolling re-renders the visible
+    window, so the widget cost does not grow with the number of emails.
+    Selection is kept by row key, also for rows scrolled out of view.
+    """
+    
+    DEFAULT_ROW_HEIGHT = 20
+    
+    def __init__(self, master, model, *args, **kwargs):
+        super().__init__(master, *args, **kwargs)
+        self.model = model
+        self.offset = 0
+        self.visible_rows = 12
+        self.selected = set()
+        self._rendered = []
+        self._refresh_pending = False
+        
+        self.tree = ttk.Treeview(self, columns=COLUMNS, show="headings", height=self.visible_rows)
+        for col in COLUMNS:
+            self.tree.heading(col, text=col, command=partial(self.sort_by, col))
+            width = 150 if col in ("Sender", "Subject") else 120
+            self.tree.column(col, width=width)
+        self._update_headings()
+        
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self._on_scrollbar)
+        self.scrollbar.pack(side="right", fill="y")
+        self.tree.pack(side="left", fill="both", expand=True)
+        
+        self.tree.bind("<<TreeviewSelect>>", self._on_select)
+        # A plain click starts a new selection, also dropping rows scrolled out of view
+        self.tree.bind("<Button-1>", lambda e: self.selected.clear())
+        self.tree.bind("<Control-Button-1>", lambda e: None)
+        self.tree.bind("<Shift-Button-1>", lambda e: None)
+        self.tree.bind("<Configure>", self._on_resize)
+        self.tree.bind("<MouseWheel>", lambda e: self.scroll(-1 if e.delta > 0 else 1, "units"))
+        self.tree.bind("<Button-4>", lambda e: self.scroll(-1, "units"))
+        self.tree.bind("<Button-5>", lambda e: self.scroll(1, "units"))
+        self.tree.bind("<Up>", lambda e: self._on_arrow(-1))
+        self.tree.bind("<Down>", lambda e: self._on_arrow(1))
+        self.tree.bind("<Prior>", lambda e: self.scroll(-1, "pages") or "break")
+        self.tree.bind("<Next>", lambda e: self.scroll(1, "pages") or "break")
+    
+    def _row_height(self):
+        height = ttk.Style().lookup("Treeview", "rowheight")
+        try:
+            return int(height) or self.DEFAULT_ROW_HEIGHT
+        except (TypeError, ValueError):
+            return self.DEFAULT_ROW_HEIGHT
+    
+    def _on_resize(self, event):
+        # Intestazione esclusa: circa una riga
+        rows = max(1, event.height // self._row_height() - 1)
+        if rows != self.visible_rows:
+            self.visible_rows = rows
+            self.refresh()
+    
+    def _on_scrollbar(self, action, amount, unit=None):
+        if action == "moveto":
+            self.offset = int(float(amount) * len(self.model))
+            self.refresh()
+        elif action == "scroll":
+            self.scroll(int(amount), unit)
+    
+    def scroll(self, amount, unit="units"):
+        step = self.visible_rows if unit == "pages" else 1
+        self.offset += amount * step
+        self.refresh()
+    
+    def _on_arrow(self, direction):
+        """Scroll when the keyboard focus moves past the first/last rendered row"""
+        focus = self.tree.focus()
+        if not self._rendered or focus not in self._rendered:
+            return None
+        index = self._rendered.index(focus) + direction
+        if 0 <= index < len(self._rendered):
+            return None
+        self.scroll(direction)
+        target = self._rendered[0 if direction < 0 else -1] if self._rendered else None
+        if target:
+            self.selected = {target}
+            self.tree.focus(target)
+            self.tree.selection_set(target)
+        return "break"
+    
+    def _update_headings(self):
+        for col in COLUMNS:
+            arrow = (" ▼" if self.model.descending else " ▲") if col == self.model.sort_column else ""
+            self.tree.heading(col, text=col + arrow)
+    
+    def sort_by(self, column):
+        self.model.set_sort(column)
+        self._update_headings()
+        self.refresh()
+    
+    def set_filter(self, text):
+        self.model.set_filter(text)
+        self.offset = 0
+        self.refresh()
+    
+    def _on_select(self, event):
+        # Also fired by refresh(): the tree already shows the restored selection then
+        rendered = set(self._rendered)
+        self.selected = (self.selected - rendered) | set(self.tree.selection())
+    
+    def schedule_refresh(self):
+        """Coalesce many row updates into a single redraw"""
+        if not self._refresh_pending:
+            self._refresh_pending = True
+            self.after_idle(self.refresh)
+    
+    def refresh(self):
+        """Render the rows of the visible window"""
+        self._refresh_pending = False
+        total = len(self.model)
+        self.offset = max(0, min(self.offset, total - self.visible_rows))
+        rows = self.model.slice(self.offset, self.offset + self.visible_rows)
+        
+        focus = self.tree.focus()
+        self.tree.delete(*self.tree.get_children())
+        for row in rows:
+            self.tree.insert('', 'end', iid=row.key, values=row.values())
+        self._rendered = [row.key for row in rows]
+        self.tree.selection_set([k for k in self._rendered if k in self.selected])
+        if focus in self._rendered:
+            self.tree.focus(focus)
+        
+        if total:
+            self.scrollbar.set(self.offset / total, min(1.0, (self.offset + len(rows)) / total))
+        else:
+            self.scrollbar.set(0, 1)
+    
+    def focused(self):
+        """Key of the row with keyboard focus (None if not rendered)"""
+        focus = self.tree.focus()
+        return focus if focus in self._rendered else None
+    
+    def forget_rows(self, keys):
+        self.selected.difference_update(keys)
+
+
 class MailTableFrame(ttk.LabelFrame):
     """Frame for email display and management"""
     
-    def __init__(self, master, config_manager, reparti_manager, *args, **kwargs):
+    # Intervallo di consegna dei risultati dei worker al thread di Tk (ms)
+    POLL_INTERVAL_MS = 50
+    
+    def __init__(self, master, config_manager, reparti_manager, message_store, *args, **kwargs):
         super().__init__(master, text="Operations Control", *args, **kwargs)
         self.config_manager = config_manager
         self.reparti_manager = reparti_manager
-        self.ticket_processor = None  # Lazy initialization
+        # Full messages stay on disk; the table keeps only row summaries
+        self.message_store = message_store
+        # Router rebuilt only when LLM settings or departments change
+        self.processor_registry = ProcessorRegistry(
+            lambda: create_router(self.config_manager.get),
+            self.config_manager,
+            ROUTER_CONFIG_KEYS,
+            self.reparti_manager
+        )
+        
+        # IMAP, PDF, LLM and SMTP run on worker threads; results come back via after()
+        self.runner = TaskRunner(int(self.config_manager.get('GUI_WORKERS', DEFAULT_WORKERS) or DEFAULT_WORKERS))
+        self._batch = None
+        self._imap_actions = None
         
         # Action buttons
         btn_frame = ttk.Frame(self)
         btn_frame.pack(fill="x", padx=5, pady=5)
         
-        ttk.Button(btn_frame, text="📬 Check Mail", command=self.check_mail).pack(side="left", padx=5)
-        ttk.Button(btn_frame, text="🔄 Process Selected", command=self.process_mail).pack(side="left", padx=5)
+        self.check_btn = ttk.Button(btn_frame, text="📬 Check Mail", command=self.check_mail)
+        self.check_btn.pack(side="left", padx=5)
+        self.process_btn = ttk.Button(btn_frame, text="🔄 Process Selected", command=self.process_mail)
+        self.process_btn.pack(side="left", padx=5)
         ttk.Button(btn_frame, text="📋 Details", command=self.show_details).pack(side="left", padx=5)
         ttk.Button(btn_frame, text="🗑️ Remove", command=self.remove_selected).pack(side="left", padx=5)
-        
-        # Mail table
-        columns = ("Sender", "Subject", "Date", "Department", "Status")
-        self.tree = ttk.Treeview(self, columns=columns, show="headings", height=12)
-        
-        for col in columns:
-            self.tree.heading(col, text=col)
-            width = 150 if col in ("Sender", "Subject") else 120
-            self.tree.column(col, width=width)
-        
-        self.tree.pack(fill="both", expand=True, padx=5, pady=5)
-        
-        # Store complete mail data
-        self.mail_data = {}
+        self.cancel_btn = ttk.Button(btn_frame, text="⛔ Cancel", command=self.cancel_batch, state="disabled")
+        self.cancel_btn.pack(side="left", padx=5)
+        
+        # Progress of the running batch
+        progress_frame = ttk.Frame(self)
+        progress_frame.pack(fill="x", padx=5)
+        self.progress = ttk.Progressbar(progress_frame, mode="determinate", length=200)
+        self.progress.pack(side="left", padx=5)
+        self.status_var = tk.StringVar(value="Ready")
+        ttk.Label(progress_frame, textvariable=self.status_var).pack(side="left", padx=5)
+        
+        # Filter
+        filter_frame = ttk.Frame(self)
+        filter_frame.pack(fill="x", padx=5, pady=(5, 0))
+        ttk.Label(filter_frame, text="🔍 Filter:").pack(side="left", padx=5)
+        self.filter_var = tk.StringVar()
+        ttk.Entry(filter_frame, textvariable=self.filter_var, width=40).pack(side="left", padx=5)
+        self.count_var = tk.StringVar(value="0 emails")
+        ttk.Label(filter_frame, textvariable=self.count_var).pack(side="right", padx=5)
+        self._filter_job = None
+        self.filter_var.trace_add("write", lambda *args: self._schedule_filter())
+        
+        # Mail table (virtualized: only the rows on screen are Treeview items)
+        self.model = MailTableModel()
+        self.table = VirtualMailTable(self, self.model)
+        self.table.pack(fill="both", expand=True, padx=5, pady=5)
+        
+        self.bind("<Destroy>", self._on_destroy)
+        self.after(self.POLL_INTERVAL_MS, self._poll)
+    
+    # ----- Worker plumbing -----
+    
+    def _poll(self):
+        """Run the callbacks of finished background tasks on the Tk thread"""
+        self.runner.poll()
+        self.after(self.POLL_INTERVAL_MS, self._poll)
+    
+    def _on_destroy(self, event):
+        if event.widget is self:
+            if self._batch:
+                self._batch['token'].cancel()
+            self.runner.shutdown()
+    
+    def _start_batch(self, phase, total, message):
+        """Disable the actions and show progress (total=None: indeterminate)"""
+        self._batch = {'token': CancelToken(), 'phase': phase, 'total': total or 0,
+                       'done': 0, 'errors': 0, 'results': {}}
+        self.check_btn.config(state="disabled")
+        self.process_btn.config(state="disabled")
+        self.cancel_btn.config(state="normal")
+        if total is None:
+            self.progress.config(mode="indeterminate")
+            self.progress.start(10)
+        else:
+            self.progress.config(mode="determinate", maximum=max(total, 1), value=0)
+        self.status_var.set(message)
+        return self._batch['token']
+    
+    def _end_batch(self, message):
+        self._batch = None
+        self.progress.stop()
+        self.progress.config(mode="determinate", value=0)
+        self.check_btn.config(state="normal")
+        self.process_btn.config(state="normal")
+        self.cancel_btn.config(state="disabled")
+        self.status_var.set(message)
+    
+    def cancel_batch(self):
+        """Cancel the running batch (emails already being sent still complete)"""
+        if self._batch:
+            self._batch['token'].cancel()
+            self.status_var.set("Cancelling...")
+    
+    def _set_row(self, item, department=None, status=None):
+        """Update a table row if it still exists (it may have been removed meanwhile)"""
+        fields = {}
+        if department is not None:
+            fields['department'] = department
+        if status is not None:
+            fields['status'] = status
+        if self.model.update(item, **fields) is not None:
+            self.table.schedule_refresh()
+    
+    def _refresh_count(self):
+        shown, total = len(self.model), self.model.total
+        self.count_var.set(f"{total} emails" if shown == total else f"{shown} of {total} emails")
+    
+    def _schedule_filter(self):
+        # Debounce: filtra quando l'utente smette di digitare
+        if self._filter_job is not None:
+            self.after_cancel(self._filter_job)
+        self._filter_job = self.after(150, self._apply_filter)
+    
+    def _apply_filter(self):
+        self._filter_job = None
+        self.table.set_filter(self.filter_var.get())
+        self._refresh_count()
+    
+    # ----- Check mail -----
     
     def check_mail(self):
-        """Check for new emails"""
+        """Check for new emails (IMAP fetch on a worker thread)"""
         try:
             # Verify configuration
             required = ['EMAIL', 'EMAIL_PASSWORD', 'IMAP']
             self.config_manager.validate(required)
-            
-            # Create fetcher
-            fetcher = MailFetcher(
-                self.config_manager.get('IMAP'),
-                self.config_manager.get('EMAIL'),
-                self.config_manager.get('EMAIL_PASSWORD')
-            )
-            
-            # Fetch emails
-            emails = fetcher.fetch_unread_emails()
-            
-            if not emails:
-                messagebox.showinfo("Check Mail", "No new unread emails found.")
-                return
-            
-            # Add to table
-            for msg, metadata in emails:
-                mail_id = f"{metadata['from']}-{metadata['subject']}-{metadata['date']}"
-                
-                # Avoid duplicates
-                if mail_id in self.mail_data:
-                    continue
-                
-                date_str = datetime.now().strftime('%Y-%m-%d %H:%M')
-                item_id = self.tree.insert('', 0, values=(
-                    metadata['from'][:40],
-                    metadata['subject'][:50],
-                    date_str,
-                    "",
-                    "Not processed"
-                ))
-                
-                self.mail_data[item_id] = {
-                    'message': msg,
-                    'metadata': metadata
-                }
-            
-            messagebox.showinfo("Check Mail", f"Found {len(emails)} new unread emails.")
-        
         except Exception as e:
             messagebox.showerror("Error", f"Error checking mail:\n{str(e)}")
-    
-    def _get_ticket_processor(self):
-        """Initialize TicketProcessor with direct API (lazy init)"""
-        if not self.ticket_processor:
-            groq_key = self.config_manager.get('GROQ_API_KEY', '')
-            groq_model = self.config_manager.get('GROQ_MODEL', 'llama-3.1-8b-instant')
-            ollama_url = self.config_manager.get('OLLAMA_URL', '')
-            ollama_model = self.config_manager.get('OLLAMA_MODEL', 'llama3.1')
-            
-            if groq_key:
-                # Use Groq (recommended - fast and free)
-                self.ticket_processor = TicketProcessorSimple(
-                    api_key=groq_key,
-                    provider="groq",
-                    model=groq_model
-                )
-                logger.info(f"✅ Using Groq API with model: {groq_model}")
-            elif ollama_url:
-                # Use local Ollama
-                self.ticket_processor = TicketProcessorSimple(
-                    api_key="ollama",
-                    provider="ollama",
-                    model=ollama_model,
-                    api_base=ollama_url
-                )
-                logger.info(f"✅ Using local Ollama with model: {ollama_model}")
-            else:
-                raise Exception("Configure GROQ_API_KEY (free at console.groq.com) or OLLAMA_URL")
+            return
         
-        return self.ticket_processor
+        # Create fetcher
+        fetcher = MailFetcher(
+            self.config_manager.get('IMAP'),
+            self.config_manager.get('EMAIL'),
+            self.config_manager.get('EMAIL_PASSWORD')
+        )
+        
+        token = self._start_batch('fetch', None, "📬 Checking mail...")
+        self.runner.submit(
+            self._fetch_and_store, fetcher,
+            on_done=self._on_mail_fetched,
+            on_error=self._on_fetch_error,
+            on_cancel=lambda: self._end_batch("Check mail cancelled"),
+            token=token
+        )
+    
+    def _on_fetch_error(self, error):
+        self._end_batch("Check mail failed")
+        messagebox.showerror("Error", f"Error checking mail:\n{str(error)}")
+    
+    def _fetch_and_store(self, fetcher):
+        """Worker: fetch unread emails, store the raw messages, return row summaries"""
+        received = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        summaries = []
+        for msg, metadata in fetcher.fetch_unread_emails():
+            mail_id = f"{metadata['from']}-{metadata['subject']}-{metadata['date']}"
+            self.message_store.put(mail_id, msg)
+            summaries.append({
+                'mail_id': mail_id,
+                'sender': metadata['from'],
+                'subject': metadata['subject'],
+                'date': metadata['date'],
+                'received': received,
+                'preview': metadata['body'][:200],
+                'uid': metadata.get('uid', ''),
+                'message_id': msg.get('Message-ID', ''),
+            })
+        return summaries
+    
+    def _on_mail_fetched(self, summaries):
+        """Add fetched emails to the table (duplicates are skipped)"""
+        added = self.model.add_many(summaries)
+        self.table.refresh()
+        self._refresh_count()
+        
+        if not summaries:
+            self._end_batch("No new unread emails found.")
+        else:
+            self._end_batch(f"Found {len(summaries)} new unread emails ({len(added)} added).")
+    
+    # ----- Process selected -----
     
     def process_mail(self):
-        """Process selected emails with complete LLM analysis"""
-        selected = self.tree.selection()
+        """Analyze the selected emails concurrently, confirm once, then forward"""
+        selected = [self.model.get(key) for key in self._visible_selection()]
         if not selected:
             messagebox.showinfo("Process", "Select at least one email from the table.")
             return
         
-        reparti = self.reparti_manager.get_all()
-        if not reparti:
+        if not self.reparti_manager.get_all():
             messagebox.showerror("Error", "No departments configured. Add departments before processing.")
             return
         
-        # Initialize processor and sender
-        try:
-            processor = self._get_ticket_processor()
-        except Exception as e:
-            messagebox.showerror("Error", f"Cannot initialize LLM:\n{str(e)}")
+        items = [row.key for row in selected if row.status == NOT_PROCESSED]
+        if not items:
+            messagebox.showinfo("Process", "The selected emails have already been processed.")
             return
         
-        sender = MailSender(
+        self._sender = MailSender(
             self.config_manager.get('SMTP'),
             self.config_manager.get('EMAIL'),
             self.config_manager.get('EMAIL_PASSWORD')
         )
+        # Fetched with PEEK: source messages are marked seen (and filed) once the batch has been sent
+        self._imap_actions = ImapActions(
+            self.config_manager.get('IMAP'),
+            self.config_manager.get('EMAIL'),
+            self.config_manager.get('EMAIL_PASSWORD'),
+            routed_folder=self.config_manager.get('IMAP_ROUTED_FOLDER', DEFAULT_ROUTED_FOLDER),
+            retry_folder=self.config_manager.get('IMAP_RETRY_FOLDER', DEFAULT_RETRY_FOLDER),
+            file_messages=self.config_manager.get_bool('IMAP_ACTIONS', True)
+        )
         
-        for item in selected:
-            values = list(self.tree.item(item, 'values'))
-            
-            if values[4] != "Not processed":
-                continue
-            
-            mail_info = self.mail_data.get(item)
-            if not mail_info:
-                continue
-            
-            metadata = mail_info['metadata']
-            email_msg = mail_info['message']
-            
-            try:
-                # Extract PDF attachment
-                pdf_content = read_pdf_attachment(email_msg)
-                
-                # Analyze with LLM (includes body + PDF)
-                analysis, reparto = processor.process_ticket(
-                    email_msg,
-                    metadata['subject'],
-                    metadata['body'],
-                    pdf_content,
-                    reparti
-                )
-                
-                if not analysis or not reparto:
-                    values[4] = "❌ LLM analysis error"
-                    self.tree.item(item, values=values)
-                    continue
-                
-                # Show confirmation with analysis details
-                conferma_msg = (
-                    f"Email: {metadata['subject'][:60]}...\n"
-                    f"From: {metadata['from']}\n\n"
-                    f"=== AI ANALYSIS ===\n"
-                    f"Suggested department: {reparto['nome']}\n"
-                    f"Email: {reparto['email']}\n"
-                    f"Confidence: {analysis.get('confidence', 0)}%\n\n"
-                    f"Summary: {analysis.get('summary', 'N/A')[:100]}...\n\n"
-                    f"Reasoning: {analysis.get('reasoning', 'N/A')[:150]}...\n\n"
-                    f"Send email to this department?"
-                )
-                
-                conferma = messagebox.askyesno("Confirm AI Routing", conferma_msg)
-                
-                if not conferma:
-                    values[4] = "⏸️ Cancelled by user"
-                else:
-                    # Send email with complete analysis and attachments
-                    success = sender.send_forwarded_mail(
-                        to_email=reparto['email'],
-                        original_from=metadata['from'],
-                        original_subject=metadata['subject'],
-                        original_body=metadata['body'],
-                        original_date=metadata['date'],
-                        reparto_nome=reparto['nome'],
-                        analysis_summary=analysis.get('summary'),
-                        confidence=analysis.get('confidence'),
-                        email_message=email_msg  # For PDF attachments
-                    )
-                    
-                    if success:
-                        values[3] = reparto['nome']
-                        confidence_icon = "✅" if analysis.get('confidence', 0) >= 70 else "⚠️"
-                        values[4] = f"{confidence_icon} Sent ({analysis.get('confidence')}%)"
-                    else:
-                        values[4] = "❌ Send error"
-                
-            except Exception as e:
-                values[4] = f"❌ Error: {str(e)[:30]}"
-                messagebox.showerror("Processing Error", f"Error during processing:\n{str(e)}")
-            
-            self.tree.item(item, values=values)
+        token = self._start_batch('analyze', len(items), f"🤖 Analyzing {len(items)} emails...")
+        for item in items:
+            self._set_row(item, status="⏳ Analyzing...")
+            self.runner.submit(
+                self._analyze, item, self.model.get(item),
+                on_done=partial(self._on_analyzed, item),
+                on_error=partial(self._on_item_error, item),
+                on_cancel=partial(self._on_item_cancelled, item),
+                token=token
+            )
     
-    def show_details(self):
-        """Show selected email details"""
-        item = self.tree.focus()
-        if not item:
-            messagebox.showinfo("Details", "Select an email from the table.")
+    def _load_message(self, row):
+        """Full message of a row from the message store"""
+        email_msg = self.message_store.get(row.mail_id)
+        if email_msg is None:
+            raise FileNotFoundError("message no longer in the local store")
+        return email_msg
+    
+    def _analyze(self, item, row):
+        """Worker: PDF extraction and LLM analysis of one email"""
+        snapshot = self.processor_registry.get()
+        email_msg = self._load_message(row)
+        
+        # Extract PDF attachment
+        pdf_content = read_pdf_attachment(email_msg)
+        
+        # Analyze with LLM (includes body + PDF); the department is shown as soon as it is streamed
+        return snapshot.processor.process_ticket(
+            email_msg,
+            row.subject,
+            parse_message(email_msg).body_text,
+            pdf_content,
+            snapshot.reparti,
+            on_route=lambda route, reparto: self.runner.post(self._on_routed, item, reparto)
+        )
+    
+    def _on_routed(self, item, reparto):
+        # L'analisi completa (riassunto, confidenza) arriva con _on_analyzed
+        if not self._batch['token'].cancelled and item not in self._batch['results']:
+            self._set_row(item, department=reparto['nome'], status="✍️ Summarizing...")
+    
+    def _on_analyzed(self, item, result):
+        if self._batch['token'].cancelled:
+            # Analisi senza effetti: con il batch annullato la riga torna da elaborare
+            self._on_item_cancelled(item)
+            return
+        analysis, reparto = result
+        if not analysis or not reparto:
+            self._batch['errors'] += 1
+            self._set_row(item, status="❌ LLM analysis error")
+        else:
+            self._batch['results'][item] = (analysis, reparto)
+            self._set_row(item, department=reparto['nome'],
+                          status=f"🔎 Awaiting confirmation ({analysis.get('confidence')}%)")
+        self._item_finished()
+    
+    def _on_item_error(self, item, error):
+        logger.error(f"Error processing email: {error}")
+        row = self.model.get(item)
+        if self._batch['phase'] == 'send' and self._imap_actions and row is not None:
+            self._imap_actions.fail(row.uid)
+        self._batch['errors'] += 1
+        self._set_row(item, status=f"❌ Error: {str(error)[:30]}")
+        self._item_finished()
+    
+    def _on_item_cancelled(self, item):
+        if self._batch['phase'] == 'analyze':
+            self._batch['results'].pop(item, None)
+            self._set_row(item, department="", status="Not processed")
+        else:
+            self._set_row(item, status="⏸️ Cancelled")
+        self._item_finished()
+    
+    def _item_finished(self):
+        batch = self._batch
+        batch['done'] += 1
+        self.progress.config(value=batch['done'])
+        if batch['done'] < batch['total']:
+            verb = "Analyzing" if batch['phase'] == 'analyze' else "Sending"
+            self.status_var.set(f"{verb}: {batch['done']}/{batch['total']}")
+            return
+        
+        if batch['token'].cancelled:
+            self._end_batch("Processing cancelled")
+            self._file_sent_messages()
+        elif batch['phase'] == 'analyze':
+            self._confirm_batch()
+        else:
+            sent = batch['total'] - batch['errors']
+            self._end_batch(f"✅ {sent} emails forwarded" + (f", {batch['errors']} errors" if batch['errors'] else ""))
+            self._file_sent_messages()
+    
+    def _file_sent_messages(self):
+        """Move the source messages of the batch (one IMAP command per folder)"""
+        if self._imap_actions and self._imap_actions.pending():
+            self.runner.submit(
+                self._imap_actions.flush,
+                on_error=lambda error: logger.error(f"Error filing messages on IMAP: {error}")
+            )
+    
+    def _confirm_batch(self):
+        """One confirmation for all analyzed emails, then send the confirmed ones"""
+        results = {item: r for item, r in self._batch['results'].items() if self.model.get(item) is not None}
+        errors = self._batch['errors']
+        if not results:
+            self._end_batch(f"No emails to forward ({errors} errors)")
+            return
+        
+        rows = [(self.model.get(item), analysis, reparto)
+                for item, (analysis, reparto) in results.items()]
+        confirmed = BatchConfirmDialog.ask(self, rows) or []
+        
+        for item in results:
+            if item not in confirmed:
+                self._set_row(item, department="", status="⏸️ Cancelled by user")
+        if not confirmed:
+            self._end_batch("Forwarding cancelled by user")
             return
         
-        mail_info = self.mail_data.get(item)
-        if not mail_info:
-            messagebox.showinfo("Details", "Email data not available.")
+        token = self._start_batch('send', len(confirmed), f"📤 Sending {len(confirmed)} emails...")
+        for item in confirmed:
+            analysis, reparto = results[item]
+            self._set_row(item, status="📤 Sending...")
+            self.runner.submit(
+                self._send, self.model.get(item), analysis, reparto,
+                on_done=partial(self._on_sent, item, analysis, reparto),
+                on_error=partial(self._on_item_error, item),
+                on_cancel=partial(self._on_item_cancelled, item),
+                token=token
+            )
+    
+    def _send(self, row, analysis, reparto):
+        """Worker: forward one email with its analysis and attachments"""
+        email_msg = self._load_message(row)
+        return self._sender.send_forwarded_mail(
+            to_email=reparto['email'],
+            original_from=row.sender,
+            original_subject=row.subject,
+            original_body=parse_message(email_msg).body_text,
+            original_date=row.date,
+            reparto_nome=reparto['nome'],
+            analysis_summary=analysis.get('summary'),
+            confidence=analysis.get('confidence'),
+            email_message=email_msg  # For PDF attachments
+        )
+    
+    def _on_sent(self, item, analysis, reparto, success):
+        row = self.model.get(item)
+        if self._imap_actions and row is not None:
+            if success:
+                self._imap_actions.route(row.uid, reparto['nome'])
+            else:
+                self._imap_actions.fail(row.uid)
+        if success and row is not None:
+            record_ticket(analysis, reparto['nome'], message_id=row.message_id or None,
+                          mailbox=self.config_manager.get('EMAIL'), sender=row.sender, subject=row.subject)
+        if success:
+            confidence_icon = "✅" if analysis.get('confidence', 0) >= 70 else "⚠️"
+            self._set_row(item, department=reparto['nome'],
+                          status=f"{confidence_icon} Sent ({analysis.get('confidence')}%)")
+        else:
+            self._batch['errors'] += 1
+            self._set_row(item, status="❌ Send error")
+        self._item_finished()
+    
+    def show_details(self):
+        """Show selected email details (body loaded from the message store)"""
+        item = self.table.focused()
+        row = self.model.get(item) if item else None
+        if row is None:
+            messagebox.showinfo("Details", "Select an email from the table.")
             return
         
-        metadata = mail_info['metadata']
-        values = self.tree.item(item, 'values')
+        email_msg = self.message_store.get(row.mail_id)
+        body = parse_message(email_msg).body_text if email_msg is not None else row.preview
         
         details = (
-            f"From: {metadata['from']}\n"
-            f"Subject: {metadata['subject']}\n"
-            f"Date: {metadata['date']}\n"
-            f"Department: {values[3]}\n"
-            f"Status: {values[4]}\n\n"
-            f"Body:\n{metadata['body'][:500]}..."
+            f"From: {row.sender}\n"
+            f"Subject: {row.subject}\n"
+            f"Date: {row.date}\n"
+            f"Department: {row.department}\n"
+            f"Status: {row.status}\n\n"
+            f"Body:\n{body[:500]}..."
         )
         
         messagebox.showinfo("Email Details", details)
     
+    def _visible_selection(self):
+        """Selected rows shown by the current filter (hidden rows stay selected but untouched)"""
+        return [key for key in self.table.selected if self.model.index_of(key) is not None]
+    
     def remove_selected(self):
-        """Remove selected emails from view"""
-        selected = self.tree.selection()
-        for item in selected:
-            if item in self.mail_data:
-                del self.mail_data[item]
-            self.tree.delete(item)
+        """Remove the selected visible emails from view and from the message store"""
+        keys = self._visible_selection()
+        for row in self.model.remove(keys):
+            self.message_store.delete(row.mail_id)
+        self.table.forget_rows(keys)
+        self.table.refresh()
+        self._refresh_count()
 
 
 class MailSupportGUI:
@@ -439,6 +852,9 @@ class MailSupportGUI:
         config_dir = os.path.dirname(__file__)
         self.config_manager = ConfigManager(os.path.join(config_dir, 'config_gui.json'))
         self.reparti_manager = RepartiManager(os.path.join(config_dir, 'reparti_config.json'))
+        # The table is not persisted across sessions: drop messages left by the previous one
+        self.message_store = RawMessageStore(os.path.join(config_dir, 'message_store'))
+        self.message_store.clear()
         
         # Create interface
         self.create_widgets()
@@ -454,7 +870,7 @@ class MailSupportGUI:
         reparti_frame.pack(fill="x", padx=10, pady=5)
         
         # Mail table frame
-        mail_frame = MailTableFrame(self.root, self.config_manager, self.reparti_manager)
+        mail_frame = MailTableFrame(self.root, self.config_manager, self.reparti_manager, self.message_store)
         mail_frame.pack(fill="both", expand=True, padx=10, pady=5)
 
 
@@ -4,12 +4,17 @@ import json
 import time
 import os
 from dotenv import load_dotenv
-from modules.redirect_engine import route_mail, redirect_mail
+from modules.redirect_engine import route_mail, redirect_mail, complete_route_fields, is_found
+from modules.llm_schemas import GEO_TICKET
 from modules.sql_engine import json_to_sql
-from modules.process_mail import (check_for_new_emails, 
-                                    get_email_body,
+from modules.ticket_sink import record_ticket
+from modules.process_mail import (get_email_body,
                                     read_pdf_attachment)
 from modules.azure_maps_full import get_location_details
+from modules.text_cleaner import clean_email_text
+from modules.tracing import span, trace, set_trace_attribute
+from modules.account_scheduler import AccountScheduler, job_handler, load_accounts
+from modules.work_queue import QueueWorker, RetryableError, create_work_queue
 import logging
 from logging.handlers import RotatingFileHandler
 import smtplib
@@ -26,7 +31,6 @@ try:
     email_password = Config.EMAIL_PASSWORD
     smtp_host = Config.SMTP_HOST
     AZURE_API_KEY = Config.AZURE_API_KEY
-    CHECK_INTERVAL = Config.CHECK_INTERVAL
     control_email = Config.CONTROL_EMAIL
 except ImportError:
     # Fallback to old configuration
@@ -34,7 +38,6 @@ except ImportError:
     email_password = os.getenv('EMAIL_PASSWORD')
     smtp_host = os.getenv('SMTP')
     AZURE_API_KEY = os.getenv("AZURE_API_KEY")
-    CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL', 60))
     control_email = os.getenv('CONTROL_EMAIL', email_account)
 
 if not email_account or not email_password or not AZURE_API_KEY:
@@ -42,11 +45,26 @@ if not email_account or not email_password or not AZURE_API_KEY:
     exit(1)
 
 # Initialize LLM (Groq consigliato per velocità, Ollama per locale)
-groq = ChatGroq(temperature=0, model_name="llama-3.1-8b-instant", response_format={"type": "json_object"})
-ollama = ChatOllama(model="llama3.1", temperature=0.0, format='json', stop=["<|start_header_id|>", "<|end_header_id|>", "<eot_id>", "<|reserved_special_token"])
+def build_llm(provider):
+    """LangChain chat model for a provider name (None if not configured)"""
+    if provider == 'groq' and os.getenv('GROQ_API_KEY'):
+        # Nessun retry interno: in caso di timeout/429 si passa subito al fallback
+        return ChatGroq(temperature=0, model_name=os.getenv('GROQ_MODEL', "llama-3.1-8b-instant"),
+                        response_format={"type": "json_object"},
+                        timeout=float(os.getenv('LLM_TIMEOUT', 30)), max_retries=0)
+    if provider == 'ollama':
+        # Decodifica vincolata allo schema della risposta
+        return ChatOllama(model=os.getenv('OLLAMA_MODEL', "llama3.1"), temperature=0.0, format=GEO_TICKET.json_schema(),
+                          stop=["<|start_header_id|>", "<|end_header_id|>", "<eot_id>", "<|reserved_special_token"])
+    return None
 
-# Usa Groq come default (più veloce)
-llm = groq
+# Groq di default (più veloce), Ollama come fallback
+LLM_PROVIDER_ORDER = [p.strip().lower() for p in os.getenv('LLM_PROVIDER_ORDER', 'groq,ollama').split(',') if p.strip()]
+llms = [m for m in (build_llm(p) for p in LLM_PROVIDER_ORDER) if m is not None]
+if not llms:
+    print("No LLM provider configured (set GROQ_API_KEY or LLM_PROVIDER_ORDER=ollama).")
+    exit(1)
+llm = llms[0].with_fallbacks(llms[1:]) if len(llms) > 1 else llms[0]
 
 # Setup logging with rotation
 os.makedirs('logs', exist_ok=True)
@@ -69,140 +87,227 @@ except ImportError:
 # Track processed emails to avoid duplicates
 processed_emails = set()
 
-def validate_llm_response(response_str):
-    """Validate LLM JSON response structure"""
-    try:
-        response_json = json.loads(response_str)
-        required_fields = ['address', 'problem', 'equipment', 'confidence']
-        
-        for field in required_fields:
-            if field not in response_json:
-                logger.error(f"Missing required field: {field}")
-                return None
-        
-        # Validate confidence is a number between 0-100
-        confidence = response_json.get('confidence')
-        if not isinstance(confidence, (int, float)) or not (0 <= confidence <= 100):
-            logger.error(f"Invalid confidence value: {confidence}")
-            return None
-        
-        return response_json
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON parsing error: {e}")
+# Accounts and folders to poll (MAIL_ACCOUNTS, or the single EMAIL/IMAP account).
+# Each folder keeps its processing state (fetched -> analyzed -> forwarded ->
+# acknowledged) across restarts, so an interrupted run neither loses nor
+# re-forwards emails; flags and moves are committed once per poll.
+mail_accounts = load_accounts(lambda key, default=None: os.getenv(key, default))
+
+# Scale-out: with WORK_QUEUE set, fetchers queue the emails and any number of
+# worker processes (WORKER_ROLE=process) claim them; SHARD_INDEX/SHARD_COUNT
+# split the folders among several fetchers. Without it everything runs here.
+work_queue_url = os.getenv('WORK_QUEUE')
+worker_role = os.getenv('WORKER_ROLE', 'all').lower() if work_queue_url else 'all'
+if worker_role not in ('all', 'fetch', 'process'):
+    print(f"Invalid WORKER_ROLE '{worker_role}' (use all, fetch or process).")
+    exit(1)
+if worker_role != 'process' and not mail_accounts:
+    print("No mail account configured (set EMAIL/IMAP or MAIL_ACCOUNTS).")
+    exit(1)
+
+def validate_llm_response(response_str, body=None):
+    """
+    Parse and validate the LLM JSON response against the geo_ticket schema.
+
+    If some fields are missing and the email body is given, only those
+    fields are requested again.
+    """
+    response_json, missing = GEO_TICKET.parse(response_str)
+    if missing and body is not None:
+        try:
+            extra, _ = GEO_TICKET.parse(complete_route_fields(body, response_str, missing, llm))
+            response_json.update({k: v for k, v in extra.items() if k in missing})
+            response_json, missing = GEO_TICKET.validate(response_json)
+        except Exception as e:
+            logger.error(f"Retry of missing fields failed: {e}")
+
+    if missing:
+        logger.error(f"Missing required fields: {', '.join(missing)}")
         return None
+    return response_json
 
-logger.info("🚀 Main loop started")
-logger.info(f"📧 Email account: {email_account}")
-logger.info(f"⏱️ Check interval: {CHECK_INTERVAL} seconds")
+logger.info(f"🚀 Main loop started (role: {worker_role})")
+for account in (mail_accounts if worker_role != 'process' else []):
+    logger.info(f"📧 Email account: {account.name} ({', '.join(account.folders)}), "
+                f"check interval: {account.poll_interval:g} seconds")
 logger.info(f"📝 Test mode: {os.getenv('USE_TEST_RECIPIENTS', 'false')}")
 
 
+def process_email(mailbox, email_message, retry_transient=False):
+    """
+    Route one email of a mailbox: LLM analysis, geocoding, SQL, forwarding.
 
-while True:
+    With retry_transient, an unavailable LLM raises RetryableError (the
+    queued job is retried) instead of sending the email to control.
+    """
+    # Generate a unique email ID to avoid duplicate processing
+    email_id = f"{email_message.get('From', '')}-{email_message.get('Subject', '')}-{email_message.get('Date', '')}"
+    
+    if email_id in processed_emails:
+        logger.info(f"⏭️ Skipping duplicate email: {email_id[:50]}...")
+        # Altrimenti resterebbe 'fetched' e verrebbe riscaricata a ogni controllo
+        mailbox.fail(email_message, "duplicate of an email already forwarded")
+        return
+    
     try:
-        logger.info("⏳ Waiting for next check...")
-        email_messages = check_for_new_emails(email_account)
-        
-        if not email_messages:
-            logger.info("✅ No new emails")
-        
-        for email_message in email_messages:
-            # Generate a unique email ID to avoid duplicate processing
-            email_id = f"{email_message.get('From', '')}-{email_message.get('Subject', '')}-{email_message.get('Date', '')}"
-            
-            if email_id in processed_emails:
-                logger.info(f"⏭️ Skipping duplicate email: {email_id[:50]}...")
-                continue
-            
-            try:
-                logger.info("📩 New email found, starting processing...")
-
-                # Extract email body
+        with trace(email_id):
+            set_trace_attribute('account', mailbox.key)
+            logger.info(f"📩 New email found in {mailbox.key}, starting processing...")
+
+            # Extract email body
+            with span('body'):
                 body = get_email_body(email_message)
-                logger.info("✅ Email body extracted")
+            logger.info("✅ Email body extracted")
 
-                # Extract PDF content
+            # Extract PDF content
+            with span('pdf'):
                 pdf_content = read_pdf_attachment(email_message)
-                logger.info("✅ PDF content extracted")
+            logger.info("✅ PDF content extracted")
 
-                # Combine PDF content with email body
-                content = body + pdf_content
+            # Combine PDF content with email body (without tracking links, quotes and footers)
+            with span('clean'):
+                cleaned = clean_email_text(body)
+            logger.info(f"🧹 Preprocessing saved {cleaned.tokens_saved} tokens "
+                        f"({cleaned.original_tokens} -> {cleaned.cleaned_tokens})")
+            content = cleaned.text + pdf_content
 
-                # Route mail with LLM
-                llm_response, run_id = route_mail(content, llm)
-                logger.info(f"🤖 LLM response generated (run_id: {run_id})")
+            # Route mail with LLM
+            with span('llm'):
+                try:
+                    # In coda un'email senza quota torna da riprovare invece di andare al controllo
+                    llm_response, run_id = route_mail(content, llm, raise_on_rate_limit=retry_transient)
+                except Exception as e:
+                    raise RetryableError(f"LLM unavailable: {e}") from e
+            set_trace_attribute('run_id', str(run_id))
+            logger.info(f"🤖 LLM response generated (run_id: {run_id})")
 
-                # Validate JSON response
-                response_json = validate_llm_response(llm_response)
+            # Validate JSON response
+            with span('validate') as validate_span:
+                response_json = validate_llm_response(llm_response, content)
                 if not response_json:
-                    logger.error("❌ Invalid LLM response")
+                    validate_span.error = 'invalid_json'
+            if not response_json:
+                logger.error("❌ Invalid LLM response")
+                with span('smtp'):
                     redirect_mail(None, body, email_message, "Invalid JSON response", None)
-                    if metrics:
-                        metrics.record_failure()
-                    continue
-
-                # Track low confidence
-                if response_json.get('confidence', 0) < 50:
-                    logger.warning(f"⚠️ Low confidence: {response_json.get('confidence')}")
-                    if metrics:
-                        metrics.record_low_confidence()
-
-                # Extract address and geocode
-                address_found = response_json.get('address')
-                geocode_result = None
-                if address_found:
+                mailbox.fail(email_message, "invalid LLM response")
+                if metrics:
+                    metrics.record_failure()
+                return
+
+            mailbox.analyzed(email_message)
+
+            # Track low confidence
+            if response_json.get('confidence', 0) < 50:
+                logger.warning(f"⚠️ Low confidence: {response_json.get('confidence')}")
+                if metrics:
+                    metrics.record_low_confidence()
+
+            # Extract address and geocode
+            address_found = response_json.get('address')
+            geocode_result = None
+            if is_found(address_found):
+                with span('geocode'):
                     geocode_result = get_location_details(address_found, AZURE_API_KEY)
-                    logger.info(f"📍 Geocode result: {geocode_result}")
-                else:
-                    logger.warning("⚠️ No address found in response")
+                logger.info(f"📍 Geocode result: {geocode_result}")
+            else:
+                logger.warning("⚠️ No address found in response")
 
-                # Generate SQL
+            # Generate SQL
+            with span('sql'):
                 sql_response = json_to_sql(response_json)
-                logger.info(f"💾 SQL entry generated")
-
-                # Redirect email
-                redirect_mail(geocode_result, body, email_message, sql_response, response_json)
-                logger.info("✅ Email redirected successfully")
-                
-                # Mark as processed
-                processed_emails.add(email_id)
-                if metrics:
-                    metrics.record_success()
-                
-            except Exception as e:
-                logger.error(f"❌ Error processing email: {e}", exc_info=True)
-                if metrics:
-                    metrics.record_failure()
-                
-                try:
-                    redirect_mail(None, get_email_body(email_message), email_message, f"Processing error: {str(e)}", None)
-                except Exception as error:
-                    logger.error(f"❌ Failed to redirect error email: {error}")
-                    # Emergency fallback
-                    with smtplib.SMTP_SSL(smtp_host, 465) as smtp:
-                        smtp.login(email_account, email_password)
-                        error_msg = MIMEMultipart()
-                        error_msg['Subject'] = "Critical Error in Email Processing"
-                        error_msg['From'] = email_account
-                        error_msg['To'] = control_email
-                        error_text = f"Critical error occurred: {str(e)}\n\nFailed to redirect: {str(error)}"
-                        error_msg.attach(MIMEText(error_text))
-                        smtp.send_message(error_msg, to_addrs=[control_email])
-
-        # Log metrics periodically (every 10 checks)
-        if metrics and metrics.total_processed % 10 == 0 and metrics.total_processed > 0:
-            metrics.log_stats(logger)
-            metrics.save()
-
-        logger.info(f"💤 Sleeping for {CHECK_INTERVAL} seconds...")
-        time.sleep(CHECK_INTERVAL)
+            logger.info(f"💾 SQL entry generated")
+
+            # Redirect email
+            # Le email inoltrate al controllo finiscono nella cartella di revisione
+            with span('smtp'):
+                department = redirect_mail(geocode_result, body, email_message, sql_response, response_json)
+            logger.info("✅ Email redirected successfully")
+            mailbox.route(email_message, department)
+            # Scritto in batch dal thread del sink, non rallenta la pipeline
+            record_ticket(response_json, department, message_id=email_message.get('Message-ID'),
+                          mailbox=mailbox.key, sender=email_message.get('From'),
+                          subject=email_message.get('Subject'))
+
+            # Mark as processed
+            processed_emails.add(email_id)
+            if metrics:
+                metrics.record_success()
         
-    except KeyboardInterrupt:
-        logger.info("⛔ Manual interruption")
-        if metrics:
-            metrics.log_stats(logger)
-            metrics.save()
-        break
     except Exception as e:
-        logger.error(f"❌ Error in main loop: {e}", exc_info=True)
-        time.sleep(10)  # Sleep a bit before retrying
+        if retry_transient and isinstance(e, RetryableError):
+            logger.warning(f"⚠️ {e}, email left in the queue for a retry")
+            raise
+        logger.error(f"❌ Error processing email: {e}", exc_info=True)
+        if metrics:
+            metrics.record_failure()
+        try:
+            mailbox.fail(email_message, e)
+        except Exception as error:
+            logger.error(f"❌ Failed to record email failure: {error}")
+        
+        try:
+            redirect_mail(None, get_email_body(email_message), email_message, f"Processing error: {str(e)}", None)
+        except Exception as error:
+            logger.error(f"❌ Failed to redirect error email: {error}")
+            # Emergency fallback
+            with smtplib.SMTP_SSL(smtp_host, 465) as smtp:
+                smtp.login(email_account, email_password)
+                error_msg = MIMEMultipart()
+                error_msg['Subject'] = "Critical Error in Email Processing"
+                error_msg['From'] = email_account
+                error_msg['To'] = control_email
+                error_text = f"Critical error occurred: {str(e)}\n\nFailed to redirect: {str(error)}"
+                error_msg.attach(MIMEText(error_text))
+                smtp.send_message(error_msg, to_addrs=[control_email])
+
+
+def process_batch(mailbox, email_messages):
+    """Scheduler handler: process the emails fetched by one poll of a folder"""
+    for email_message in email_messages:
+        process_email(mailbox, email_message)
+    maybe_log_metrics()
+
+
+def process_queued(mailbox, email_message):
+    """Queue worker handler: process one email claimed from the work queue"""
+    process_email(mailbox, email_message, retry_transient=True)
+    maybe_log_metrics()
+
+
+def maybe_log_metrics():
+    # Log metrics periodically (every 10 processed emails)
+    if metrics and metrics.total_processed % 10 == 0 and metrics.total_processed > 0:
+        metrics.log_stats(logger)
+        metrics.save()
+
+
+work_queue = create_work_queue(work_queue_url) if work_queue_url else None
+scheduler = None
+worker = None
+if worker_role in ('all', 'fetch'):
+    shard = (int(os.getenv('SHARD_INDEX', '0')), max(1, int(os.getenv('SHARD_COUNT', '1'))))
+    scheduler = AccountScheduler(mail_accounts, process_batch,
+                                 state_db=os.getenv('MESSAGE_STATE_DB', 'message_state.db'),
+                                 queue=work_queue, shard=shard)
+    scheduler.start()
+if work_queue is not None and worker_role in ('all', 'process'):
+    worker = QueueWorker(work_queue, job_handler(process_queued),
+                         threads=int(os.getenv('WORKER_THREADS', '2')))
+    worker.start()
+
+try:
+    while True:
+        time.sleep(1)
+except KeyboardInterrupt:
+    logger.info("⛔ Manual interruption")
+    # Prima i worker, così il fetcher raccoglie gli ultimi risultati
+    if worker:
+        worker.stop()
+    if scheduler:
+        scheduler.stop()
+    if work_queue is not None:
+        work_queue.close()
+    if metrics:
+        metrics.log_stats(logger)
+        metrics.save()
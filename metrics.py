@@ -1,7 +1,18 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 import json
 import os
+import threading
+
+try:
+    from modules.rate_limiter import get_rate_limit_stats
+except ImportError:
+    get_rate_limit_stats = None
+
+try:
+    from modules.tracing import tracer
+except ImportError:
+    tracer = None
 
 @dataclass
 class ProcessingMetrics:
@@ -10,21 +21,26 @@ class ProcessingMetrics:
     failed: int = 0
     low_confidence: int = 0
     start_time: datetime = None
+    # Le mailbox vengono elaborate in parallelo dallo scheduler
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
     
     def __post_init__(self):
         if self.start_time is None:
             self.start_time = datetime.now()
     
     def record_success(self):
-        self.total_processed += 1
-        self.successful += 1
+        with self._lock:
+            self.total_processed += 1
+            self.successful += 1
     
     def record_failure(self):
-        self.total_processed += 1
-        self.failed += 1
+        with self._lock:
+            self.total_processed += 1
+            self.failed += 1
     
     def record_low_confidence(self):
-        self.low_confidence += 1
+        with self._lock:
+            self.low_confidence += 1
     
     def get_stats(self):
         uptime = (datetime.now() - self.start_time).total_seconds() if self.start_time else 0
@@ -35,16 +51,28 @@ class ProcessingMetrics:
             'low_confidence': self.low_confidence,
             'success_rate': round(self.successful / self.total_processed * 100, 2) if self.total_processed > 0 else 0,
             'uptime_hours': round(uptime / 3600, 2),
-            'emails_per_hour': round(self.total_processed / (uptime / 3600), 2) if uptime > 0 else 0
+            'emails_per_hour': round(self.total_processed / (uptime / 3600), 2) if uptime > 0 else 0,
+            'rate_limits': get_rate_limit_stats() if get_rate_limit_stats else {},
+            'stages': tracer.stats() if tracer else {}
         }
     
     def save(self, filepath='logs/metrics.json'):
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
         with open(filepath, 'w') as f:
             json.dump(self.get_stats(), f, indent=2)
+        if tracer:
+            # Per il textfile collector di node_exporter
+            with open(os.path.splitext(filepath)[0] + '.prom', 'w') as f:
+                f.write(tracer.render_prometheus())
     
     def log_stats(self, logger):
         stats = self.get_stats()
         logger.info(f"📊 Stats: Processed={stats['total']}, Success={stats['successful']}, "
                    f"Failed={stats['failed']}, Success Rate={stats['success_rate']}%, "
                    f"Uptime={stats['uptime_hours']}h, Rate={stats['emails_per_hour']}/h")
+        for name, usage in stats['rate_limits'].items():
+            logger.info(f"🚦 {name}: {usage['requests_available']}/{usage['requests_capacity']} requests available, "
+                       f"waited {usage['waited']}x ({usage['wait_seconds']}s), throttled {usage['throttled']}x")
+        for stage, timing in stats['stages'].items():
+            logger.info(f"⏱️ {stage}: n={timing['count']}, p50={timing['p50_ms']}ms, "
+                       f"p95={timing['p95_ms']}ms, p99={timing['p99_ms']}ms, errors={timing['errors']}")
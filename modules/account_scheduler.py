@@ -0,0 +1,512 @@
+"""
+Scheduler of several IMAP accounts and folders in one process.
+
+Each account has its own credentials, poll interval and pool of logged-in
+IMAP connections, and each of its folders is polled on its own schedule
+with its own processing state. One scheduler thread hands due polls to a
+shared worker pool, earliest due first and never more than max_connections
+at a time per account. A poll fetches at most batch_size messages: one
+that fills its batch is due again immediately, but queues behind the polls
+already waiting, so a busy mailbox cannot starve the others.
+
+With a shared WorkQueue the scheduler only fetches: messages are queued
+for worker processes (see work_queue.QueueWorker and JobMailbox) and the
+results they report are applied to the source messages on the next poll.
+Mailboxes can be sharded across instances so each is fetched by one.
+"""
+import email
+import imaplib
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from modules.imap_actions import (DEFAULT_RETRY_FOLDER, DEFAULT_REVIEW_FOLDER, DEFAULT_ROUTED_FOLDER, UID_ATTR,
+                                  ImapActions, get_uid)
+from modules.mail_fetcher import fetch_unseen
+from modules.message_state import ANALYZED, FAILED, FORWARDED, QUEUED, MessageStateStore
+from modules.prom_metrics import ACCOUNT_FETCHED, ACCOUNT_HANDLED, ACCOUNT_POLL_ERRORS, ACCOUNT_POLL_LATENCY
+from modules.raw_message_store import message_bytes
+from modules.timeseries import get_timeseries
+from modules.tracing import span
+from modules.work_queue import DONE, Job, WorkQueue
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 60.0
+DEFAULT_MAX_CONNECTIONS = 2
+DEFAULT_BATCH_SIZE = 50
+# Secondi di inattività dopo cui una connessione del pool viene verificata con NOOP
+IDLE_CHECK_AFTER = 60.0
+
+
+@dataclass
+class MailAccount:
+    """IMAP account polled by the scheduler"""
+    name: str
+    imap_host: str
+    user: str
+    password: str = field(repr=False)
+    folders: List[str] = field(default_factory=lambda: ['INBOX'])
+    poll_interval: float = DEFAULT_POLL_INTERVAL
+    max_connections: int = DEFAULT_MAX_CONNECTIONS
+    batch_size: int = DEFAULT_BATCH_SIZE
+    routed_folder: str = DEFAULT_ROUTED_FOLDER
+    retry_folder: str = DEFAULT_RETRY_FOLDER
+    review_folder: str = DEFAULT_REVIEW_FOLDER
+    file_messages: bool = True
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'MailAccount':
+        """Account from a MAIL_ACCOUNTS entry ('password_env' reads the password from the environment)"""
+        password = data.get('password') or os.getenv(data.get('password_env', ''), '')
+        return cls(
+            name=data.get('name') or data['email'],
+            imap_host=data['imap'],
+            user=data['email'],
+            password=password,
+            folders=list(data.get('folders') or ['INBOX']),
+            poll_interval=float(data.get('poll_interval', DEFAULT_POLL_INTERVAL)),
+            max_connections=max(1, int(data.get('max_connections', DEFAULT_MAX_CONNECTIONS))),
+            batch_size=max(1, int(data.get('batch_size', DEFAULT_BATCH_SIZE))),
+            routed_folder=data.get('routed_folder', DEFAULT_ROUTED_FOLDER),
+            retry_folder=data.get('retry_folder', DEFAULT_RETRY_FOLDER),
+            review_folder=data.get('review_folder', DEFAULT_REVIEW_FOLDER),
+            file_messages=_flag(data.get('file_messages', True)),
+        )
+
+
+def _flag(value) -> bool:
+    return value if isinstance(value, bool) else str(value).lower() == 'true'
+
+
+def load_accounts(get: Callable[..., Any]) -> List[MailAccount]:
+    """
+    Accounts to poll.
+
+    MAIL_ACCOUNTS is a JSON list, or the path of a JSON file with the list,
+    of {name, email, imap, password | password_env, folders, poll_interval,
+    max_connections, batch_size, routed_folder, retry_folder, review_folder,
+    file_messages, enabled}. Without it, the single EMAIL/IMAP account of the configuration
+    is used, with its folders from IMAP_FOLDERS (comma separated).
+
+    Args:
+        get: Configuration getter (key, default)
+    """
+    defaults = {
+        'poll_interval': get('CHECK_INTERVAL', DEFAULT_POLL_INTERVAL),
+        'routed_folder': get('IMAP_ROUTED_FOLDER', DEFAULT_ROUTED_FOLDER),
+        'retry_folder': get('IMAP_RETRY_FOLDER', DEFAULT_RETRY_FOLDER),
+        'review_folder': get('IMAP_REVIEW_FOLDER', DEFAULT_REVIEW_FOLDER),
+        'file_messages': _flag(get('IMAP_ACTIONS', True)),
+    }
+    raw = get('MAIL_ACCOUNTS')
+    if raw:
+        if isinstance(raw, str):
+            raw = raw.strip()
+            if raw.startswith('['):
+                raw = json.loads(raw)
+            else:
+                with open(raw, encoding='utf-8') as f:
+                    raw = json.load(f)
+        accounts = [MailAccount.from_dict({**defaults, **entry}) for entry in raw if entry.get('enabled', True)]
+    elif get('EMAIL'):
+        folders = [f.strip() for f in str(get('IMAP_FOLDERS', 'INBOX')).split(',') if f.strip()]
+        accounts = [MailAccount.from_dict({**defaults, 'email': get('EMAIL'), 'imap': get('IMAP'),
+                                           'password': get('EMAIL_PASSWORD'), 'folders': folders})]
+    else:
+        accounts = []
+
+    names = [a.name for a in accounts]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate account names: {', '.join(duplicates)}")
+    return accounts
+
+
+class ImapConnectionPool:
+    """Logged-in IMAP connections of one account, reused across polls"""
+
+    def __init__(self, account: MailAccount):
+        self.account = account
+        self.opened = 0
+        self._idle: List[Tuple[imaplib.IMAP4, float]] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(account.max_connections)
+
+    def _open(self) -> imaplib.IMAP4:
+        mail = imaplib.IMAP4_SSL(self.account.imap_host)
+        try:
+            mail.login(self.account.user, self.account.password)
+        except Exception:
+            self._discard(mail)
+            raise
+        self.opened += 1
+        return mail
+
+    @staticmethod
+    def _discard(mail: imaplib.IMAP4) -> None:
+        try:
+            mail.logout()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """A logged-in connection (blocks while max_connections are in use)"""
+        with self._slots:
+            mail, last_used = None, 0.0
+            with self._lock:
+                if self._idle:
+                    mail, last_used = self._idle.pop()
+            if mail is not None and time.monotonic() - last_used > IDLE_CHECK_AFTER:
+                try:
+                    mail.noop()
+                except Exception:
+                    # Il server ha chiuso la connessione inattiva
+                    self._discard(mail)
+                    mail = None
+            if mail is None:
+                mail = self._open()
+            try:
+                yield mail
+            except BaseException:
+                # Stato della connessione incerto dopo un errore: non torna nel pool
+                self._discard(mail)
+                raise
+            with self._lock:
+                self._idle.append((mail, time.monotonic()))
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for mail, _ in idle:
+            self._discard(mail)
+
+
+class Mailbox:
+    """One folder of an account: its processing state and pending IMAP actions"""
+
+    def __init__(self, account: MailAccount, folder: str, state_db: str,
+                 pool: Optional[ImapConnectionPool] = None):
+        """
+        Args:
+            account: Account of the folder
+            folder: Folder to poll
+            state_db: SQLite file of the processing state
+            pool: Connections of the account, also used to commit IMAP actions
+        """
+        self.account = account
+        self.folder = folder
+        self.key = f"{account.name}/{folder}"
+        self.state = MessageStateStore(state_db, mailbox=self.key)
+        self.actions = ImapActions(account.imap_host, account.user, account.password,
+                                   mailbox=folder,
+                                   routed_folder=account.routed_folder,
+                                   retry_folder=account.retry_folder,
+                                   review_folder=account.review_folder,
+                                   file_messages=account.file_messages,
+                                   on_acknowledged=self.state.acknowledge,
+                                   connection=pool.connection if pool is not None else None)
+        self.next_due = 0.0
+        self.polls = 0
+        self.fetched = 0
+        self.errors = 0
+        self.last_poll: Optional[float] = None
+        self.last_duration: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    # ----- Transizioni dei messaggi (chiamate dall'handler) -----
+
+    def analyzed(self, message) -> None:
+        self.state.set(get_uid(message), ANALYZED)
+
+    def route(self, message, department: str) -> None:
+        """Record a forwarded message and queue its flags/move"""
+        self._route_uid(get_uid(message), department)
+
+    def fail(self, message, error) -> None:
+        """Record a failed message and queue its move to the retry folder"""
+        self._fail_uid(get_uid(message), error)
+
+    def _route_uid(self, uid, department: str) -> None:
+        self.state.set(uid, FORWARDED, department=department)
+        self.actions.route(uid, department)
+        ACCOUNT_HANDLED.inc(account=self.account.name, result='routed')
+
+    def _fail_uid(self, uid, error) -> None:
+        self.state.set(uid, FAILED, error=str(error)[:500])
+        self.actions.fail(uid)
+        ACCOUNT_HANDLED.inc(account=self.account.name, result='failed')
+
+    # ----- Coda condivisa -----
+
+    def enqueue(self, queue: WorkQueue, messages: list) -> int:
+        """
+        Hand fetched messages to the work queue instead of processing them here.
+
+        Returns:
+            Jobs added (messages already queued are skipped)
+        """
+        added = 0
+        for message in messages:
+            uid = get_uid(message)
+            # Chiave stabile: lo stesso messaggio non viene mai accodato due volte
+            added += queue.put(f"{self.key}/{self.state.uidvalidity}/{uid}", self.key, message_bytes(message))
+            self.state.set(uid, QUEUED)
+        return added
+
+    def collect(self, queue: WorkQueue) -> int:
+        """
+        Apply the outcome of the jobs the workers finished: forwarded messages
+        are routed, failed or dead ones go to the retry folder.
+
+        Returns:
+            Jobs collected
+        """
+        jobs = queue.collect(self.key)
+        for job in jobs:
+            uidvalidity, uid = job.key.rsplit('/', 2)[1:]
+            if int(uidvalidity) != self.state.uidvalidity:
+                continue
+            outcome = json.loads(job.result or '{}') if job.state == DONE else {'error': job.error}
+            try:
+                if 'department' in outcome:
+                    self._route_uid(uid, outcome['department'])
+                else:
+                    self._fail_uid(uid, outcome.get('error') or 'no outcome reported')
+            except Exception as e:
+                logger.error(f"Error applying result of job {job.key}: {e}")
+        return len(jobs)
+
+    def commit(self) -> Dict[str, int]:
+        """
+        Commit the queued IMAP actions in one batch, plus those of messages an
+        interrupted run forwarded or failed without acknowledging.
+        """
+        for uid, state, department in self.state.unacknowledged():
+            if state == FORWARDED:
+                self.actions.route(uid, department)
+            else:
+                self.actions.fail(uid)
+        self.actions.uidvalidity = self.state.uidvalidity
+        if not self.actions.pending():
+            return {}
+        with span('imap', account=self.account.name):
+            return self.actions.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'account': self.account.name,
+            'folder': self.folder,
+            'polls': self.polls,
+            'fetched': self.fetched,
+            'errors': self.errors,
+            'last_poll': self.last_poll,
+            'last_duration_s': round(self.last_duration, 3) if self.last_duration is not None else None,
+            'last_error': self.last_error,
+            'states': self.state.counts(),
+        }
+
+
+class AccountScheduler:
+    """Polls the folders of several accounts concurrently"""
+
+    def __init__(
+        self,
+        accounts: List[MailAccount],
+        handler: Callable[[Mailbox, list], None],
+        state_db: str = 'message_state.db',
+        max_workers: Optional[int] = None,
+        queue: Optional[WorkQueue] = None,
+        shard: Tuple[int, int] = (0, 1)
+    ):
+        """
+        Args:
+            accounts: Accounts to poll
+            handler: Called on a worker thread with (mailbox, messages) for each
+                non-empty poll; it reports each message with mailbox.analyzed,
+                mailbox.route or mailbox.fail (unused with a queue)
+            state_db: SQLite file of the per-folder processing state
+            max_workers: Concurrent polls overall (default: sum of max_connections, at most 32)
+            queue: If set, fetched messages are queued for worker processes
+            shard: (index, count): poll only the folders assigned to this instance
+        """
+        self.handler = handler
+        self.queue = queue
+        self.accounts = accounts
+        self.pools = {a.name: ImapConnectionPool(a) for a in accounts}
+        index, count = shard
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index} of {count} (index must be in 0..count-1)")
+        # Assegnazione stabile tra le istanze: ogni cartella ha un solo fetcher
+        self.mailboxes = [Mailbox(a, folder, state_db, pool=self.pools[a.name])
+                          for a in accounts for folder in a.folders
+                          if zlib.crc32(f"{a.name}/{folder}".encode('utf-8')) % count == index]
+        workers = max_workers or min(32, sum(a.max_connections for a in accounts)) or 1
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mailbox')
+        self.timeseries = get_timeseries()
+        self._cond = threading.Condition()
+        self._waiting = list(self.mailboxes)  # mailbox senza un poll in corso
+        self._in_flight: Dict[str, int] = defaultdict(int)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ----- Ciclo -----
+
+    def _next(self, now: float) -> Tuple[Optional[Mailbox], Optional[float]]:
+        """Earliest due mailbox whose account has a free connection, or seconds to wait"""
+        free = [m for m in self._waiting
+                if self._in_flight[m.account.name] < m.account.max_connections]
+        if not free:
+            return None, None
+        mailbox = min(free, key=lambda m: m.next_due)
+        if mailbox.next_due <= now:
+            return mailbox, 0.0
+        return None, mailbox.next_due - now
+
+    def _run(self) -> None:
+        with self._cond:
+            while not self._stop.is_set():
+                mailbox, wait = self._next(time.monotonic())
+                if mailbox is None:
+                    # Senza timeout si attende la fine di un poll (notify)
+                    self._cond.wait(wait)
+                    continue
+                self._waiting.remove(mailbox)
+                self._in_flight[mailbox.account.name] += 1
+                self._executor.submit(self._poll, mailbox)
+
+    def _poll(self, mailbox: Mailbox) -> None:
+        account = mailbox.account
+        start = time.monotonic()
+        full = False
+        try:
+            with self.pools[account.name].connection() as mail:
+                with span('fetch', account=account.name, folder=mailbox.folder):
+                    messages = fetch_unseen(mail, mailbox.folder, mailbox.state, limit=account.batch_size)
+            mailbox.fetched += len(messages)
+            if messages:
+                ACCOUNT_FETCHED.inc(len(messages), account=account.name, folder=mailbox.folder)
+                self.timeseries.increment('account_emails_fetched', len(messages), account=account.name)
+                full = len(messages) >= account.batch_size
+                if self.queue is not None:
+                    mailbox.enqueue(self.queue, messages)
+                else:
+                    # La connessione è già tornata nel pool: l'elaborazione può essere lenta
+                    self.handler(mailbox, messages)
+            if self.queue is not None:
+                mailbox.collect(self.queue)
+            mailbox.commit()
+            mailbox.last_error = None
+        except Exception as e:
+            mailbox.errors += 1
+            mailbox.last_error = f"{type(e).__name__}: {e}"
+            ACCOUNT_POLL_ERRORS.inc(account=account.name)
+            logger.error(f"❌ Error polling {mailbox.key}: {e}", exc_info=True)
+        finally:
+            end = time.monotonic()
+            mailbox.polls += 1
+            mailbox.last_poll = time.time()
+            mailbox.last_duration = end - start
+            ACCOUNT_POLL_LATENCY.observe(end - start, account=account.name)
+            with self._cond:
+                mailbox.next_due = end if full else end + account.poll_interval
+                self._in_flight[account.name] -= 1
+                self._waiting.append(mailbox)
+                self._cond.notify()
+
+    # ----- Controllo -----
+
+    def start(self) -> None:
+        """Start polling in the background"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="account-scheduler", daemon=True)
+            self._thread.start()
+            logger.info(f"📬 Polling {len(self.mailboxes)} folders of {len(self.accounts)} accounts")
+
+    def run_forever(self) -> None:
+        """Start and block until stop() (or KeyboardInterrupt)"""
+        self.start()
+        while not self._stop.wait(1.0):
+            pass
+
+    def stop(self) -> None:
+        """Stop scheduling, wait for running polls and commit their IMAP actions"""
+        with self._cond:
+            self._stop.set()
+            self._cond.notify_all()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        for mailbox in self.mailboxes:
+            try:
+                if self.queue is not None:
+                    mailbox.collect(self.queue)
+                mailbox.commit()
+            except Exception as e:
+                logger.error(f"Error committing IMAP actions of {mailbox.key}: {e}")
+            mailbox.state.close()
+        for pool in self.pools.values():
+            pool.close()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per-account throughput: folders with their counters, plus totals"""
+        result: Dict[str, Dict[str, Any]] = {}
+        for mailbox in self.mailboxes:
+            entry = result.setdefault(mailbox.account.name, {
+                'connections_opened': self.pools[mailbox.account.name].opened,
+                'in_flight': self._in_flight[mailbox.account.name],
+                'fetched': 0, 'errors': 0, 'folders': {}})
+            folder = mailbox.stats()
+            entry['folders'][mailbox.folder] = folder
+            entry['fetched'] += folder['fetched']
+            entry['errors'] += folder['errors']
+        return result
+
+
+class JobMailbox:
+    """
+    Mailbox stand-in for a queued message processed by a worker: what the
+    pipeline reports (route or fail) becomes the job result, applied to the
+    source message by the fetcher that owns the mailbox.
+    """
+
+    def __init__(self, job: Job):
+        self.job = job
+        self.key = job.mailbox
+        self.outcome: Optional[Dict[str, str]] = None
+
+    def analyzed(self, message) -> None:
+        pass
+
+    def route(self, message, department: str) -> None:
+        self.outcome = {'department': department}
+
+    def fail(self, message, error) -> None:
+        self.outcome = {'error': str(error)[:500]}
+
+
+def job_handler(process: Callable[[Any, Any], None]) -> Callable[[Job], str]:
+    """
+    QueueWorker handler running process(mailbox, message) on a queued message.
+
+    The pipeline reports the outcome with mailbox.route or mailbox.fail; to
+    have the job retried instead (up to the queue's max attempts, then dead
+    and filed in the retry folder) it raises RetryableError.
+
+    Args:
+        process: Per-message pipeline, as used with the scheduler handler
+    """
+    def handle(job: Job) -> str:
+        message = email.message_from_bytes(job.payload)
+        setattr(message, UID_ATTR, job.key.rsplit('/', 1)[1])
+        mailbox = JobMailbox(job)
+        process(mailbox, message)
+        return json.dumps(mailbox.outcome or {'error': 'no outcome reported'})
+    return handle
@@ -1,5 +1,7 @@
 import requests
 
+from modules.rate_limiter import RateLimitTimeout, get_rate_limiter
+
 # Import timeout configuration
 try:
     from config import Config
@@ -7,6 +9,23 @@ try:
 except ImportError:
     REQUEST_TIMEOUT = 10  # Default timeout
 
+
+def _azure_get(url, params):
+    """GET on Azure Maps within the subscription's rate limit (one retry after a 429)"""
+    limiter = get_rate_limiter('azure_maps')
+    for attempt in range(2):
+        if limiter:
+            try:
+                limiter.acquire()
+            except RateLimitTimeout:
+                return None
+        response = requests.get(url, params=params, timeout=REQUEST_TIMEOUT)
+        if response.status_code != 429 or not limiter:
+            return response
+        retry_after = response.headers.get('Retry-After')
+        limiter.penalize(float(retry_after) if retry_after and retry_after.isdigit() else None)
+    return response
+
 def get_location_details(address, subscription_key):
     # Funzione di geocodifica
     def geocode_address(address, subscription_key):
@@ -16,8 +35,8 @@ def get_location_details(address, subscription_key):
             'query': address,
             'subscription-key': subscription_key
         }
-        response = requests.get(url, params=params, timeout=REQUEST_TIMEOUT)
-        if response.status_code == 200:
+        response = _azure_get(url, params)
+        if response is not None and response.status_code == 200:
             data = response.json()
             if data['results']:
                 return data['results'][0]['position']
@@ -34,8 +53,8 @@ def get_location_details(address, subscription_key):
             'query': f'{lat},{lon}',
             'subscription-key': subscription_key
         }
-        response = requests.get(url, params=params, timeout=REQUEST_TIMEOUT)
-        if response.status_code == 200:
+        response = _azure_get(url, params)
+        if response is not None and response.status_code == 200:
             data = response.json()
             if data['addresses']:
                 return data['addresses'][0]['address']
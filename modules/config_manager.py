@@ -45,6 +45,10 @@ class ConfigManager:
                 'GROQ_API_KEY': 'GROQ_API_KEY',
                 'OLLAMA_URL': 'OLLAMA_URL',
                 'AZURE_API_KEY': 'AZURE_API_KEY',
+                'IMAP_ACTIONS': 'IMAP_ACTIONS',
+                'IMAP_ROUTED_FOLDER': 'IMAP_ROUTED_FOLDER',
+                'IMAP_RETRY_FOLDER': 'IMAP_RETRY_FOLDER',
+                'IMAP_REVIEW_FOLDER': 'IMAP_REVIEW_FOLDER',
             }
             
             for env_key, config_key in env_mapping.items():
@@ -63,6 +67,13 @@ class ConfigManager:
         """Get configuration value"""
         return self._config.get(key, default)
     
+    def get_bool(self, key: str, default: bool = False) -> bool:
+        """Get a flag; values from .env are strings ("true", "false", "1", "0")"""
+        value = self._config.get(key, default)
+        if isinstance(value, str):
+            return value.strip().lower() in ('true', '1', 'yes', 'on')
+        return bool(value)
+    
     def set(self, key: str, value: Any) -> None:
         """Set configuration value"""
         self._config[key] = value
@@ -0,0 +1,103 @@
+"""
+Department catalog index.
+
+Provides O(1) lookups by name and a cosine-similarity shortlist of the
+departments closest to an email, so that only the top candidates have to
+be described in the prompt when the catalog is large.
+"""
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from modules.embeddings import get_embedder
+from modules.prom_metrics import cache_hit
+
+logger = logging.getLogger(__name__)
+
+
+def department_text(reparto: Dict[str, str]) -> str:
+    return f"{reparto['nome']}: {reparto.get('descrizione', '')}"
+
+
+def _fingerprint(reparti: List[Dict[str, str]]) -> Tuple:
+    # Contenuto del catalogo: due copie uguali (get_all() restituisce una copia) condividono l'indice
+    return tuple(tuple(sorted((k, str(v)) for k, v in r.items())) for r in reparti)
+
+
+class DepartmentIndex:
+    """Name map and embedding matrix of a departments list"""
+
+    def __init__(self, reparti: List[Dict[str, str]], embedder=None):
+        self.reparti = reparti
+        self.fingerprint = _fingerprint(reparti)
+        self.by_name: Dict[str, Dict[str, str]] = {r['nome'].lower(): r for r in reparti}
+        self._embedder = embedder
+        self._matrix: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.reparti)
+
+    def get(self, nome: str) -> Optional[Dict[str, str]]:
+        """Department by name (case-insensitive)"""
+        return self.by_name.get(str(nome).lower())
+
+    def __contains__(self, nome: str) -> bool:
+        return str(nome).lower() in self.by_name
+
+    @property
+    def embedder(self):
+        if self._embedder is None:
+            self._embedder = get_embedder()
+        return self._embedder
+
+    def build(self) -> np.ndarray:
+        """Embed all departments (done once, on first shortlist)"""
+        if self._matrix is None:
+            with self._lock:
+                if self._matrix is None:
+                    self._matrix = self.embedder.embed([department_text(r) for r in self.reparti])
+                    logger.info(f"Department index built: {len(self.reparti)} departments, "
+                                f"{self._matrix.shape[1]} dims ({self.embedder.name})")
+        return self._matrix
+
+    def shortlist(self, text: str, k: int) -> List[Dict[str, str]]:
+        """
+        The k departments most similar to text, best first.
+
+        Args:
+            text: Email content (subject + body)
+            k: Number of candidates
+        """
+        if k >= len(self.reparti):
+            return list(self.reparti)
+        matrix = self.build()
+        query = self.embedder.embed([text])[0]
+        scores = matrix @ query
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self.reparti[i] for i in top]
+
+
+_current: Optional[DepartmentIndex] = None
+_current_lock = threading.Lock()
+
+
+def get_department_index(reparti: List[Dict[str, str]]) -> DepartmentIndex:
+    """
+    Index of a departments list, shared while the catalog content is the
+    same (the list object itself, e.g. a ProcessorRegistry snapshot, or an
+    equal copy from RepartiManager.get_all()).
+    """
+    global _current
+    index = _current
+    if index is not None and (index.reparti is reparti or index.fingerprint == _fingerprint(reparti)):
+        cache_hit('department_index', True)
+        return index
+    cache_hit('department_index', False)
+    with _current_lock:
+        if _current is None or _current.fingerprint != _fingerprint(reparti):
+            _current = DepartmentIndex(reparti)
+        return _current
@@ -0,0 +1,101 @@
+"""
+Local CPU text embeddings.
+
+Uses a sentence-transformers model when installed (multilingual MiniLM by
+default); otherwise falls back to a hashing embedder (words + character
+trigrams) that needs only NumPy. All vectors are L2-normalized float32, so
+cosine similarity is a dot product.
+"""
+import logging
+import os
+import re
+import zlib
+from functools import lru_cache
+from typing import List, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Modello di embedding opzionale
+try:
+    from sentence_transformers import SentenceTransformer
+    SENTENCE_TRANSFORMERS_AVAILABLE = True
+except ImportError:
+    SENTENCE_TRANSFORMERS_AVAILABLE = False
+
+DEFAULT_EMBEDDING_MODEL = 'paraphrase-multilingual-MiniLM-L12-v2'
+HASHING_DIM = 1024
+
+_WORD_RE = re.compile(r'\w{2,}')
+
+
+class HashingEmbedder:
+    """Signed feature hashing of words and character trigrams (no model download)"""
+
+    def __init__(self, dim: int = HASHING_DIM):
+        self.dim = dim
+        self.name = f'hashing-{dim}'
+
+    @staticmethod
+    def _features(text: str) -> List[str]:
+        features = []
+        for word in _WORD_RE.findall(text.lower()):
+            features.append(word)
+            padded = f'#{word}#'
+            features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def _embed_one(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        features = self._features(text)
+        if not features:
+            return vector
+        hashes = np.fromiter((zlib.crc32(f.encode('utf-8')) for f in features), dtype=np.uint32, count=len(features))
+        signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+        np.add.at(vector, hashes % self.dim, signs)
+        # Attenua le feature molto frequenti
+        vector = np.sign(vector) * np.sqrt(np.abs(vector))
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.vstack([self._embed_one(t or '') for t in texts])
+
+
+class SentenceTransformerEmbedder:
+    """sentence-transformers model running on CPU"""
+
+    def __init__(self, model_name: str = DEFAULT_EMBEDDING_MODEL):
+        self.model = SentenceTransformer(model_name, device='cpu')
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = model_name
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        vectors = self.model.encode(list(texts), batch_size=32, normalize_embeddings=True,
+                                    show_progress_bar=False)
+        return np.asarray(vectors, dtype=np.float32)
+
+
+@lru_cache(maxsize=4)
+def get_embedder(model_name: str = None):
+    """
+    Shared embedder.
+
+    Args:
+        model_name: sentence-transformers model (default: EMBEDDING_MODEL env
+            or DEFAULT_EMBEDDING_MODEL); "hashing" forces the NumPy fallback
+    """
+    model_name = model_name or os.getenv('EMBEDDING_MODEL', DEFAULT_EMBEDDING_MODEL)
+    if SENTENCE_TRANSFORMERS_AVAILABLE and model_name != 'hashing':
+        try:
+            embedder = SentenceTransformerEmbedder(model_name)
+            logger.info(f"Embeddings: {model_name} ({embedder.dim} dims)")
+            return embedder
+        except Exception as e:
+            logger.warning(f"Embedding model {model_name} not available, using hashing: {e}")
+    return HashingEmbedder()
@@ -0,0 +1,37 @@
+"""
+File helpers shared by the JSON-backed managers.
+"""
+import json
+import os
+import tempfile
+from typing import Any
+
+
+def atomic_write_json(path: str, data: Any, **dump_kwargs) -> None:
+    """
+    Write JSON to path atomically.
+
+    Data goes to a temporary file in the same directory, which is flushed to
+    disk and then renamed over path, so readers and crashes never see a
+    truncated file.
+
+    Args:
+        path: Destination file
+        data: JSON-serializable object
+        **dump_kwargs: Passed to json.dump (e.g. indent, ensure_ascii)
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(path)}.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
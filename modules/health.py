@@ -0,0 +1,234 @@
+"""
+Dependency health checks with cached results.
+
+Each check (IMAP login, SMTP login, LLM provider reachability, backlog
+size...) runs at most once per TTL; concurrent callers share the cached
+result and the checks in flight, and stale checks are refreshed in
+parallel under one shared deadline so a hanging dependency cannot block
+the health endpoint.
+"""
+import imaplib
+import logging
+import smtplib
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+OK = 'ok'
+DEGRADED = 'degraded'
+DOWN = 'down'
+SKIPPED = 'skipped'  # dipendenza non configurata
+
+DEFAULT_TTL = 30.0
+DEFAULT_TIMEOUT = 10.0
+
+CheckOutcome = Union[None, str, Tuple[str, str]]
+
+
+class CheckSkipped(Exception):
+    """Raised by a check whose dependency is not configured"""
+
+
+@dataclass
+class CheckResult:
+    """Outcome of one dependency check"""
+    name: str
+    status: str
+    detail: str
+    latency_ms: float
+    checked_at: float
+    critical: bool
+
+
+@dataclass
+class _Check:
+    name: str
+    fn: Callable[[], CheckOutcome]
+    critical: bool
+    ttl: float
+    result: Optional[CheckResult] = None
+    running: Optional[Future] = None  # esecuzione in corso, condivisa dai chiamanti
+
+
+class HealthChecker:
+    """Registry of cached dependency checks"""
+
+    def __init__(self, ttl: float = DEFAULT_TTL, timeout: float = DEFAULT_TIMEOUT):
+        """
+        Args:
+            ttl: Seconds a check result is reused
+            timeout: Seconds after which a running check is reported as down
+        """
+        self.ttl = ttl
+        self.timeout = timeout
+        self._checks: Dict[str, _Check] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='health')
+
+    def register(self, name: str, fn: Callable[[], CheckOutcome], critical: bool = True,
+                 ttl: Optional[float] = None) -> None:
+        """
+        Add a check.
+
+        Args:
+            name: Check name (imap, smtp, llm:groq...)
+            fn: Returns None/detail string when healthy, or (status, detail);
+                raises when the dependency is down (CheckSkipped if not configured)
+            critical: If False, a failure only degrades the overall status
+            ttl: Override of the default TTL
+        """
+        self._checks[name] = _Check(name, fn, critical, ttl if ttl is not None else self.ttl)
+
+    def _run(self, check: _Check) -> CheckResult:
+        start = time.monotonic()
+        try:
+            outcome = check.fn()
+            status, detail = outcome if isinstance(outcome, tuple) else (OK, outcome or '')
+        except CheckSkipped as e:
+            status, detail = SKIPPED, str(e)
+        except Exception as e:
+            status, detail = DOWN, f"{type(e).__name__}: {e}"
+        return CheckResult(check.name, status, detail, round((time.monotonic() - start) * 1000, 1),
+                           time.time(), check.critical)
+
+    def _stale(self, check: _Check, now: float) -> bool:
+        return check.result is None or now - check.result.checked_at >= check.ttl
+
+    def _record(self, check: _Check, future: Future) -> None:
+        with self._lock:
+            if check.running is not future:
+                return
+            check.running = None
+            check.result = future.result()
+        if check.result.status == DOWN:
+            logger.warning(f"⚠️ Health check {check.name} failed: {check.result.detail}")
+
+    def results(self, refresh: bool = False) -> Dict[str, CheckResult]:
+        """
+        Check results, running those that are stale (or all if refresh).
+
+        A check already running is not started again: callers wait for the
+        same run. All checks share one deadline of `timeout` seconds; those
+        still running then are reported down and record their result when
+        they finish.
+        """
+        with self._lock:
+            now = time.time()
+            started = []
+            for check in self._checks.values():
+                if check.running is None and (refresh or self._stale(check, now)):
+                    check.running = self._executor.submit(self._run, check)
+                    started.append((check, check.running))
+            waiting = {c.name: (c, c.running) for c in self._checks.values() if c.running is not None}
+        for check, future in started:
+            future.add_done_callback(lambda future, check=check: self._record(check, future))
+
+        # Attesa senza lock: gli altri chiamanti leggono la cache o aspettano le stesse esecuzioni
+        wait([future for _, future in waiting.values()], timeout=self.timeout)
+        for check, future in waiting.values():
+            if future.done():
+                self._record(check, future)
+                continue
+            with self._lock:
+                if check.running is future:
+                    check.result = CheckResult(check.name, DOWN, f"timed out after {self.timeout:.0f}s",
+                                               self.timeout * 1000, time.time(), check.critical)
+            logger.warning(f"⚠️ Health check {check.name} timed out after {self.timeout:.0f}s")
+        with self._lock:
+            return {name: c.result for name, c in self._checks.items()}
+
+    def cached(self) -> Dict[str, CheckResult]:
+        """Last results without running anything (for metrics scrapes)"""
+        return {name: c.result for name, c in self._checks.items() if c.result is not None}
+
+    def report(self, refresh: bool = False) -> Dict:
+        """
+        Overall status: 'unhealthy' if a critical check is down, 'degraded'
+        if a non-critical check is down or any check is degraded.
+        """
+        results = self.results(refresh)
+        if any(r.status == DOWN and r.critical for r in results.values()):
+            status = 'unhealthy'
+        elif any(r.status in (DOWN, DEGRADED) for r in results.values()):
+            status = 'degraded'
+        else:
+            status = 'healthy'
+        return {
+            'status': status,
+            'checks': {name: asdict(r) for name, r in results.items()},
+        }
+
+
+def imap_check(host: str, user: str, password: str, timeout: float = DEFAULT_TIMEOUT) -> CheckOutcome:
+    """Connect and log in to the IMAP server"""
+    if not all([host, user, password]):
+        raise CheckSkipped("IMAP credentials not configured")
+    mail = imaplib.IMAP4_SSL(host, timeout=timeout)
+    try:
+        mail.login(user, password)
+    finally:
+        try:
+            mail.logout()
+        except Exception:
+            pass
+    return f"login ok on {host}"
+
+
+def smtp_check(host: str, user: str, password: str, port: int = 465, timeout: float = DEFAULT_TIMEOUT) -> CheckOutcome:
+    """Connect and log in to the SMTP server"""
+    if not all([host, user, password]):
+        raise CheckSkipped("SMTP credentials not configured")
+    with smtplib.SMTP_SSL(host, port, timeout=timeout) as smtp:
+        smtp.login(user, password)
+    return f"login ok on {host}:{port}"
+
+
+def llm_check(processor, timeout: float = DEFAULT_TIMEOUT) -> CheckOutcome:
+    """GET /models of an OpenAI-compatible provider (Groq, Ollama)"""
+    import requests
+
+    response = requests.get(f"{processor.api_base}/models", headers=processor._headers(), timeout=timeout)
+    if response.status_code == 429:
+        return DEGRADED, "rate limited"
+    response.raise_for_status()
+    models = [m.get('id') for m in response.json().get('data', [])]
+    if models and processor.model not in models:
+        return DEGRADED, f"model {processor.model} not available"
+    return f"{processor.model} available"
+
+
+def llm_router_check(router, timeout: float = DEFAULT_TIMEOUT) -> CheckOutcome:
+    """
+    All providers of an LLMRouter: degraded if only some are reachable.
+
+    The timeout is the budget of the whole check, shared among the
+    providers still to be checked.
+    """
+    details, statuses = [], []
+    deadline = time.monotonic() + timeout
+    processors = list(router.processors)
+    for position, processor in enumerate(processors):
+        name = f"{processor.provider}:{processor.model}"
+        budget = max(0.5, (deadline - time.monotonic()) / (len(processors) - position))
+        try:
+            outcome = llm_check(processor, budget)
+            status, detail = outcome if isinstance(outcome, tuple) else (OK, outcome)
+        except Exception as e:
+            status, detail = DOWN, f"{type(e).__name__}: {e}"
+        statuses.append(status)
+        details.append(f"{name} {status}" + (f" ({detail})" if status != OK else ''))
+    if all(status == DOWN for status in statuses):
+        raise ConnectionError('; '.join(details) or "no LLM provider configured")
+    return (OK if all(status == OK for status in statuses) else DEGRADED), '; '.join(details)
+
+
+def backlog_check(count: Callable[[], int], warn_at: int) -> CheckOutcome:
+    """Degraded when more than warn_at emails are waiting"""
+    pending = count()
+    if pending > warn_at:
+        return DEGRADED, f"{pending} emails waiting (> {warn_at})"
+    return f"{pending} emails waiting"
@@ -0,0 +1,172 @@
+"""
+Streaming HTML to plain text conversion shared by all email parsing code.
+
+The converter tokenizes the document with a single precompiled pattern and
+walks it once, so large newsletters are converted without building a DOM and
+the scan stops as soon as the length cap is reached.
+"""
+import logging
+import re
+from html import unescape
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Elementi il cui contenuto è testo grezzo: si salta direttamente al tag di chiusura
+_RAW_TEXT_TAGS = frozenset({'script', 'style'})
+# Contenitori il cui testo non deve mai finire nel corpo
+_SKIP_TAGS = frozenset({'head', 'title', 'noscript', 'template', 'svg', 'object'})
+_BLOCK_TAGS = frozenset({
+    'p', 'div', 'br', 'hr', 'tr', 'table', 'ul', 'ol', 'section', 'article',
+    'header', 'footer', 'blockquote', 'pre', 'center',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+})
+_CELL_TAGS = frozenset({'td', 'th'})
+
+_TOKEN_RE = re.compile(
+    r'<!--.*?(?:-->|$)'                                                   # comment
+    r'|<(/?)([a-zA-Z][a-zA-Z0-9:-]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>'   # tag
+    r'|<[!?][^>]*>'                                                       # doctype / PI
+    r'|([^<]+|<)',                                                        # text
+    re.DOTALL,
+)
+_HREF_RE = re.compile(r'\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.IGNORECASE)
+_RAW_TEXT_END_RE = {tag: re.compile(rf'</{tag}\s*>', re.IGNORECASE) for tag in _RAW_TEXT_TAGS}
+
+_WHITESPACE_RE = re.compile(r'[ \t\r\n\f\v\u00a0\u200b\u200c\u034f]+')
+_EMPTY_CELLS_RE = re.compile(r' \|(?: +\|)+ ')
+_LINE_EDGES_RE = re.compile(r' *\n *')
+_SEPARATOR_ONLY_RE = re.compile(r'^ ?\|[ |]*$', re.MULTILINE)
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+
+# Fallback regex (HTML malformato)
+_STYLE_RE = re.compile(r'<style[^>]*>.*?</style>', re.DOTALL | re.IGNORECASE)
+_SCRIPT_RE = re.compile(r'<script[^>]*>.*?</script>', re.DOTALL | re.IGNORECASE)
+_TAG_RE = re.compile(r'<[^>]+>')
+
+
+class HTMLTextConverter:
+    """Single-pass HTML tokenizer that accumulates readable text"""
+
+    def __init__(self, max_chars: Optional[int] = None, include_links: bool = False):
+        """
+        Args:
+            max_chars: Stop collecting text after this many characters (None = no limit)
+            include_links: Append link targets after the anchor text
+        """
+        self.max_chars = max_chars
+        self.include_links = include_links
+        self.truncated = False
+
+    def convert(self, html_content: str) -> str:
+        """Convert an HTML document to plain text"""
+        self.truncated = False
+        chunks = []
+        length = 0
+        limit = self.max_chars
+        skip_depth = 0
+        cell_index = 0
+        href = None
+        pos = 0
+        end = len(html_content)
+        match_token = _TOKEN_RE.match
+
+        while pos < end:
+            m = match_token(html_content, pos)
+            pos = m.end()
+            text = m.group(4)
+            out = None
+
+            if text is not None:
+                if skip_depth:
+                    continue
+                if '&' in text:
+                    text = unescape(text)
+                out = _WHITESPACE_RE.sub(' ', text)
+                if out == ' ' and (not chunks or chunks[-1][-1] in ' \n'):
+                    # Spazi tra tag: servono solo come separatore
+                    continue
+            else:
+                tag = m.group(2)
+                if tag is None:
+                    continue  # commento, doctype
+                tag = tag.lower()
+                closing = bool(m.group(1))
+
+                if tag in _RAW_TEXT_TAGS:
+                    if not closing and not m.group(3).endswith('/'):
+                        close = _RAW_TEXT_END_RE[tag].search(html_content, pos)
+                        pos = close.end() if close else end
+                    continue
+                if tag in _SKIP_TAGS:
+                    if closing:
+                        skip_depth = max(0, skip_depth - 1)
+                    elif not m.group(3).endswith('/'):
+                        skip_depth += 1
+                    continue
+                if skip_depth:
+                    continue
+
+                if closing:
+                    if tag in _BLOCK_TAGS:
+                        out = '\n'
+                    elif tag == 'a' and href:
+                        if href.startswith(('http://', 'https://', 'mailto:')):
+                            out = f' ({href})'
+                        href = None
+                elif tag in _CELL_TAGS:
+                    if cell_index:
+                        out = ' | '
+                    cell_index += 1
+                elif tag == 'tr':
+                    cell_index = 0
+                    out = '\n'
+                elif tag == 'li':
+                    out = '\n- '
+                elif tag in _BLOCK_TAGS:
+                    out = '\n'
+                elif tag == 'a' and self.include_links:
+                    h = _HREF_RE.search(m.group(3))
+                    href = unescape(h.group(1) or h.group(2) or h.group(3)) if h else None
+
+            if out:
+                if limit is not None and length + len(out) >= limit:
+                    chunks.append(out[:limit - length])
+                    self.truncated = True
+                    break
+                chunks.append(out)
+                length += len(out)
+
+        text = ''.join(chunks)
+        text = _EMPTY_CELLS_RE.sub(' | ', text)
+        text = _LINE_EDGES_RE.sub('\n', text)
+        text = _SEPARATOR_ONLY_RE.sub('', text)
+        text = _BLANK_LINES_RE.sub('\n\n', text)
+        return text.strip()
+
+
+def html_to_text(html_content: str, max_chars: Optional[int] = None, include_links: bool = False) -> str:
+    """
+    Convert HTML to plain text.
+
+    Args:
+        html_content: HTML source
+        max_chars: Maximum length of the returned text (None = no limit)
+        include_links: Append link targets after the anchor text
+
+    Returns:
+        Plain text
+    """
+    if not html_content:
+        return ""
+
+    try:
+        return HTMLTextConverter(max_chars=max_chars, include_links=include_links).convert(html_content)
+    except Exception as e:
+        logger.warning(f"Error converting HTML to text: {e}")
+        # Fallback: rimozione tag HTML con regex
+        text = _STYLE_RE.sub('', html_content)
+        text = _SCRIPT_RE.sub('', text)
+        text = _TAG_RE.sub('', text)
+        text = _WHITESPACE_RE.sub(' ', text).strip()
+        return text[:max_chars] if max_chars is not None else text
@@ -0,0 +1,342 @@
+"""
+Post-routing IMAP actions.
+
+Once an email has been forwarded (or has failed), its source message is
+filed on the server: routed mail goes to a per-department folder, mail sent
+to the control address to a review folder, failures to a retry folder.
+Actions are queued by UID and flushed in batches grouped by target folder,
+so N emails cost one UID MOVE per folder (or COPY + STORE + one UID EXPUNGE
+on servers without MOVE) instead of N round trips.
+"""
+import atexit
+import base64
+import imaplib
+import logging
+import re
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, ContextManager, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAILBOX = 'INBOX'
+DEFAULT_ROUTED_FOLDER = 'Routed'
+DEFAULT_RETRY_FOLDER = 'Retry'
+DEFAULT_REVIEW_FOLDER = 'Review'
+# Reparto delle email inoltrate all'indirizzo di controllo (filed in review_folder)
+CONTROL_DEPARTMENT = 'Control'
+
+# Attributo con cui check_for_new_emails associa l'UID al messaggio
+UID_ATTR = 'imap_uid'
+
+_LIST_DELIMITER = re.compile(rb'\([^)]*\)\s+(?:"((?:[^"\\]|\\.)*)"|NIL)')
+
+
+def get_uid(message) -> Optional[str]:
+    """IMAP UID of a fetched message, if known"""
+    return getattr(message, UID_ATTR, None)
+
+
+def uid_set(uids: Iterable) -> str:
+    """
+    Compact IMAP sequence set of UIDs, e.g. [1, 2, 3, 5, 7, 8] -> '1:3,5,7:8'.
+    """
+    values = sorted({int(uid) for uid in uids})
+    ranges = []
+    for value in values:
+        if ranges and value == ranges[-1][1] + 1:
+            ranges[-1][1] = value
+        else:
+            ranges.append([value, value])
+    return ','.join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+
+def encode_mailbox(name: str) -> str:
+    """Mailbox name in IMAP modified UTF-7 (RFC 3501 5.1.3)"""
+    result, pending = [], []
+
+    def flush_pending():
+        if pending:
+            encoded = base64.b64encode(''.join(pending).encode('utf-16-be')).decode('ascii')
+            result.append('&' + encoded.rstrip('=').replace('/', ',') + '-')
+            pending.clear()
+
+    for char in name:
+        if 0x20 <= ord(char) <= 0x7e:
+            flush_pending()
+            result.append('&-' if char == '&' else char)
+        else:
+            pending.append(char)
+    flush_pending()
+    return ''.join(result)
+
+
+def quote_mailbox(name: str) -> str:
+    """Encoded and quoted mailbox name for IMAP commands"""
+    return '"' + encode_mailbox(name).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class ImapActions:
+    """Queue of flag/move actions on source messages, flushed in batches"""
+
+    def __init__(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        mailbox: str = DEFAULT_MAILBOX,
+        routed_folder: str = DEFAULT_ROUTED_FOLDER,
+        retry_folder: str = DEFAULT_RETRY_FOLDER,
+        review_folder: str = DEFAULT_REVIEW_FOLDER,
+        flush_interval: Optional[float] = None,
+        file_messages: bool = True,
+        on_acknowledged: Optional[Callable[[List[str]], None]] = None,
+        connection: Optional[Callable[[], ContextManager[imaplib.IMAP4]]] = None
+    ):
+        """
+        Args:
+            host, user, password: IMAP account of the source messages
+            mailbox: Folder the UIDs belong to
+            routed_folder: Parent of the per-department folders
+            retry_folder: Folder for messages whose processing failed
+            review_folder: Folder for messages forwarded to the control address
+            flush_interval: If set, a background thread flushes every N seconds;
+                otherwise the caller flushes after each batch
+            file_messages: If False, messages are only flagged, never moved
+            on_acknowledged: Called with the UIDs whose actions were committed
+            connection: Context manager factory yielding a logged-in connection
+                (e.g. ImapConnectionPool.connection); default: one login per flush
+        """
+        self.host = host
+        self.user = user
+        self.password = password
+        self.mailbox = mailbox
+        self.routed_folder = routed_folder
+        self.retry_folder = retry_folder
+        self.review_folder = review_folder
+        self.file_messages = file_messages
+        self.on_acknowledged = on_acknowledged
+        self._connection = connection or self._login
+        # UIDVALIDITY dei UID accodati: se il server la cambia i UID non sono più validi
+        self.uidvalidity: Optional[int] = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # (operazione, flag) -> UID  e  percorso cartella -> UID
+        self._flags: Dict[Tuple[str, str], Set[str]] = defaultdict(set)
+        self._moves: Dict[Tuple[str, ...], Set[str]] = defaultdict(set)
+        self._created: Set[str] = set()
+
+        self.flush_interval = flush_interval
+        self._stop = threading.Event()
+        if flush_interval:
+            threading.Thread(target=self._flush_loop, name="imap-actions", daemon=True).start()
+            atexit.register(self.close)
+
+    # ----- Accodamento -----
+
+    def flag(self, uid: str, flags: str = '\\Seen', remove: bool = False) -> None:
+        """Queue a STORE of flags (e.g. '\\Seen', '\\Flagged') on a message"""
+        if uid:
+            with self._lock:
+                self._flags[('-FLAGS.SILENT' if remove else '+FLAGS.SILENT', f"({flags})")].add(str(uid))
+
+    def move(self, uid: str, *folder: str) -> None:
+        """Queue a move to a folder given as path parts (joined with the server delimiter)"""
+        if uid:
+            with self._lock:
+                self._moves[tuple(folder)].add(str(uid))
+
+    def route(self, uid: str, department: str) -> None:
+        """
+        Mark a forwarded message as seen and file it under routed_folder/department
+        (review_folder for CONTROL_DEPARTMENT)
+        """
+        self.flag(uid, '\\Seen')
+        if not self.file_messages:
+            return
+        if department == CONTROL_DEPARTMENT:
+            self.move(uid, self.review_folder)
+        else:
+            self.move(uid, self.routed_folder, department or 'Unknown')
+
+    def fail(self, uid: str) -> None:
+        """File a message whose processing failed in the retry folder (flagged if not filing)"""
+        if self.file_messages:
+            self.flag(uid, '\\Seen', remove=True)
+            self.move(uid, self.retry_folder)
+        else:
+            self.flag(uid, '\\Flagged')
+
+    def pending(self) -> int:
+        """Messages with queued actions"""
+        with self._lock:
+            uids = set()
+            for group in list(self._flags.values()) + list(self._moves.values()):
+                uids |= group
+            return len(uids)
+
+    # ----- Esecuzione -----
+
+    def _take(self):
+        with self._lock:
+            flags, moves = dict(self._flags), dict(self._moves)
+            self._flags.clear()
+            self._moves.clear()
+        return flags, moves
+
+    def _requeue(self, flags, moves) -> None:
+        with self._lock:
+            for key, uids in flags.items():
+                self._flags[key] |= uids
+            for key, uids in moves.items():
+                self._moves[key] |= uids
+
+    @contextmanager
+    def _login(self):
+        mail = imaplib.IMAP4_SSL(self.host)
+        try:
+            mail.login(self.user, self.password)
+            yield mail
+        finally:
+            try:
+                mail.logout()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _check(response, command: str):
+        status, data = response
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"{command} failed: {data}")
+        return data
+
+    def _capabilities(self, mail) -> Set[str]:
+        # Dopo il login il server può annunciare capability in più (es. MOVE)
+        try:
+            data = self._check(mail.capability(), 'CAPABILITY')
+            return set(data[-1].decode('ascii', errors='ignore').upper().split())
+        except Exception:
+            return set(mail.capabilities)
+
+    def _delimiter(self, mail) -> str:
+        """Hierarchy delimiter of the server ('/' or '.')"""
+        try:
+            data = self._check(mail.list('""', '""'), 'LIST')
+            match = _LIST_DELIMITER.match(data[0] or b'')
+            if match and match.group(1):
+                return match.group(1).decode('ascii')
+        except Exception as e:
+            logger.warning(f"⚠️ Could not read IMAP hierarchy delimiter: {e}")
+        return '/'
+
+    def _folder_name(self, parts: Tuple[str, ...], delimiter: str) -> str:
+        # Il delimitatore dentro un nome di reparto creerebbe sottocartelle
+        return delimiter.join(part.replace(delimiter, '-').strip() or '-' for part in parts)
+
+    def _ensure_folder(self, mail, name: str) -> None:
+        if name in self._created:
+            return
+        status, data = mail.create(quote_mailbox(name))
+        # Una cartella già esistente fa fallire CREATE: va bene così
+        if status != 'OK' and b'exist' not in b' '.join(d or b'' for d in data).lower():
+            raise imaplib.IMAP4.error(f"CREATE {name} failed: {data}")
+        self._created.add(name)
+
+    def flush(self) -> Dict[str, int]:
+        """
+        Run the queued actions: one STORE per flag change, then one MOVE per
+        folder (without MOVE: one COPY per folder, then a single STORE
+        \\Deleted and UID EXPUNGE for all of them). Servers without UIDPLUS
+        cannot expunge only these messages: they are left flagged \\Deleted
+        rather than expunging other clients' deleted messages.
+
+        Actions of a batch that fails are put back in the queue.
+
+        Returns:
+            Messages moved per folder
+        """
+        with self._flush_lock:
+            flags, moves = self._take()
+            if not flags and not moves:
+                return {}
+
+            moved: Dict[str, int] = {}
+            done_flags, done_moves = set(), set()
+            try:
+                with self._connection() as mail:
+                    self._check(mail.select(quote_mailbox(self.mailbox)), 'SELECT')
+                    if not self._same_uidvalidity(mail):
+                        flags, moves = {}, {}
+                    capabilities = self._capabilities(mail)
+
+                    for (operation, flag_list), uids in flags.items():
+                        self._check(mail.uid('STORE', uid_set(uids), operation, flag_list), 'UID STORE')
+                        done_flags.add((operation, flag_list))
+
+                    delimiter = self._delimiter(mail) if moves else '/'
+                    copied: List[str] = []
+                    for parts, uids in moves.items():
+                        folder = self._folder_name(parts, delimiter)
+                        self._ensure_folder(mail, folder)
+                        uids_arg = uid_set(uids)
+                        if 'MOVE' in capabilities:
+                            self._check(mail.uid('MOVE', uids_arg, quote_mailbox(folder)), 'UID MOVE')
+                        else:
+                            self._check(mail.uid('COPY', uids_arg, quote_mailbox(folder)), 'UID COPY')
+                            copied.extend(uids)
+                        done_moves.add(parts)
+                        moved[folder] = len(uids)
+
+                    if copied:
+                        copied_set = uid_set(copied)
+                        self._check(mail.uid('STORE', copied_set, '+FLAGS.SILENT', '(\\Deleted)'), 'UID STORE')
+                        # Senza UIDPLUS, EXPUNGE rimuoverebbe ogni messaggio \Deleted della cartella
+                        if 'UIDPLUS' in capabilities:
+                            self._check(mail.uid('EXPUNGE', copied_set), 'UID EXPUNGE')
+                        else:
+                            logger.warning(f"⚠️ Server without UIDPLUS: {len(copied)} copied messages "
+                                           f"left flagged \\Deleted in {self.mailbox}")
+            except Exception as e:
+                logger.error(f"❌ IMAP actions failed, will retry: {e}")
+                self._requeue({k: v for k, v in flags.items() if k not in done_flags},
+                              {k: v for k, v in moves.items() if k not in done_moves})
+
+            if moved:
+                logger.info("📁 Filed source messages: " + ", ".join(f"{f} ({n})" for f, n in moved.items()))
+            self._acknowledge(flags, moves, done_flags, done_moves)
+            return moved
+
+    def _same_uidvalidity(self, mail) -> bool:
+        if self.uidvalidity is None:
+            return True
+        _, data = mail.response('UIDVALIDITY')
+        # Su una connessione riusata possono esserci risposte di SELECT precedenti: vale l'ultima
+        current = int(data[-1]) if data and data[-1] else None
+        if current is not None and current != int(self.uidvalidity):
+            logger.error(f"❌ UIDVALIDITY of {self.mailbox} changed ({self.uidvalidity} -> {current}), "
+                         f"dropping queued IMAP actions")
+            return False
+        return True
+
+    def _acknowledge(self, flags, moves, done_flags, done_moves) -> None:
+        # Confermati i UID le cui azioni sono andate tutte a buon fine
+        done, failed = set(), set()
+        for actions, completed in ((flags, done_flags), (moves, done_moves)):
+            for key, uids in actions.items():
+                (done if key in completed else failed).update(uids)
+        done -= failed
+        if done and self.on_acknowledged:
+            try:
+                self.on_acknowledged(sorted(done, key=int))
+            except Exception as e:
+                logger.error(f"Error acknowledging IMAP actions: {e}")
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self) -> None:
+        """Stop the background flusher and run pending actions"""
+        self._stop.set()
+        self.flush()
@@ -0,0 +1,151 @@
+"""
+Incremental JSON object parser for streamed LLM completions.
+
+Fed with text chunks as they arrive, it returns each top-level field of the
+JSON object as soon as its value is complete, without waiting for the rest
+of the document.
+"""
+import json
+from typing import Any, Dict, Optional, Tuple
+
+_WHITESPACE = ' \t\r\n'
+_SCALAR_END = ',}] \t\r\n'
+
+
+class IncrementalJSONParser:
+    """Extracts completed top-level fields from a partially received JSON object"""
+
+    def __init__(self):
+        self.fields: Dict[str, Any] = {}
+        self.complete = False
+        self._buffer = ""
+        self._pos = 0
+        self._started = False
+
+    def feed(self, chunk: str) -> Dict[str, Any]:
+        """
+        Add a chunk of text.
+
+        Args:
+            chunk: Next piece of the completion
+
+        Returns:
+            Fields completed by this chunk (empty dict if none)
+        """
+        self._buffer += chunk
+        new_fields = {}
+        while not self.complete:
+            item = self._next_field()
+            if item is None:
+                break
+            key, value = item
+            self.fields[key] = value
+            new_fields[key] = value
+        return new_fields
+
+    def _skip(self, i: int, chars: str) -> int:
+        buf = self._buffer
+        while i < len(buf) and buf[i] in chars:
+            i += 1
+        return i
+
+    def _scan_string(self, i: int) -> Optional[int]:
+        """End index (exclusive) of the string starting at i, None if incomplete"""
+        buf = self._buffer
+        j = i + 1
+        while j < len(buf):
+            c = buf[j]
+            if c == '\\':
+                j += 2
+                continue
+            if c == '"':
+                return j + 1
+            j += 1
+        return None
+
+    def _scan_container(self, i: int) -> Optional[int]:
+        """End index (exclusive) of the object/array starting at i, None if incomplete"""
+        buf = self._buffer
+        depth = 0
+        j = i
+        while j < len(buf):
+            c = buf[j]
+            if c == '"':
+                end = self._scan_string(j)
+                if end is None:
+                    return None
+                j = end
+                continue
+            if c in '{[':
+                depth += 1
+            elif c in '}]':
+                depth -= 1
+                if depth == 0:
+                    return j + 1
+            j += 1
+        return None
+
+    def _scan_value(self, i: int) -> Optional[int]:
+        buf = self._buffer
+        c = buf[i]
+        if c == '"':
+            return self._scan_string(i)
+        if c in '{[':
+            return self._scan_container(i)
+        # Numeri e letterali: completi solo quando segue un delimitatore
+        j = i
+        while j < len(buf) and buf[j] not in _SCALAR_END:
+            j += 1
+        return j if j < len(buf) else None
+
+    def _next_field(self) -> Optional[Tuple[str, Any]]:
+        buf = self._buffer
+        i = self._pos
+
+        if not self._started:
+            # Salta eventuale testo prima dell'oggetto (es. ```json)
+            start = buf.find('{', i)
+            if start < 0:
+                self._pos = len(buf)
+                return None
+            self._started = True
+            i = start + 1
+            self._pos = i
+
+        i = self._skip(i, _WHITESPACE + ',')
+        if i >= len(buf):
+            return None
+        if buf[i] == '}':
+            self.complete = True
+            self._pos = i + 1
+            return None
+        if buf[i] != '"':
+            # Non è JSON valido: lascia che sia il parser completo a gestirlo
+            self.complete = True
+            return None
+
+        key_end = self._scan_string(i)
+        if key_end is None:
+            return None
+        colon = self._skip(key_end, _WHITESPACE)
+        if colon >= len(buf):
+            return None
+        if buf[colon] != ':':
+            self.complete = True
+            return None
+        value_start = self._skip(colon + 1, _WHITESPACE)
+        if value_start >= len(buf):
+            return None
+        value_end = self._scan_value(value_start)
+        if value_end is None:
+            return None
+
+        try:
+            key = json.loads(buf[i:key_end])
+            value = json.loads(buf[value_start:value_end])
+        except ValueError:
+            self.complete = True
+            return None
+
+        self._pos = value_end
+        return key, value
@@ -0,0 +1,390 @@
+"""
+Multi-provider routing for ticket analysis.
+
+Wraps several TicketProcessorSimple instances (e.g. Groq and a local Ollama),
+keeps rolling latency and error statistics per provider/model, sends each
+request to the fastest healthy one, fails over on timeouts and 429s and can
+optionally hedge slow requests to a second provider.
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.message import Message
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from modules.rate_limiter import DEFAULT_MAX_WAIT
+from modules.timeseries import get_timeseries
+from modules.tracing import span
+from modules.prom_metrics import LLM_ERRORS
+from modules.ticket_processor_simple import LLMProviderError, TicketProcessorSimple
+
+logger = logging.getLogger(__name__)
+
+# Campioni considerati per latenza e tasso di errore
+DEFAULT_WINDOW = 50
+# Oltre questo tasso di errore il provider è considerato non sano
+MAX_ERROR_RATE = 0.5
+# Pausa dopo un 429 senza Retry-After, o dopo timeout/errori di connessione
+RATE_LIMIT_COOLDOWN = 30.0
+FAILURE_COOLDOWN = 10.0
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class ProviderStats:
+    """Rolling latency/error window of one provider"""
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self.cooldown_until = 0.0
+        self.last_error: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+            self._outcomes.append(True)
+
+    def record_failure(self, error: Exception, cooldown: float = 0.0) -> None:
+        with self._lock:
+            self._outcomes.append(False)
+            self.last_error = str(error)
+            if cooldown:
+                self.cooldown_until = max(self.cooldown_until, time.monotonic() + cooldown)
+
+    @property
+    def samples(self) -> int:
+        return len(self._outcomes)
+
+    @property
+    def error_rate(self) -> float:
+        with self._lock:
+            return 1 - sum(self._outcomes) / len(self._outcomes) if self._outcomes else 0.0
+
+    def latency(self, pct: float) -> Optional[float]:
+        with self._lock:
+            values = sorted(self._latencies)
+        return _percentile(values, pct) if values else None
+
+    @property
+    def cooling_down(self) -> bool:
+        return time.monotonic() < self.cooldown_until
+
+    @property
+    def healthy(self) -> bool:
+        return not self.cooling_down and self.error_rate <= MAX_ERROR_RATE
+
+    def snapshot(self) -> Dict:
+        p50, p95 = self.latency(50), self.latency(95)
+        return {
+            'samples': self.samples,
+            'p50_ms': round(p50 * 1000) if p50 is not None else None,
+            'p95_ms': round(p95 * 1000) if p95 is not None else None,
+            'error_rate': round(self.error_rate, 3),
+            'healthy': self.healthy,
+            'cooldown_s': round(max(0.0, self.cooldown_until - time.monotonic()), 1),
+            'last_error': self.last_error,
+        }
+
+
+def provider_name(processor: TicketProcessorSimple) -> str:
+    return f"{processor.provider}:{processor.model}"
+
+
+class LLMRouter:
+    """
+    Drop-in replacement for TicketProcessorSimple that routes across providers.
+
+    Providers are ranked by health, then by rolling p50 latency; providers
+    without samples keep their configured order so each one is probed.
+    """
+
+    def __init__(
+        self,
+        processors: List[TicketProcessorSimple],
+        hedge_after: Optional[float] = None,
+        window: int = DEFAULT_WINDOW
+    ):
+        """
+        Args:
+            processors: Candidate processors, in preference order
+            hedge_after: Seconds after which a slow request is duplicated on the
+                next provider (None = no hedging, 0 = use the primary's p95)
+            window: Number of recent calls kept per provider
+        """
+        if not processors:
+            raise ValueError("LLMRouter needs at least one processor")
+        self.processors = processors
+        self.hedge_after = hedge_after
+        self.stats = {provider_name(p): ProviderStats(window) for p in processors}
+        self._executor = ThreadPoolExecutor(max_workers=2 * len(processors), thread_name_prefix="llm-hedge")
+
+    # Interfaccia comune con TicketProcessorSimple
+    @property
+    def provider(self) -> str:
+        return self.ranked()[0].provider
+
+    @property
+    def model(self) -> str:
+        return self.ranked()[0].model
+
+    def ranked(self) -> List[TicketProcessorSimple]:
+        """Processors from best to worst"""
+        def key(item):
+            index, processor = item
+            stats = self.stats[provider_name(processor)]
+            p50 = stats.latency(50)
+            return (not stats.healthy, p50 is not None, p50 or 0.0, index)
+        return [p for _, p in sorted(enumerate(self.processors), key=key)]
+
+    @staticmethod
+    def _stream(processor: TicketProcessorSimple, on_route: Callable[[Dict, Dict], None], subject: str,
+                body: str, pdf_content: str, reparti: List[Dict[str, str]],
+                email_id: Optional[str] = None) -> Optional[Dict]:
+        """Streamed analysis on one provider, passing the early route to on_route"""
+        result = None
+        for event, data in processor.analyze_email_stream(subject, body, pdf_content, reparti, email_id,
+                                                          raise_on_error=True):
+            if event == 'route':
+                reparto = processor.get_reparto_details(data['reparto_suggerito'], reparti)
+                if reparto:
+                    on_route(data, reparto)
+            else:
+                result = data
+        return result
+
+    def _call(self, processor: TicketProcessorSimple, *args, email_id: Optional[str] = None,
+              on_route: Optional[Callable[[Dict, Dict], None]] = None) -> Optional[Dict]:
+        """Run one provider (streamed if on_route is given) and record the outcome"""
+        stats = self.stats[provider_name(processor)]
+        start = time.monotonic()
+        try:
+            with span('llm', provider=provider_name(processor)):
+                if on_route is None:
+                    result = processor.analyze_email(*args, raise_on_error=True, email_id=email_id)
+                else:
+                    result = self._stream(processor, on_route, *args, email_id=email_id)
+        except LLMProviderError as e:
+            if e.is_rate_limit:
+                cooldown = e.retry_after or RATE_LIMIT_COOLDOWN
+            elif e.status_code is None or e.status_code >= 500:
+                cooldown = FAILURE_COOLDOWN
+            else:
+                cooldown = 0.0
+            stats.record_failure(e, cooldown)
+            kind = 'rate_limit' if e.is_rate_limit else 'error'
+            get_timeseries().increment('llm_errors', provider=provider_name(processor), kind=kind)
+            LLM_ERRORS.inc(provider=provider_name(processor), kind=kind)
+            logger.warning(f"⚠️ {provider_name(processor)} failed ({e}), cooldown {cooldown:.0f}s")
+            return None
+
+        if result is None:
+            stats.record_failure(ValueError("invalid or incomplete response"))
+            get_timeseries().increment('llm_errors', provider=provider_name(processor), kind='invalid')
+            LLM_ERRORS.inc(provider=provider_name(processor), kind='invalid')
+            return None
+        latency = time.monotonic() - start
+        stats.record_success(latency)
+        get_timeseries().observe('llm_latency', latency, provider=provider_name(processor))
+        result['provider'] = provider_name(processor)
+        result['latency_ms'] = round(latency * 1000)
+        return result
+
+    def _hedge_delay(self, processor: TicketProcessorSimple) -> Optional[float]:
+        if self.hedge_after is None:
+            return None
+        if self.hedge_after > 0:
+            return self.hedge_after
+        return self.stats[provider_name(processor)].latency(95)
+
+    def analyze_email(
+        self,
+        subject: str,
+        body: str,
+        pdf_content: str,
+        reparti: List[Dict[str, str]],
+        email_id: Optional[str] = None
+    ) -> Optional[Dict]:
+        """
+        Analyze email on the best provider, failing over (and hedging) as needed.
+
+        Args:
+            email_id: Id of a stored email, excluded from the similar past tickets
+
+        Returns:
+            Same dict as TicketProcessorSimple.analyze_email plus 'provider'
+            and 'latency_ms', or None if every provider failed
+        """
+        args = (subject, body, pdf_content, reparti)
+        candidates = self.ranked()
+
+        while candidates:
+            primary = candidates.pop(0)
+            delay = self._hedge_delay(primary)
+            if delay is None or not candidates:
+                result = self._call(primary, *args, email_id=email_id)
+                if result is not None:
+                    return result
+                continue
+
+            pending = {self._executor.submit(contextvars.copy_context().run, self._call, primary, *args,
+                                            email_id=email_id)}
+            done, _ = wait(pending, timeout=delay)
+            if not done:
+                backup = candidates.pop(0)
+                logger.info(f"⏱️ {provider_name(primary)} slower than {delay:.1f}s, "
+                            f"hedging on {provider_name(backup)}")
+                pending.add(self._executor.submit(contextvars.copy_context().run, self._call, backup, *args,
+                                                email_id=email_id))
+
+            # Primo risultato valido; l'altra richiesta termina in background
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if result is not None:
+                        return result
+
+        logger.error("❌ All LLM providers failed")
+        return None
+
+    def prepare_departments(self, reparti: List[Dict[str, str]]) -> None:
+        """Pre-render the departments block on every provider"""
+        for processor in self.processors:
+            processor.prepare_departments(reparti)
+
+    def get_reparto_details(
+        self,
+        reparto_nome: str,
+        reparti: List[Dict[str, str]]
+    ) -> Optional[Dict[str, str]]:
+        """Find department details by name"""
+        return self.processors[0].get_reparto_details(reparto_nome, reparti)
+
+    def process_ticket(
+        self,
+        email_message: Message,
+        subject: str,
+        body: str,
+        pdf_content: str,
+        reparti: List[Dict[str, str]],
+        on_route: Optional[Callable[[Dict, Dict], None]] = None,
+        email_id: Optional[str] = None
+    ) -> Tuple[Optional[Dict], Optional[Dict]]:
+        """
+        Process ticket: analyze and determine routing.
+
+        With on_route the streamed completion of the best provider is used
+        (no hedging); on failure the next provider is tried, with the same
+        cooldowns as analyze_email (Retry-After on 429s). The early route
+        is a preview only, forwarding waits for the returned analysis.
+
+        Returns:
+            Tuple (analysis_result, department_details) or (None, None) on error
+        """
+        try:
+            if on_route is None:
+                analysis = self.analyze_email(subject, body, pdf_content, reparti, email_id)
+            else:
+                analysis = None
+                routed = []
+
+                def route_once(route, reparto):
+                    if not routed:
+                        routed.append(route)
+                        on_route(route, reparto)
+
+                for processor in self.ranked():
+                    analysis = self._call(processor, subject, body, pdf_content, reparti,
+                                          email_id=email_id, on_route=route_once)
+                    if analysis:
+                        break
+
+            if not analysis:
+                return None, None
+
+            reparto = self.get_reparto_details(analysis['reparto_suggerito'], reparti)
+            if not reparto:
+                logger.error(f"Department not found: {analysis['reparto_suggerito']}")
+                return analysis, None
+
+            return analysis, reparto
+
+        except Exception as e:
+            logger.error(f"Ticket processing error: {e}", exc_info=True)
+            return None, None
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """Rolling statistics per provider"""
+        return {name: stats.snapshot() for name, stats in self.stats.items()}
+
+
+# Settings create_router depends on
+ROUTER_CONFIG_KEYS = ('GROQ_API_KEY', 'GROQ_MODEL', 'OLLAMA_URL', 'OLLAMA_MODEL',
+                      'LLM_PROVIDER_ORDER', 'LLM_TIMEOUT', 'LLM_HEDGE_AFTER')
+
+
+def create_router(
+    config_get: Callable,
+    default_ollama_model: str = 'llama3.1',
+    history_index=None
+) -> LLMRouter:
+    """
+    Build a router from configuration values.
+
+    Keys: GROQ_API_KEY/GROQ_MODEL, OLLAMA_URL/OLLAMA_MODEL, LLM_PROVIDER_ORDER
+    (e.g. "ollama,groq"), LLM_TIMEOUT and LLM_HEDGE_AFTER (seconds, empty =
+    disabled, 0 = primary's p95).
+
+    Args:
+        config_get: Getter like ConfigManager.get(key, default)
+        default_ollama_model: Ollama model when OLLAMA_MODEL is not set
+        history_index: Optional TicketHistoryIndex shared by all providers
+    """
+    timeout = float(config_get('LLM_TIMEOUT', 30) or 30)
+    # Con più provider conviene passare al successivo invece di attendere la quota
+    rate_limit_wait = 5.0 if config_get('GROQ_API_KEY', '') and config_get('OLLAMA_URL', '') else DEFAULT_MAX_WAIT
+    available = {}
+
+    groq_key = config_get('GROQ_API_KEY', '')
+    if groq_key:
+        available['groq'] = TicketProcessorSimple(
+            api_key=groq_key,
+            provider="groq",
+            model=config_get('GROQ_MODEL', 'llama-3.1-8b-instant'),
+            timeout=timeout,
+            rate_limit_wait=rate_limit_wait,
+            history_index=history_index
+        )
+
+    ollama_url = config_get('OLLAMA_URL', '')
+    if ollama_url:
+        available['ollama'] = TicketProcessorSimple(
+            api_key="ollama",
+            provider="ollama",
+            model=config_get('OLLAMA_MODEL', default_ollama_model),
+            api_base=ollama_url,
+            timeout=timeout,
+            history_index=history_index
+        )
+
+    if not available:
+        raise Exception("Configure GROQ_API_KEY (free at console.groq.com) or OLLAMA_URL")
+
+    order = [p.strip().lower() for p in (config_get('LLM_PROVIDER_ORDER', '') or 'groq,ollama').split(',')]
+    processors = [available[p] for p in order if p in available]
+    processors += [p for name, p in available.items() if name not in order]
+
+    hedge_after = config_get('LLM_HEDGE_AFTER', '')
+    hedge_after = float(hedge_after) if hedge_after not in ('', None) else None
+
+    logger.info(f"✅ LLM router: {', '.join(provider_name(p) for p in processors)}"
+                f"{f' (hedge after {hedge_after}s)' if hedge_after is not None else ''}")
+    return LLMRouter(processors, hedge_after=hedge_after)
@@ -0,0 +1,211 @@
+"""
+Schemas of every JSON object the LLMs are asked to produce.
+
+One registry is the single source of truth for:
+- the JSON Schema sent to providers that support constrained decoding
+  (Ollama `format` / `response_format: json_schema`, Groq `json_object`)
+- tolerant parsing of the completion (code fences, surrounding text,
+  trailing commas, Python literals, truncated output)
+- validation and coercion, reporting which fields are still missing so
+  that a retry can ask for those fields only
+"""
+import ast
+import json
+import logging
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from modules.json_stream import IncrementalJSONParser
+
+logger = logging.getLogger(__name__)
+
+_FENCE_RE = re.compile(r'^\s*```(?:json|JSON)?\s*|\s*```\s*$')
+_TRAILING_COMMA_RE = re.compile(r',\s*([}\]])')
+_NUMBER_RE = re.compile(r'-?\d+(?:[.,]\d+)?')
+_PY_LITERALS = {'true': 'True', 'false': 'False', 'null': 'None'}
+_PY_LITERAL_RE = re.compile(r'\b(true|false|null)\b')
+
+
+@dataclass(frozen=True)
+class FieldSpec:
+    """One field of an LLM output object"""
+    name: str
+    type: str = 'string'  # 'string' | 'number'
+    required: bool = True
+    description: str = ''
+    max_length: Optional[int] = None
+    minimum: Optional[float] = None
+    maximum: Optional[float] = None
+
+    def json_schema(self) -> Dict[str, Any]:
+        schema: Dict[str, Any] = {'type': 'integer' if self.type == 'number' else 'string'}
+        if self.description:
+            schema['description'] = self.description
+        if self.minimum is not None:
+            schema['minimum'] = self.minimum
+        if self.maximum is not None:
+            schema['maximum'] = self.maximum
+        return schema
+
+    def coerce(self, value: Any) -> Any:
+        """Normalized value, or None if it cannot be used"""
+        if value is None:
+            return None
+        if self.type == 'number':
+            if isinstance(value, bool):
+                return None
+            if isinstance(value, str):
+                match = _NUMBER_RE.search(value)  # es. "85%"
+                if not match:
+                    return None
+                value = float(match.group(0).replace(',', '.'))
+            if not isinstance(value, (int, float)):
+                return None
+            if self.minimum is not None and value < self.minimum:
+                value = self.minimum
+            if self.maximum is not None and value > self.maximum:
+                value = self.maximum
+            return int(round(value))
+
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, ensure_ascii=False)
+        value = str(value).strip()
+        if not value:
+            return None
+        if self.max_length and len(value) > self.max_length:
+            value = value[:self.max_length].rstrip()
+        return value
+
+
+@dataclass(frozen=True)
+class LLMSchema:
+    """Expected shape of one kind of LLM output"""
+    name: str
+    fields: Tuple[FieldSpec, ...]
+    description: str = ''
+
+    @property
+    def required(self) -> List[str]:
+        return [f.name for f in self.fields if f.required]
+
+    def json_schema(self, only: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+        """JSON Schema of the object (optionally restricted to some fields)"""
+        fields = [f for f in self.fields if only is None or f.name in only]
+        return {
+            'type': 'object',
+            'properties': {f.name: f.json_schema() for f in fields},
+            'required': [f.name for f in fields if f.required],
+        }
+
+    def validate(self, data: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+        """
+        Coerce known fields and report missing/invalid required ones.
+
+        Unknown keys are kept unchanged.
+
+        Returns:
+            Tuple (cleaned object, names of missing required fields)
+        """
+        cleaned = dict(data)
+        missing = []
+        for spec in self.fields:
+            value = spec.coerce(data.get(spec.name))
+            if value is None:
+                cleaned.pop(spec.name, None)
+                if spec.required:
+                    missing.append(spec.name)
+            else:
+                cleaned[spec.name] = value
+        return cleaned, missing
+
+    def parse(self, text: str) -> Tuple[Dict[str, Any], List[str]]:
+        """Tolerant parse + validate of a completion"""
+        return self.validate(parse_json_lenient(text))
+
+
+def parse_json_lenient(text: str) -> Dict[str, Any]:
+    """
+    Parse a JSON object from an LLM completion, repairing common defects.
+
+    Tries in order: plain json.loads, the outermost {...} with fences and
+    trailing commas removed, Python literal syntax (single quotes), and
+    finally the complete fields of a truncated object.
+
+    Returns:
+        The parsed object ({} if nothing could be recovered)
+    """
+    if not text:
+        return {}
+    text = text.strip()
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict):
+            return data
+    except ValueError:
+        pass
+
+    candidate = _FENCE_RE.sub('', text)
+    start, end = candidate.find('{'), candidate.rfind('}')
+    if start >= 0 and end > start:
+        candidate = _TRAILING_COMMA_RE.sub(r'\1', candidate[start:end + 1])
+        try:
+            data = json.loads(candidate)
+            if isinstance(data, dict):
+                return data
+        except ValueError:
+            pass
+        try:
+            data = ast.literal_eval(_PY_LITERAL_RE.sub(lambda m: _PY_LITERALS[m.group(1)], candidate))
+            if isinstance(data, dict):
+                return data
+        except (ValueError, SyntaxError):
+            pass
+
+    # Output troncato (es. max_tokens): recupera i campi completi
+    parser = IncrementalJSONParser()
+    parser.feed(text)
+    if parser.fields:
+        logger.warning(f"Recovered {len(parser.fields)} fields from malformed JSON")
+    return parser.fields
+
+
+def missing_fields_prompt(schema: LLMSchema, missing: Sequence[str]) -> str:
+    """Follow-up instruction asking only for the missing fields"""
+    properties = json.dumps(schema.json_schema(only=missing)['properties'], ensure_ascii=False)
+    return (
+        f"Your previous answer is missing these fields: {', '.join(missing)}. "
+        f"Respond ONLY with a JSON object containing exactly these fields: {properties}"
+    )
+
+
+# ----- Registry -----
+
+DEPARTMENT_ROUTING = LLMSchema(
+    name='department_routing',
+    description='Department routing of a support email (TicketProcessorSimple)',
+    fields=(
+        FieldSpec('reparto_suggerito', description='Exact name of one of the listed departments'),
+        FieldSpec('confidence', type='number', minimum=0, maximum=100, description='Confidence 0-100'),
+        FieldSpec('summary', max_length=200, description='Brief problem summary (max 100 characters)'),
+        FieldSpec('reasoning', required=False, max_length=300, description='Choice reasoning (max 150 characters)'),
+    ),
+)
+
+GEO_TICKET = LLMSchema(
+    name='geo_ticket',
+    description='Technical assistance request with address (route_mail)',
+    fields=(
+        FieldSpec('summary', description="Riassunto della richiesta o 'not found'"),
+        FieldSpec('equipment', description="Apparecchiatura guasta o 'not found'"),
+        FieldSpec('address', description="Indirizzo dell'intervento con ', Italy' o 'not found'"),
+        FieldSpec('confidence', type='number', minimum=0, maximum=100, description='Confidenza 0-100'),
+    ),
+)
+
+SCHEMAS: Dict[str, LLMSchema] = {s.name: s for s in (DEPARTMENT_ROUTING, GEO_TICKET)}
+
+
+def get_schema(name: str) -> LLMSchema:
+    """Schema by name (KeyError if unknown)"""
+    return SCHEMAS[name]
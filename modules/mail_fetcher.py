@@ -8,9 +8,67 @@ from email.message import Message
 from typing import List, Tuple, Dict, Optional
 import logging
 
+from modules.parsed_message import parse_message
+from modules.imap_actions import UID_ATTR, quote_mailbox
+from modules.message_state import ANALYZED, FAILED, FETCHED
+
 logger = logging.getLogger(__name__)
 
 
+def fetch_unseen(mail, folder: str = 'INBOX', state=None, limit: Optional[int] = None) -> List[Message]:
+    """
+    Fetch unread emails of a folder with BODY.PEEK, so they stay unseen until forwarded.
+
+    With a MessageStateStore only UIDs above its watermark are searched,
+    plus the messages an interrupted run left fetched or analyzed; each
+    message is recorded as fetched.
+
+    Args:
+        mail: Logged-in IMAP connection
+        folder: Folder to select
+        state: Optional MessageStateStore of this folder
+        limit: Max new messages per call (the rest is picked up next time)
+
+    Returns:
+        Messages, each with its UID in the imap_uid attribute
+    """
+    email_messages = []
+    status, data = mail.select(quote_mailbox(folder))
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"SELECT {folder} failed: {data}")
+
+    criteria = ['UNSEEN']
+    if state is not None:
+        _, data = mail.response('UIDVALIDITY')
+        watermark = state.open(int(data[0]))
+        criteria += ['UID', f'{watermark + 1}:*']
+    status, messages = mail.uid('SEARCH', None, *criteria)
+    if status != 'OK':
+        return email_messages
+
+    uids = messages[0].split()
+    recovered = []
+    if state is not None:
+        # 'n:*' restituisce sempre almeno l'ultimo UID, anche se < n
+        recovered = [str(u).encode() for u in state.in_state(FETCHED, ANALYZED)]
+        uids = [u for u in uids if int(u) > watermark]
+    if limit is not None:
+        uids = sorted(uids, key=int)[:limit]
+    for uid in recovered + uids:
+        status, data = mail.uid('FETCH', uid, '(BODY.PEEK[])')
+        if status == 'OK' and data and isinstance(data[0], tuple):
+            email_message = email.message_from_bytes(data[0][1])
+            # UID per archiviare il messaggio dopo l'inoltro (vedi imap_actions)
+            setattr(email_message, UID_ATTR, uid.decode())
+            if state is None or state.fetched(uid, email_message.get('Message-ID')):
+                email_messages.append(email_message)
+        elif uid in recovered:
+            state.set(uid, FAILED, error="message no longer on the server")
+        if state is not None:
+            state.advance(uid)
+    return email_messages
+
+
 class MailFetcher:
     """Manages retrieval of unread emails from an IMAP server"""
     
@@ -21,7 +79,7 @@ class MailFetcher:
     
     def fetch_unread_emails(self) -> List[Tuple[Message, Dict[str, str]]]:
         """
-        Retrieve all unread emails
+        Retrieve all unread emails without marking them as seen
         
         Returns:
             List of tuples (message, metadata) where metadata contains:
@@ -29,6 +87,7 @@ class MailFetcher:
             - subject: subject
             - date: date
             - body: message body
+            - uid: IMAP UID (for the post-routing actions of ImapActions)
         """
         emails = []
         
@@ -38,8 +97,8 @@ class MailFetcher:
             mail.login(self.email_user, self.email_password)
             mail.select('inbox')
             
-            # Search unread emails
-            status, messages = mail.search(None, 'UNSEEN')
+            # Search unread emails (by UID, stable across sessions)
+            status, messages = mail.uid('SEARCH', None, 'UNSEEN')
             
             if status != 'OK':
                 logger.error("Error searching unread emails")
@@ -47,8 +106,9 @@ class MailFetcher:
             
             email_ids = messages[0].split()
             
-            for email_id in email_ids:
-                status, msg_data = mail.fetch(email_id, '(RFC822)')
+            for uid in email_ids:
+                # PEEK: resta non letta finché non viene inoltrata e archiviata
+                status, msg_data = mail.uid('FETCH', uid, '(BODY.PEEK[])')
                 
                 if status != 'OK':
                     continue
@@ -68,7 +128,8 @@ class MailFetcher:
                     'from': from_addr,
                     'subject': subject,
                     'date': date_str,
-                    'body': body
+                    'body': body,
+                    'uid': uid.decode()
                 }
                 
                 emails.append((msg, metadata))
@@ -99,128 +160,4 @@ class MailFetcher:
     
     def _extract_body(self, msg: Message) -> str:
         """Extract message body (prefers plain text, converts HTML if needed)"""
-        body = ""
-        html_body = ""
-        
-        if msg.is_multipart():
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                content_disposition = str(part.get('Content-Disposition', ''))
-                
-                # Raccogli sia text/plain che text/html
-                if content_type == 'text/plain' and 'attachment' not in content_disposition:
-                    try:
-                        payload = part.get_payload(decode=True)
-                        if payload:
-                            decoded = payload.decode('utf-8', errors='ignore')
-                            # Controlla se è un messaggio "HTML not supported"
-                            if not self._is_html_fallback_message(decoded):
-                                body = decoded
-                    except Exception as e:
-                        logger.warning(f"Error decoding text/plain part: {e}")
-                
-                # Salva sempre HTML se disponibile
-                elif content_type == 'text/html' and 'attachment' not in content_disposition:
-                    try:
-                        payload = part.get_payload(decode=True)
-                        if payload:
-                            html_body = payload.decode('utf-8', errors='ignore')
-                    except Exception as e:
-                        logger.warning(f"Error decoding text/html part: {e}")
-        else:
-            try:
-                payload = msg.get_payload(decode=True)
-                if payload:
-                    # Controlla se è HTML
-                    content_type = msg.get_content_type()
-                    decoded = payload.decode('utf-8', errors='ignore')
-                    
-                    if content_type == 'text/html':
-                        html_body = decoded
-                    else:
-                        body = decoded
-            except Exception as e:
-                logger.warning(f"Error decoding message: {e}")
-        
-        # Se abbiamo solo HTML, convertiamolo in testo
-        if not body and html_body:
-            body = self._html_to_text(html_body)
-        
-        return body.strip()
-    
-    def _is_html_fallback_message(self, text: str) -> bool:
-        """Check if text is just a fallback message for HTML emails"""
-        text_lower = text.lower().strip()
-        
-        # Messaggi comuni che indicano che il contenuto reale è in HTML
-        fallback_indicators = [
-            "email client might not support html",
-            "this email requires html",
-            "view this email in a browser",
-            "view in browser",
-            "open this email in another email client",
-            "html formatted email",
-            "enable html to view"
-        ]
-        
-        # Se il testo è molto corto e contiene uno di questi indicatori, è un fallback
-        if len(text) < 500:  # Messaggi di fallback sono tipicamente brevi
-            for indicator in fallback_indicators:
-                if indicator in text_lower:
-                    return True
-        
-        return False
-    
-    def _html_to_text(self, html_content: str) -> str:
-        """Convert HTML to plain text"""
-        try:
-            from html.parser import HTMLParser
-            import re
-            
-            class HTMLTextExtractor(HTMLParser):
-                def __init__(self):
-                    super().__init__()
-                    self.text = []
-                    self.skip_tags = {'script', 'style', 'head', 'title', 'meta', '[document]'}
-                    self.current_tag = None
-                
-                def handle_starttag(self, tag, attrs):
-                    self.current_tag = tag
-                    # Aggiungi spazio dopo link
-                    if tag == 'a':
-                        for attr, value in attrs:
-                            if attr == 'href':
-                                self.text.append(f' ')
-                
-                def handle_endtag(self, tag):
-                    self.current_tag = None
-                    # Aggiungi nuova riga dopo elementi blocco
-                    if tag in {'p', 'div', 'br', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}:
-                        self.text.append('\n')
-                
-                def handle_data(self, data):
-                    if self.current_tag not in self.skip_tags:
-                        text = data.strip()
-                        if text:
-                            self.text.append(text + ' ')
-            
-            parser = HTMLTextExtractor()
-            parser.feed(html_content)
-            text = ''.join(parser.text)
-            
-            # Pulisci il testo
-            text = re.sub(r'\n\s*\n', '\n\n', text)  # Rimuovi righe vuote multiple
-            text = re.sub(r' +', ' ', text)  # Rimuovi spazi multipli
-            text = text.strip()
-            
-            return text
-            
-        except Exception as e:
-            logger.warning(f"Error converting HTML to text: {e}")
-            # Fallback: rimozione tag HTML con regex
-            import re
-            text = re.sub(r'<style[^>]*>.*?</style>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-            text = re.sub(r'<script[^>]*>.*?</script>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-            text = re.sub(r'<[^>]+>', '', text)
-            text = re.sub(r'\s+', ' ', text)
-            return text.strip()
+        return parse_message(msg).body_text
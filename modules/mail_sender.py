@@ -8,6 +8,8 @@ from email.mime.application import MIMEApplication
 import logging
 from typing import Optional
 
+from modules.parsed_message import parse_message
+
 logger = logging.getLogger(__name__)
 
 
@@ -94,21 +96,13 @@ Subject: {original_subject}
             # Attach PDF if present in original email
             if email_message:
                 pdf_count = 0
-                for part in email_message.walk():
-                    # Check if PDF
-                    is_pdf = (part.get_content_type() == 'application/pdf' or 
-                             (part.get_content_type() == 'application/octet-stream' and 
-                              part.get_filename() and part.get_filename().lower().endswith('.pdf')))
-                    
-                    if is_pdf:
-                        pdf_data = part.get_payload(decode=True)
-                        if pdf_data:
-                            filename = part.get_filename() or f"attachment_{pdf_count}.pdf"
-                            pdf_attachment = MIMEApplication(pdf_data, _subtype="pdf")
-                            pdf_attachment.add_header('Content-Disposition', 'attachment', filename=filename)
-                            fwd_msg.attach(pdf_attachment)
-                            pdf_count += 1
-                            logger.info(f"PDF attachment added: {filename}")
+                for attachment in parse_message(email_message).pdf_attachments:
+                    filename = attachment.filename or f"attachment_{pdf_count}.pdf"
+                    pdf_attachment = MIMEApplication(attachment.payload, _subtype="pdf")
+                    pdf_attachment.add_header('Content-Disposition', 'attachment', filename=filename)
+                    fwd_msg.attach(pdf_attachment)
+                    pdf_count += 1
+                    logger.info(f"PDF attachment added: {filename}")
                 
                 if pdf_count > 0:
                     logger.info(f"Total PDF attachments: {pdf_count}")
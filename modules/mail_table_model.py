@@ -0,0 +1,223 @@
+"""
+Sorted, filtered model of the GUI mail table.
+
+Holds one small MailRow per email (no message bodies or attachments) and
+keeps the visible order incrementally: inserts and updates are placed with
+a binary search instead of re-sorting, and a filter that narrows the
+previous one only scans the rows currently shown. The view is exposed by
+index so the widget can render just the rows on screen.
+"""
+import bisect
+import itertools
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+COLUMNS = ("Sender", "Subject", "Date", "Department", "Status")
+NOT_PROCESSED = "Not processed"
+
+# Colonna -> attributo di MailRow usato per ordinare
+_SORT_ATTRS = {
+    "Sender": 'sender',
+    "Subject": 'subject',
+    "Date": 'received',
+    "Department": 'department',
+    "Status": 'status',
+}
+_FILTER_ATTRS = ('sender', 'subject', 'department', 'status')
+
+
+@dataclass
+class MailRow:
+    """Lightweight summary of an email shown in the table"""
+    key: str  # chiave stabile, usata anche come iid del Treeview
+    mail_id: str  # chiave nel RawMessageStore
+    sender: str
+    subject: str
+    date: str  # header Date originale
+    received: str  # 'YYYY-mm-dd HH:MM:SS' di quando è stata scaricata
+    department: str = ""
+    status: str = NOT_PROCESSED
+    preview: str = ""
+    uid: str = ""  # UID IMAP del messaggio sorgente
+    message_id: str = ""  # header Message-ID, chiave del ticket
+    _seq: int = field(default=0, repr=False)
+
+    def values(self) -> Tuple[str, ...]:
+        return (self.sender[:40], self.subject[:50], self.received[:16], self.department, self.status)
+
+    def matches(self, text: str) -> bool:
+        return not text or any(text in getattr(self, a).casefold() for a in _FILTER_ATTRS)
+
+
+class MailTableModel:
+    """Rows by key plus an incrementally maintained sorted/filtered view"""
+
+    def __init__(self, sort_column: str = "Date", descending: bool = True):
+        self._rows: Dict[str, MailRow] = {}
+        self._by_mail_id: Dict[str, str] = {}
+        self._seq = itertools.count()
+        self.sort_column = sort_column
+        self.descending = descending
+        self.filter_text = ""
+        # Vista in ordine crescente di (valore, seq); descending inverte gli indici
+        self._view_keys: List[Tuple[str, int]] = []
+        self._view: List[str] = []
+
+    # ----- Accesso -----
+
+    def __len__(self) -> int:
+        """Rows in the current view"""
+        return len(self._view)
+
+    @property
+    def total(self) -> int:
+        return len(self._rows)
+
+    def get(self, key: str) -> Optional[MailRow]:
+        return self._rows.get(key)
+
+    def has_mail(self, mail_id: str) -> bool:
+        return mail_id in self._by_mail_id
+
+    def slice(self, start: int, stop: int) -> List[MailRow]:
+        """Rows at view positions [start, stop)"""
+        n = len(self._view)
+        start, stop = max(0, start), min(n, stop)
+        if start >= stop:
+            return []
+        if self.descending:
+            keys = self._view[n - stop:n - start][::-1]
+        else:
+            keys = self._view[start:stop]
+        return [self._rows[k] for k in keys]
+
+    def index_of(self, key: str) -> Optional[int]:
+        """View position of a row, None if filtered out"""
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        pos = self._find(row)
+        if pos is None:
+            return None
+        return len(self._view) - 1 - pos if self.descending else pos
+
+    # ----- Vista -----
+
+    def _sort_key(self, row: MailRow) -> Tuple[str, int]:
+        return (getattr(row, _SORT_ATTRS[self.sort_column]).casefold(), row._seq)
+
+    def _find(self, row: MailRow) -> Optional[int]:
+        sort_key = self._sort_key(row)
+        pos = bisect.bisect_left(self._view_keys, sort_key)
+        if pos < len(self._view_keys) and self._view_keys[pos] == sort_key:
+            return pos
+        return None
+
+    def _insert_view(self, row: MailRow) -> None:
+        sort_key = self._sort_key(row)
+        pos = bisect.bisect_left(self._view_keys, sort_key)
+        self._view_keys.insert(pos, sort_key)
+        self._view.insert(pos, row.key)
+
+    def _remove_view(self, row: MailRow) -> None:
+        pos = self._find(row)
+        if pos is not None:
+            del self._view_keys[pos]
+            del self._view[pos]
+
+    def _rebuild(self, rows: Iterable[MailRow]) -> None:
+        text = self.filter_text
+        pairs = sorted((self._sort_key(r), r.key) for r in rows if r.matches(text))
+        self._view_keys = [p[0] for p in pairs]
+        self._view = [p[1] for p in pairs]
+
+    def set_sort(self, column: str, descending: Optional[bool] = None) -> None:
+        """Sort by column; clicking the same column again flips the direction"""
+        if column not in _SORT_ATTRS:
+            raise ValueError(f"Unknown column '{column}'")
+        if descending is None:
+            descending = not self.descending if column == self.sort_column else False
+        if column != self.sort_column:
+            self.sort_column = column
+            self._rebuild(self._rows[k] for k in self._view)
+        self.descending = descending
+
+    def set_filter(self, text: str) -> None:
+        """Show only rows whose sender/subject/department/status contain text"""
+        text = text.strip().casefold()
+        if text == self.filter_text:
+            return
+        narrowing = self.filter_text in text
+        self.filter_text = text
+        if narrowing:
+            # Il nuovo filtro restringe il precedente: basta scorrere la vista
+            keep = [i for i, k in enumerate(self._view) if self._rows[k].matches(text)]
+            self._view_keys = [self._view_keys[i] for i in keep]
+            self._view = [self._view[i] for i in keep]
+        else:
+            self._rebuild(self._rows.values())
+
+    # ----- Modifiche -----
+
+    def _new_row(self, mail_id: str, sender: str, subject: str, date: str, received: str,
+                 preview: str = "", uid: str = "", message_id: str = "") -> Optional[MailRow]:
+        if mail_id in self._by_mail_id:
+            return None
+        seq = next(self._seq)
+        row = MailRow(f"m{seq}", mail_id, sender, subject, date, received, preview=preview, uid=uid,
+                      message_id=message_id, _seq=seq)
+        self._rows[row.key] = row
+        self._by_mail_id[mail_id] = row.key
+        return row
+
+    def add(self, mail_id: str, sender: str, subject: str, date: str, received: str,
+            preview: str = "", uid: str = "", message_id: str = "") -> Optional[MailRow]:
+        """Add an email; returns None if it is already in the table"""
+        row = self._new_row(mail_id, sender, subject, date, received, preview, uid, message_id)
+        if row is not None and row.matches(self.filter_text):
+            self._insert_view(row)
+        return row
+
+    def add_many(self, emails: Iterable[Dict[str, str]]) -> List[MailRow]:
+        """
+        Add several emails (dicts with the add() arguments); duplicates are skipped.
+
+        Large batches are merged with one sort instead of one insert per row.
+        """
+        rows = [r for r in (self._new_row(**e) for e in emails) if r is not None]
+        visible = [r for r in rows if r.matches(self.filter_text)]
+        if len(visible) > 64 and len(visible) * 8 > len(self._view):
+            pairs = sorted(list(zip(self._view_keys, self._view))
+                           + [(self._sort_key(r), r.key) for r in visible])
+            self._view_keys = [p[0] for p in pairs]
+            self._view = [p[1] for p in pairs]
+        else:
+            for row in visible:
+                self._insert_view(row)
+        return rows
+
+    def update(self, key: str, **fields) -> Optional[MailRow]:
+        """Change row fields (department, status...), keeping the view ordered"""
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        was_visible = self._find(row) is not None
+        if was_visible:
+            self._remove_view(row)
+        for name, value in fields.items():
+            setattr(row, name, value)
+        if row.matches(self.filter_text):
+            self._insert_view(row)
+        return row
+
+    def remove(self, keys: Iterable[str]) -> List[MailRow]:
+        """Remove rows; returns the removed ones"""
+        removed = []
+        for key in keys:
+            row = self._rows.pop(key, None)
+            if row is None:
+                continue
+            self._remove_view(row)
+            self._by_mail_id.pop(row.mail_id, None)
+            removed.append(row)
+        return removed
@@ -0,0 +1,242 @@
+"""
+Persistent processing state of IMAP messages.
+
+Messages are fetched with BODY.PEEK, so the server keeps them unseen until
+they are filed; this store records where each one is in the pipeline
+
+    fetched -> analyzed -> forwarded -> acknowledged
+       |              \\-> failed ----/
+       \\-> queued -> forwarded | failed   (processed by a queue worker)
+
+where "acknowledged" means its flags/move were committed on the server.
+After a crash, messages left fetched/analyzed are fetched again and those
+forwarded or failed but not acknowledged get their IMAP actions replayed,
+instead of being lost or forwarded twice. A per-mailbox UID watermark lets
+each check search only messages newer than the last one seen.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+FETCHED = 'fetched'
+QUEUED = 'queued'
+ANALYZED = 'analyzed'
+FORWARDED = 'forwarded'
+FAILED = 'failed'
+ACKNOWLEDGED = 'acknowledged'
+
+# Stati raggiungibili da ciascuno stato (fetched -> fetched: ripresa dopo un crash)
+_TRANSITIONS = {
+    None: {FETCHED},
+    FETCHED: {FETCHED, QUEUED, ANALYZED, FORWARDED, FAILED},
+    QUEUED: {FORWARDED, FAILED},
+    ANALYZED: {FETCHED, FORWARDED, FAILED},
+    FORWARDED: {ACKNOWLEDGED},
+    FAILED: {ACKNOWLEDGED},
+    ACKNOWLEDGED: set(),
+}
+
+DEFAULT_MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mailboxes (
+    mailbox TEXT PRIMARY KEY,
+    uidvalidity INTEGER NOT NULL,
+    last_uid INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    mailbox TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    message_id TEXT,
+    department TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (mailbox, uidvalidity, uid)
+);
+CREATE INDEX IF NOT EXISTS messages_state ON messages (mailbox, uidvalidity, state);
+"""
+
+
+class InvalidTransition(ValueError):
+    """A message was moved to a state it cannot reach from its current one"""
+
+
+class MessageStateStore:
+    """SQLite-backed state machine of the messages of one mailbox"""
+
+    def __init__(self, path: str = 'message_state.db', mailbox: str = 'INBOX',
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        """
+        Args:
+            path: SQLite database file
+            mailbox: Mailbox identifier (account and folder)
+            max_attempts: Fetches after which a message that never got past
+                analysis is marked failed instead of being retried again
+        """
+        self.path = path
+        self.mailbox = mailbox
+        self.max_attempts = max_attempts
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        row = self._conn.execute('SELECT uidvalidity, last_uid FROM mailboxes WHERE mailbox = ?',
+                                 (mailbox,)).fetchone()
+        self.uidvalidity, self._last_uid = row if row else (None, 0)
+
+    # ----- Mailbox -----
+
+    def open(self, uidvalidity: int) -> int:
+        """
+        Bind the store to the UIDVALIDITY reported by SELECT.
+
+        If it changed, the server renumbered the mailbox: the old UIDs and
+        the watermark are no longer valid and scanning restarts from zero.
+
+        Returns:
+            Highest UID already fetched
+        """
+        uidvalidity = int(uidvalidity)
+        with self._lock:
+            if uidvalidity != self.uidvalidity:
+                if self.uidvalidity is not None:
+                    logger.warning(f"⚠️ UIDVALIDITY of {self.mailbox} changed "
+                                   f"({self.uidvalidity} -> {uidvalidity}), rescanning")
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO mailboxes (mailbox, uidvalidity, last_uid) VALUES (?, ?, 0)',
+                    (self.mailbox, uidvalidity))
+                self.uidvalidity, self._last_uid = uidvalidity, 0
+            return self._last_uid
+
+    @property
+    def watermark(self) -> int:
+        return self._last_uid
+
+    def advance(self, uid) -> None:
+        """Raise the watermark to uid"""
+        uid = int(uid)
+        with self._lock:
+            if uid > self._last_uid:
+                self._conn.execute('UPDATE mailboxes SET last_uid = ? WHERE mailbox = ?', (uid, self.mailbox))
+                self._last_uid = uid
+
+    # ----- Transizioni -----
+
+    def _get(self, uid: int) -> Optional[Tuple[str, int]]:
+        return self._conn.execute(
+            'SELECT state, attempts FROM messages WHERE mailbox = ? AND uidvalidity = ? AND uid = ?',
+            (self.mailbox, self.uidvalidity, uid)).fetchone()
+
+    def state(self, uid) -> Optional[str]:
+        with self._lock:
+            row = self._get(int(uid))
+        return row[0] if row else None
+
+    def fetched(self, uid, message_id: Optional[str] = None) -> bool:
+        """
+        Record a fetch of a message.
+
+        Returns:
+            False if it should not be processed: already forwarded/failed, or
+            fetched max_attempts times without completing (then marked failed)
+        """
+        uid = int(uid)
+        with self._lock:
+            row = self._get(uid)
+            current, attempts = row if row else (None, 0)
+            if FETCHED not in _TRANSITIONS[current]:
+                return False
+            state, error = FETCHED, None
+            if attempts >= self.max_attempts:
+                state, error = FAILED, f"not completed after {attempts} attempts"
+                logger.warning(f"⚠️ Message UID {uid} {error}, giving up")
+            self._conn.execute(
+                """INSERT INTO messages (mailbox, uidvalidity, uid, state, message_id, error, attempts, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, 1, ?)
+                   ON CONFLICT (mailbox, uidvalidity, uid) DO UPDATE SET
+                       state = excluded.state, error = excluded.error,
+                       attempts = attempts + 1, updated_at = excluded.updated_at""",
+                (self.mailbox, self.uidvalidity, uid, state, message_id, error, time.time()))
+            return state == FETCHED
+
+    def set(self, uid, state: str, department: Optional[str] = None, error: Optional[str] = None) -> None:
+        """
+        Move a message to state.
+
+        Raises:
+            InvalidTransition: If state is not reachable from the current one
+        """
+        uid = int(uid)
+        with self._lock:
+            row = self._get(uid)
+            current = row[0] if row else None
+            if state not in _TRANSITIONS[current]:
+                raise InvalidTransition(f"UID {uid}: {current} -> {state}")
+            self._conn.execute(
+                """UPDATE messages SET state = ?, department = COALESCE(?, department), error = ?, updated_at = ?
+                   WHERE mailbox = ? AND uidvalidity = ? AND uid = ?""",
+                (state, department, error, time.time(), self.mailbox, self.uidvalidity, uid))
+
+    def acknowledge(self, uids: Iterable) -> int:
+        """
+        Mark forwarded/failed messages whose IMAP actions were committed (one transaction).
+
+        Returns:
+            Messages acknowledged
+        """
+        params = [(time.time(), self.mailbox, self.uidvalidity, int(uid)) for uid in uids]
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                cursor = self._conn.executemany(
+                    f"""UPDATE messages SET state = '{ACKNOWLEDGED}', updated_at = ?
+                        WHERE mailbox = ? AND uidvalidity = ? AND uid = ?
+                        AND state IN ('{FORWARDED}', '{FAILED}')""", params)
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return cursor.rowcount
+
+    # ----- Ripresa -----
+
+    def in_state(self, *states: str) -> List[int]:
+        """UIDs of the current mailbox in the given states"""
+        marks = ','.join('?' * len(states))
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT uid FROM messages WHERE mailbox = ? AND uidvalidity = ? AND state IN ({marks}) ORDER BY uid',
+                (self.mailbox, self.uidvalidity, *states)).fetchall()
+        return [r[0] for r in rows]
+
+    def unacknowledged(self) -> List[Tuple[str, str, Optional[str]]]:
+        """(uid, state, department) of forwarded/failed messages still to be filed"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT uid, state, department FROM messages WHERE mailbox = ? AND uidvalidity = ? '
+                'AND state IN (?, ?) ORDER BY uid',
+                (self.mailbox, self.uidvalidity, FORWARDED, FAILED)).fetchall()
+        return [(str(uid), state, department) for uid, state, department in rows]
+
+    def counts(self) -> Dict[str, int]:
+        """Messages per state"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT state, COUNT(*) FROM messages WHERE mailbox = ? GROUP BY state',
+                (self.mailbox,)).fetchall()
+        return dict(rows)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
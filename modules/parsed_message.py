@@ -0,0 +1,214 @@
+"""
+Single-pass parsed view of an email.message.Message.
+
+The MIME tree is walked once; text parts are decoded once and attachment
+payloads are decoded lazily on first access. The parsed view is cached on
+the message object so every consumer (body extraction, PDF reading,
+forwarding) shares the same decoded data.
+"""
+import io
+import logging
+from email.message import Message
+from typing import List, Optional
+
+from modules.html_text import html_to_text
+
+logger = logging.getLogger(__name__)
+
+# Optional PDF libraries
+try:
+    import pdfplumber
+    PDFPLUMBER_AVAILABLE = True
+except ImportError:
+    PDFPLUMBER_AVAILABLE = False
+
+try:
+    from pdf2image import convert_from_bytes
+    import pytesseract
+    OCR_AVAILABLE = True
+except ImportError:
+    OCR_AVAILABLE = False
+
+_CACHE_ATTR = '_parsed_message'
+
+# Messaggi comuni che indicano che il contenuto reale è in HTML
+_FALLBACK_INDICATORS = (
+    "email client might not support html",
+    "this email requires html",
+    "requires html",
+    "view this email in",
+    "open this email in",
+    "view in browser",
+    "click here to view",
+    "html formatted email",
+    "enable html",
+)
+
+# Limite del testo estratto da HTML (newsletter molto grandi)
+MAX_HTML_TEXT_CHARS = 100_000
+
+
+def is_html_fallback_message(text: str) -> bool:
+    """Check if a plain text part is just a fallback notice for HTML emails"""
+    # Se il testo è lungo, probabilmente è contenuto reale
+    if not text or len(text) >= 500:
+        return False
+
+    text_lower = text.lower().strip()
+    return any(indicator in text_lower for indicator in _FALLBACK_INDICATORS)
+
+
+def _decode_text(payload: bytes, charset: Optional[str]) -> str:
+    """Decode a text payload using its declared charset, falling back to utf-8"""
+    try:
+        return payload.decode(charset or 'utf-8', errors='ignore')
+    except LookupError:
+        return payload.decode('utf-8', errors='ignore')
+
+
+def extract_pdf_text(pdf_data: bytes) -> str:
+    """Extract text from PDF bytes with pdfplumber, falling back to OCR"""
+    if not PDFPLUMBER_AVAILABLE:
+        return "[PDF non leggibile - pdfplumber non disponibile]"
+
+    pdf_content = ""
+    try:
+        with pdfplumber.open(io.BytesIO(pdf_data)) as pdf:
+            for page in pdf.pages:
+                text = page.extract_text()
+                if text:
+                    pdf_content += text
+    except Exception as e:
+        pdf_content = f"Error reading PDF with pdfplumber: {str(e)}"
+
+    # If no text extracted, fallback to OCR (se disponibile)
+    if not pdf_content.strip() and OCR_AVAILABLE:
+        try:
+            for image in convert_from_bytes(pdf_data):
+                pdf_content += pytesseract.image_to_string(image)
+        except Exception as e:
+            pdf_content += f"\nError extracting text with OCR: {str(e)}"
+    elif not pdf_content.strip():
+        pdf_content = "[PDF senza testo - OCR non disponibile]"
+
+    return pdf_content
+
+
+# Parti considerate allegati anche senza filename/Content-Disposition
+_ATTACHMENT_TYPES = ('application/pdf', 'application/octet-stream')
+
+
+class Attachment:
+    """Attachment descriptor with a lazily decoded payload"""
+
+    def __init__(self, part: Message):
+        self._part = part
+        self.content_type = part.get_content_type()
+        self.disposition = str(part.get('Content-Disposition', ''))
+        self.filename = part.get_filename()
+        self._payload = None
+        self._decoded = False
+
+    @property
+    def payload(self) -> Optional[bytes]:
+        """Decoded payload (decoded on first access, then cached)"""
+        if not self._decoded:
+            self._payload = self._part.get_payload(decode=True)
+            self._decoded = True
+            # Il descrittore non serve più dopo la decodifica
+            self._part = None
+        return self._payload
+
+    @property
+    def is_pdf(self) -> bool:
+        """True for PDF attachments, including ones mislabeled as octet-stream"""
+        if self.content_type == 'application/pdf':
+            return True
+        if self.content_type != 'application/octet-stream':
+            return False
+        if self.filename and self.filename.lower().endswith('.pdf'):
+            return True
+        payload = self.payload
+        return bool(payload) and payload[:5] == b'%PDF-'
+
+
+class ParsedMessage:
+    """Message parsed in a single MIME walk with cached decoded parts"""
+
+    def __init__(self, msg: Message):
+        self.subject = msg.get('Subject', '')
+        self.plain_text = ""
+        self.html = ""
+        self.attachments: List[Attachment] = []
+        self._body_text = None
+        self._pdf_text = None
+        self._parse(msg)
+
+    def _parse(self, msg: Message) -> None:
+        """Walk the MIME tree once, decoding text parts and indexing attachments"""
+        for part in msg.walk():
+            if part.get_content_maintype() == 'multipart':
+                continue
+
+            content_type = part.get_content_type()
+            disposition = str(part.get('Content-Disposition', ''))
+
+            if content_type in ('text/plain', 'text/html') and 'attachment' not in disposition:
+                try:
+                    payload = part.get_payload(decode=True)
+                except Exception as e:
+                    logger.warning(f"Error decoding {content_type} part: {e}")
+                    continue
+                if not payload:
+                    continue
+
+                decoded = _decode_text(payload, part.get_content_charset())
+                if content_type == 'text/html':
+                    self.html = decoded
+                elif not is_html_fallback_message(decoded):
+                    self.plain_text = decoded
+            elif (part.get_filename() or 'attachment' in disposition or 'inline' in disposition
+                  or content_type in _ATTACHMENT_TYPES):
+                # Anche una parte application/pdf senza nome né Content-Disposition è un allegato
+                self.attachments.append(Attachment(part))
+
+    @property
+    def body_text(self) -> str:
+        """Message body, preferring plain text and converting HTML if needed"""
+        if self._body_text is None:
+            if self.plain_text:
+                self._body_text = self.plain_text.strip()
+            elif self.html:
+                self._body_text = html_to_text(self.html, max_chars=MAX_HTML_TEXT_CHARS)
+            else:
+                self._body_text = ""
+        return self._body_text
+
+    @property
+    def pdf_attachments(self) -> List[Attachment]:
+        """PDF attachments with a non-empty payload"""
+        return [a for a in self.attachments if a.is_pdf and a.payload]
+
+    @property
+    def pdf_text(self) -> str:
+        """Text extracted from all PDF attachments (empty if none)"""
+        if self._pdf_text is None:
+            self._pdf_text = "".join(extract_pdf_text(a.payload) for a in self.pdf_attachments)
+        return self._pdf_text
+
+
+def parse_message(msg: Message) -> ParsedMessage:
+    """
+    Get the parsed view of a message, building it on first use.
+
+    Args:
+        msg: Email message
+
+    Returns:
+        ParsedMessage cached on the message object
+    """
+    parsed = getattr(msg, _CACHE_ATTR, None)
+    if parsed is None:
+        parsed = ParsedMessage(msg)
+        setattr(msg, _CACHE_ATTR, parsed)
+    return parsed
@@ -6,7 +6,6 @@ from email.mime.multipart import MIMEMultipart
 import smtplib
 import logging  # Aggiungiamo l'importazione del modulo logging
 
-import io
 import os
 from dotenv import load_dotenv
 
@@ -20,13 +19,8 @@ except ImportError:
 # librerie per leggere pdf
 import pdfplumber
 
-# Librerie opzionali per OCR
-try:
-    from pdf2image import convert_from_bytes
-    import pytesseract
-    OCR_AVAILABLE = True
-except ImportError:
-    OCR_AVAILABLE = False
+from modules.parsed_message import parse_message
+from modules.mail_fetcher import fetch_unseen
 
 # FPDF opzionale per creazione PDF
 try:
@@ -37,36 +31,6 @@ except ImportError:
 
 load_dotenv()
 
-# Helper function per rilevare messaggi fallback HTML
-def _is_html_fallback_message(text):
-    """
-    Rileva se il testo plain è solo un messaggio fallback tipo
-    "This email requires HTML support" o "View in browser".
-    """
-    if not text or len(text) > 500:
-        # Se il testo è lungo, probabilmente è contenuto reale
-        return False
-    
-    text_lower = text.lower().strip()
-    
-    # Indicatori comuni di messaggi fallback
-    fallback_indicators = [
-        "email client might not support html",
-        "view this email in",
-        "open this email in",
-        "view in browser",
-        "click here to view",
-        "requires html",
-        "html formatted email",
-        "enable html",
-    ]
-    
-    for indicator in fallback_indicators:
-        if indicator in text_lower:
-            return True
-    
-    return False
-
 # Configuration mail from .env file
 imap_host = os.getenv('IMAP')
 smtp_host = os.getenv('SMTP')
@@ -74,18 +38,15 @@ email_account = os.getenv('EMAIL') # Get email from environment variable
 email_password = os.getenv('EMAIL_PASSWORD')  # Get password from environment variable
 
 # controlla mail non lette e returna email_message
-def check_for_new_emails(email_account):
-    email_messages = []
+def check_for_new_emails(email_account, state=None, folder='INBOX'):
+    """
+    Fetch unread emails with BODY.PEEK, so they stay unseen until forwarded.
+
+    See mail_fetcher.fetch_unseen for the role of the optional state store.
+    """
     mail = imaplib.IMAP4_SSL(imap_host)
     mail.login(email_account, email_password)
-    mail.select('inbox')
-    status, messages = mail.search(None, 'UNSEEN')
-    if status == 'OK':
-        for num in messages[0].split():
-            status, data = mail.fetch(num, '(RFC822)')
-            if status == 'OK':
-                email_message = email.message_from_bytes(data[0][1])
-                email_messages.append(email_message)
+    email_messages = fetch_unseen(mail, folder, state)
 
     mail.close()
     mail.logout()
@@ -95,152 +56,33 @@ def check_for_new_emails(email_account):
 def save_attachment(msg, download_folder=r"#allegati"):
 
         att_path = "No attachment found."
-        for part in msg.walk():
-            if part.get_content_maintype() == 'multipart':
-                continue
-            if part.get('Content-Disposition') is None:
+        for attachment in parse_message(msg).attachments:
+            if not attachment.filename or not attachment.payload:
                 continue
 
-            filename = part.get_filename()
-            att_path = os.path.join(download_folder, filename)
+            att_path = os.path.join(download_folder, attachment.filename)
 
             if not os.path.isfile(att_path):
                 fp = open(att_path, 'wb')
-                fp.write(part.get_payload(decode=True))
+                fp.write(attachment.payload)
                 fp.close()
         return att_path
 
 # legge l'allegato pdf della mail
 def read_pdf_attachment(msg):
-    pdf_content = "No PDF attachment found."
-    
-    # Loop through all parts of the email
-    for part in msg.walk():
-        # Skip multipart containers
-        if part.get_content_maintype() == 'multipart':
-            continue
-        
-        # Check for 'attachment' or 'inline' disposition
-        content_disposition = part.get("Content-Disposition", "")
-        if "attachment" in content_disposition or "inline" in content_disposition:
-            
-            # Check if the part is a PDF (even if mislabeled as octet-stream)
-            if part.get_content_type() in ['application/pdf', 'application/octet-stream']:
-                pdf_data = part.get_payload(decode=True)
-                if pdf_data:
-                    # Use BytesIO to handle the PDF content
-                    pdf_file = io.BytesIO(pdf_data)
-                    
-                    # Try to extract text using pdfplumber
-                    try:
-                        with pdfplumber.open(pdf_file) as pdf:
-                            pdf_content = ""
-                            for page in pdf.pages:
-                                text = page.extract_text()
-                                if text:
-                                    pdf_content += text
-                    except Exception as e:
-                        pdf_content = f"Error reading PDF with pdfplumber: {str(e)}"
-                    
-                    # If no text extracted, fallback to OCR (se disponibile)
-                    if not pdf_content.strip() and OCR_AVAILABLE:
-                        try:
-                            images = convert_from_bytes(pdf_data)  # Convert PDF pages to images
-                            for image in images:
-                                pdf_content += pytesseract.image_to_string(image)
-                        except Exception as e:
-                            pdf_content += f"\nError extracting text with OCR: {str(e)}"
-                    elif not pdf_content.strip():
-                        pdf_content = "[PDF senza testo - OCR non disponibile]"
-    
-    return pdf_content
+    pdf_content = parse_message(msg).pdf_text
+    return pdf_content or "No PDF attachment found."
 
 # dalla mail estrae il corpo e returna body (con soggetto all'inizio)
 def get_email_body(email_message):
     if email_message is None:
         return ""
     
-    body = ""
-    html_body = ""
-    subject = email_message.get('Subject', '')  # Ottieni l'oggetto del messaggio
-    
-    if email_message.is_multipart():
-        for part in email_message.walk():
-            ctype = part.get_content_type()
-            cdispo = str(part.get('Content-Disposition'))
-
-            # Raccogli sia text/plain che text/html
-            if ctype == 'text/plain' and 'attachment' not in cdispo:
-                payload = part.get_payload(decode=True)
-                if payload:
-                    decoded = payload.decode('utf-8', errors='ignore')
-                    # Controlla se non è un messaggio fallback HTML
-                    if not _is_html_fallback_message(decoded):
-                        body = payload
-            # Salva sempre HTML se disponibile
-            elif ctype == 'text/html' and 'attachment' not in cdispo:
-                html_body = part.get_payload(decode=True)
-    else:
-        # not multipart - i.e. plain text, no attachments
-        body = email_message.get_payload(decode=True)
-    
-    # Se abbiamo solo HTML, convertiamolo in testo
-    if not body and html_body:
-        try:
-            from html.parser import HTMLParser
-            
-            class HTMLTextExtractor(HTMLParser):
-                def __init__(self):
-                    super().__init__()
-                    self.text = []
-                    self.skip_tags = {'script', 'style', 'head', 'title', 'meta', '[document]'}
-                    self.current_tag = None
-                
-                def handle_starttag(self, tag, attrs):
-                    self.current_tag = tag
-                
-                def handle_endtag(self, tag):
-                    self.current_tag = None
-                    # Aggiungi nuova riga dopo paragrafi, div, br
-                    if tag in {'p', 'div', 'br', 'tr', 'li'}:
-                        self.text.append('\n')
-                
-                def handle_data(self, data):
-                    if self.current_tag not in self.skip_tags:
-                        text = data.strip()
-                        if text:
-                            self.text.append(text + ' ')
-            
-            parser = HTMLTextExtractor()
-            html_text = html_body.decode('utf-8', errors='ignore')
-            parser.feed(html_text)
-            body_text = ''.join(parser.text)
-            
-            # Rimuovi linee vuote multiple
-            import re
-            body_text = re.sub(r'\n\s*\n', '\n\n', body_text)
-            body_text = body_text.strip()
-            
-        except Exception as e:
-            # Fallback: rimuovi tag HTML con regex semplice
-            import re
-            body_text = html_body.decode('utf-8', errors='ignore')
-            body_text = re.sub(r'<style[^>]*>.*?</style>', '', body_text, flags=re.DOTALL | re.IGNORECASE)
-            body_text = re.sub(r'<script[^>]*>.*?</script>', '', body_text, flags=re.DOTALL | re.IGNORECASE)
-            body_text = re.sub(r'<[^>]+>', '', body_text)
-            body_text = re.sub(r'\s+', ' ', body_text)
-            body_text = body_text.strip()
-        
-        body = body_text.encode('utf-8')
-    
-    # Decodifica il body
-    if body:
-        body_decoded = body.decode('utf-8', errors='ignore')
-    else:
-        body_decoded = "[Email senza contenuto testuale]"
+    parsed = parse_message(email_message)
+    body_decoded = parsed.body_text or "[Email senza contenuto testuale]"
     
     # Concatena l'oggetto e il corpo del messaggio
-    full_body = f"{subject}\n\n{body_decoded}"
+    full_body = f"{parsed.subject}\n\n{body_decoded}"
     return full_body
 
 # dalla mail estrae il corpo del testo e anche quello del pdf allegato e returna content
@@ -248,86 +90,11 @@ def get_email_content(email_message):
     if email_message is None:
         return ""
     
-    body = ""
-    html_body = ""
-    pdf_content = ""
-    subject = email_message.get('Subject', '')
-    
-    if email_message.is_multipart():
-        for part in email_message.walk():
-            ctype = part.get_content_type()
-            cdispo = str(part.get('Content-Disposition'))
-
-            # Cerca text/plain (preferito)
-            if ctype == 'text/plain' and 'attachment' not in cdispo:
-                body = part.get_payload(decode=True)
-            # Se non c'è text/plain, prendi text/html
-            elif ctype == 'text/html' and 'attachment' not in cdispo and not body:
-                html_body = part.get_payload(decode=True)
-            # Estrai PDF
-            elif ctype == 'application/pdf':
-                pdf_data = part.get_payload(decode=True)
-                pdf_file = io.BytesIO(pdf_data)
-                with pdfplumber.open(pdf_file) as pdf:
-                    for page in pdf.pages:
-                        pdf_content += page.extract_text()
-    else:
-        body = email_message.get_payload(decode=True)
-    
-    # Se abbiamo solo HTML, convertiamolo
-    if not body and html_body:
-        try:
-            from html.parser import HTMLParser
-            
-            class HTMLTextExtractor(HTMLParser):
-                def __init__(self):
-                    super().__init__()
-                    self.text = []
-                    self.skip_tags = {'script', 'style', 'head', 'title', 'meta', '[document]'}
-                    self.current_tag = None
-                
-                def handle_starttag(self, tag, attrs):
-                    self.current_tag = tag
-                
-                def handle_endtag(self, tag):
-                    self.current_tag = None
-                    if tag in {'p', 'div', 'br', 'tr', 'li'}:
-                        self.text.append('\n')
-                
-                def handle_data(self, data):
-                    if self.current_tag not in self.skip_tags:
-                        text = data.strip()
-                        if text:
-                            self.text.append(text + ' ')
-            
-            parser = HTMLTextExtractor()
-            html_text = html_body.decode('utf-8', errors='ignore')
-            parser.feed(html_text)
-            body_text = ''.join(parser.text)
-            
-            import re
-            body_text = re.sub(r'\n\s*\n', '\n\n', body_text)
-            body_text = body_text.strip()
-            
-        except Exception as e:
-            import re
-            body_text = html_body.decode('utf-8', errors='ignore')
-            body_text = re.sub(r'<style[^>]*>.*?</style>', '', body_text, flags=re.DOTALL | re.IGNORECASE)
-            body_text = re.sub(r'<script[^>]*>.*?</script>', '', body_text, flags=re.DOTALL | re.IGNORECASE)
-            body_text = re.sub(r'<[^>]+>', '', body_text)
-            body_text = re.sub(r'\s+', ' ', body_text)
-            body_text = body_text.strip()
-        
-        body = body_text.encode('utf-8')
-    
-    # Decodifica
-    if body:
-        body_decoded = body.decode('utf-8', errors='ignore')
-    else:
-        body_decoded = "[Email senza contenuto testuale]"
+    parsed = parse_message(email_message)
+    body_decoded = parsed.body_text or "[Email senza contenuto testuale]"
 
     # Concatena oggetto, corpo e PDF
-    content = f"{subject}\n\n{body_decoded}\n\n{pdf_content}"
+    content = f"{parsed.subject}\n\n{body_decoded}\n\n{parsed.pdf_text}"
     return str(content)
 
 # Invia llm_response come risposta all'email
@@ -0,0 +1,100 @@
+"""
+Long-lived ticket processors shared across requests.
+
+The registry builds the processor (and the department data it needs) once
+and hands out an immutable snapshot. When the relevant settings or the
+departments change, a new snapshot is built and swapped in atomically;
+requests already running keep using the snapshot they started with.
+"""
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from modules.prom_metrics import cache_hit
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ProcessorSnapshot:
+    """Processor and departments valid for one configuration version"""
+    version: int
+    config_key: Tuple
+    reparti_version: int
+    processor: Any
+    reparti: List[Dict[str, str]]
+
+
+class ProcessorRegistry:
+    """Config-versioned holder of the ticket processor"""
+
+    def __init__(
+        self,
+        factory: Callable[[], Any],
+        config_manager,
+        config_keys: Sequence[str],
+        reparti_manager=None
+    ):
+        """
+        Args:
+            factory: Builds a new processor from the current configuration
+            config_manager: ConfigManager read by the factory
+            config_keys: Settings the processor depends on
+            reparti_manager: Optional RepartiManager whose departments are
+                pre-rendered into the processor
+        """
+        self.factory = factory
+        self.config_manager = config_manager
+        self.config_keys = tuple(config_keys)
+        self.reparti_manager = reparti_manager
+        self._current: Optional[ProcessorSnapshot] = None
+        self._lock = threading.Lock()
+
+    def _config_key(self) -> Tuple:
+        return tuple(self.config_manager.get(k, '') for k in self.config_keys)
+
+    def _reparti_version(self) -> int:
+        return self.reparti_manager.version if self.reparti_manager is not None else 0
+
+    def _is_current(self, snapshot: Optional[ProcessorSnapshot], config_key: Tuple, reparti_version: int) -> bool:
+        return (snapshot is not None
+                and snapshot.config_key == config_key
+                and snapshot.reparti_version == reparti_version)
+
+    def get(self) -> ProcessorSnapshot:
+        """Current snapshot, rebuilt only if settings or departments changed"""
+        snapshot = self._current
+        config_key = self._config_key()
+        reparti_version = self._reparti_version()
+        if self._is_current(snapshot, config_key, reparti_version):
+            cache_hit('processor', True)
+            return snapshot
+
+        cache_hit('processor', False)
+        with self._lock:
+            snapshot = self._current
+            if self._is_current(snapshot, config_key, reparti_version):
+                return snapshot
+
+            if snapshot is not None and snapshot.config_key == config_key:
+                processor = snapshot.processor  # cambiati solo i reparti
+            else:
+                processor = self.factory()
+            reparti = self.reparti_manager.get_all() if self.reparti_manager is not None else []
+            if reparti and hasattr(processor, 'prepare_departments'):
+                processor.prepare_departments(reparti)
+
+            version = snapshot.version + 1 if snapshot is not None else 1
+            self._current = ProcessorSnapshot(version, config_key, reparti_version, processor, reparti)
+            logger.info(f"🔁 Ticket processor snapshot v{version} ready ({len(reparti)} departments)")
+            return self._current
+
+    @property
+    def processor(self):
+        return self.get().processor
+
+    def invalidate(self) -> None:
+        """Force a full rebuild on the next get()"""
+        with self._lock:
+            self._current = None
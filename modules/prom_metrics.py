@@ -0,0 +1,236 @@
+"""
+Prometheus metrics of the backend.
+
+Counters and histograms are updated in place on the hot path; gauges that
+mirror state owned elsewhere (queue depths, rate-limit budgets, health)
+are read by collectors only when /metrics is scraped. Rendering walks a
+few dicts, so scraping every few seconds is cheap.
+"""
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+from modules.tracing import PROMETHEUS_BUCKETS, LatencyHistogram, tracer
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'mailsupport'
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = f"{PREFIX}_{name}"
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonic counter"""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {v:g}" for k, v in values]
+
+
+class Gauge(_Metric):
+    """
+    Current value, either set directly or read from a callback at scrape time.
+
+    The callback returns a number (no labels) or a dict label values -> number.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 callback: Callable[[], object] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self.callback = callback
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _collect(self) -> Iterable[Tuple[LabelValues, float]]:
+        if self.callback is None:
+            with self._lock:
+                return sorted(self._values.items())
+        values = self.callback()
+        if isinstance(values, dict):
+            return sorted(((k if isinstance(k, tuple) else (k,)), v) for k, v in values.items())
+        return [((), values)]
+
+    def render(self) -> List[str]:
+        try:
+            values = self._collect()
+        except Exception as e:
+            logger.error(f"Error collecting {self.name}: {e}")
+            return []
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {float(v):g}"
+                                for k, v in values if v is not None]
+
+
+_LE_LABELS = [f'le="{bound}"' for bound in PROMETHEUS_BUCKETS] + ['le="+Inf"']
+
+
+class Histogram(_Metric):
+    """Latency histogram per label set (HDR buckets, exported as 'le' buckets)"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._histograms: Dict[LabelValues, LatencyHistogram] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, LatencyHistogram())
+        histogram.record(value)
+
+    def get(self, **labels) -> LatencyHistogram:
+        return self._histograms.get(self._key(labels))
+
+    def render(self) -> List[str]:
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        lines = self.header()
+        for key, histogram in histograms:
+            counts = histogram.cumulative() + [histogram.count]
+            for bound, count in zip(_LE_LABELS, counts):
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, bound)} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {histogram.sum:.6f}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {histogram.count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Metrics and raw text collectors rendered together by /metrics"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], str]] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            # Idempotente: i moduli ricaricati riusano la metrica esistente
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+              callback: Callable[[], object] = None) -> Gauge:
+        gauge = self.register(Gauge(name, documentation, labelnames, callback))
+        if callback is not None:
+            gauge.callback = callback
+        return gauge
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames))
+
+    def add_collector(self, collector: Callable[[], str]) -> None:
+        """Add a function returning Prometheus text (e.g. tracer.render_prometheus)"""
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        text = '\n'.join(lines) + '\n'
+        for collector in collectors:
+            try:
+                text += collector()
+            except Exception as e:
+                logger.error(f"Error in metrics collector {collector}: {e}")
+        return text
+
+
+REGISTRY = MetricsRegistry()
+
+EMAILS_FETCHED = REGISTRY.counter('emails_fetched_total', 'Emails fetched from IMAP')
+EMAILS_PROCESSED = REGISTRY.counter('emails_processed_total', 'Emails routed by the AI', ('department',))
+EMAILS_FORWARDED = REGISTRY.counter('emails_forwarded_total', 'Emails forwarded to a department', ('department',))
+EMAILS_FAILED = REGISTRY.counter('emails_failed_total', 'Emails that failed a pipeline stage', ('stage',))
+LLM_ERRORS = REGISTRY.counter('llm_errors_total', 'Failed LLM calls by provider', ('provider', 'kind'))
+CACHE_REQUESTS = REGISTRY.counter('cache_requests_total', 'Cache lookups', ('cache', 'result'))
+ACCOUNT_FETCHED = REGISTRY.counter('account_emails_fetched_total', 'Emails fetched per mailbox',
+                                   ('account', 'folder'))
+ACCOUNT_HANDLED = REGISTRY.counter('account_emails_handled_total', 'Emails routed or failed per account',
+                                   ('account', 'result'))
+ACCOUNT_POLL_LATENCY = REGISTRY.histogram('account_poll_duration_seconds', 'Mailbox polls (fetch and processing)',
+                                          ('account',))
+ACCOUNT_POLL_ERRORS = REGISTRY.counter('account_poll_errors_total', 'Mailbox polls that failed', ('account',))
+
+
+def _rate_limit_budgets() -> Dict[LabelValues, float]:
+    from modules.rate_limiter import get_rate_limit_stats
+    values = {}
+    for name, usage in get_rate_limit_stats().items():
+        values[(name, 'requests')] = usage['requests_available']
+        if 'tokens_available' in usage:
+            values[(name, 'tokens')] = usage['tokens_available']
+    return values
+
+
+REGISTRY.add_collector(tracer.render_prometheus)
+REGISTRY.gauge('rate_limit_available', 'Remaining rate-limit budget', ('limiter', 'resource'),
+               callback=_rate_limit_budgets)
+
+
+def cache_hit(cache: str, hit: bool) -> None:
+    """Count a cache lookup"""
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def render_metrics() -> str:
+    """All registered metrics in Prometheus text format"""
+    return REGISTRY.render()
@@ -0,0 +1,240 @@
+"""
+Token-aware prompt assembly.
+
+Counts tokens with tiktoken (a calibrated heuristic if it is missing) and
+distributes the input token budget across the prompt sections by priority
+instead of truncating raw characters. The OpenAI encodings are not the
+tokenizers of Llama or Gemma, so counts for those models are approximate.
+"""
+import logging
+import math
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Tokenizer opzionale
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+# Context window (token) per famiglia di modelli
+MODEL_CONTEXT_WINDOWS = {
+    'llama-3.1': 131072,
+    'llama-3.2': 131072,
+    'llama-3.3': 131072,
+    'llama-4': 131072,
+    'llama3.1': 131072,
+    'llama3.2': 131072,
+    'llama3': 8192,
+    'gemma3': 131072,
+    'gemma2': 8192,
+    'mixtral': 32768,
+    'mistral': 32768,
+    'qwen': 32768,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Budget di input predefinito: il contesto dei modelli recenti è molto più ampio,
+# ma prompt più corti riducono latenza e consumo della quota token/minuto
+DEFAULT_MAX_INPUT_TOKENS = 4096
+DEFAULT_MAX_OUTPUT_TOKENS = 300
+
+# Encoding tiktoken più vicino al tokenizer di ciascuna famiglia (approssimato per Llama e Gemma)
+_TIKTOKEN_ENCODINGS = (
+    ('gpt-4o', 'o200k_base'),
+    ('llama-3', 'o200k_base'),
+    ('llama3', 'o200k_base'),
+    ('llama-4', 'o200k_base'),
+    ('gemma', 'o200k_base'),
+)
+_DEFAULT_TIKTOKEN_ENCODING = 'cl100k_base'
+
+# Caratteri medi per token nella stima euristica
+_HEURISTIC_CHARS_PER_TOKEN = 4.0
+_WORD_RE = re.compile(r'\w+|[^\w\s]')
+
+
+def _model_key(model: Optional[str]) -> str:
+    return (model or '').lower().rsplit('/', 1)[-1]
+
+
+def get_context_window(model: Optional[str]) -> int:
+    """Context window of a model (best match on the model family)"""
+    key = _model_key(model)
+    for prefix, window in sorted(MODEL_CONTEXT_WINDOWS.items(), key=lambda kv: -len(kv[0])):
+        if key.startswith(prefix):
+            return window
+    return DEFAULT_CONTEXT_WINDOW
+
+
+class TokenCounter:
+    """Counts and truncates text in tokens of a specific model"""
+
+    def __init__(self, model: Optional[str] = None):
+        self.model = model
+        self._encoding = None
+
+        if TIKTOKEN_AVAILABLE:
+            key = _model_key(model)
+            name = next((enc for prefix, enc in _TIKTOKEN_ENCODINGS if key.startswith(prefix)),
+                        _DEFAULT_TIKTOKEN_ENCODING)
+            try:
+                self._encoding = tiktoken.get_encoding(name)
+            except Exception as e:
+                logger.warning(f"tiktoken encoding {name} not available, using heuristic: {e}")
+
+        # Cache solo per le parti fisse del prompt (sistema, template, reparti), non per i corpi delle email
+        self.count_static = lru_cache(maxsize=64)(self.count)
+
+    @property
+    def exact(self) -> bool:
+        """True if counts come from a real tokenizer"""
+        return self._encoding is not None
+
+    def count(self, text: str) -> int:
+        """Number of tokens of text"""
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        # Parole lunghe e punteggiatura pesano più token
+        words = _WORD_RE.findall(text)
+        estimate = sum(1 + len(w) // 6 for w in words)
+        return max(estimate, math.ceil(len(text) / _HEURISTIC_CHARS_PER_TOKEN))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Truncate text to at most max_tokens tokens"""
+        if max_tokens <= 0 or not text:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+
+        if self._encoding is not None:
+            tokens = self._encoding.encode(text, disallowed_special=())
+            return self._encoding.decode(tokens[:max_tokens])
+
+        # Stima proporzionale, poi riduzione finché non rientra nel budget
+        cut = int(len(text) * max_tokens / self.count(text))
+        while cut > 0 and self.count(text[:cut]) > max_tokens:
+            cut = int(cut * 0.9)
+        return text[:cut]
+
+
+@lru_cache(maxsize=16)
+def get_token_counter(model: Optional[str]) -> TokenCounter:
+    """Shared TokenCounter for a model"""
+    return TokenCounter(model)
+
+
+@dataclass
+class PromptSection:
+    """Variable part of a prompt competing for the token budget"""
+    name: str
+    text: str
+    priority: int = 0  # 0 = highest
+    min_tokens: int = 0  # reserved before lower priorities are served
+    max_tokens: Optional[int] = None
+
+
+class PromptBuilder:
+    """Allocates a token budget across prompt sections by priority"""
+
+    def __init__(
+        self,
+        model: Optional[str] = None,
+        max_input_tokens: Optional[int] = None,
+        max_output_tokens: int = DEFAULT_MAX_OUTPUT_TOKENS
+    ):
+        """
+        Args:
+            model: Target model name (selects tokenizer and context window)
+            max_input_tokens: Input budget (default: min(context - output, DEFAULT_MAX_INPUT_TOKENS))
+            max_output_tokens: Tokens reserved for the completion
+        """
+        self.counter = get_token_counter(model)
+        context = get_context_window(model)
+        self.max_output_tokens = max_output_tokens
+        self.max_input_tokens = min(
+            max_input_tokens or DEFAULT_MAX_INPUT_TOKENS,
+            context - max_output_tokens
+        )
+        # Cache per istanza (lru_cache sul metodo terrebbe vivo ogni builder):
+        # la chiave è il contenuto del catalogo, quindi una modifica ai reparti la invalida
+        self._rendered = lru_cache(maxsize=64)(self._render_departments)
+
+    def count(self, text: str) -> int:
+        """Number of tokens of text for the target model"""
+        return self.counter.count(text)
+
+    def count_static(self, text: str) -> int:
+        """Cached count for prompt parts that repeat on every call (system prompt, templates)"""
+        return self.counter.count_static(text)
+
+    def allocate(self, fixed: Sequence[str], sections: Sequence[PromptSection]) -> Dict[str, str]:
+        """
+        Fit sections into the budget left after the fixed (always included) parts.
+
+        Sections are served in priority order: first each one gets up to its
+        min_tokens, then the remaining budget is granted in the same order.
+
+        Args:
+            fixed: Static prompt parts (system prompt, templates)
+            sections: Variable sections
+
+        Returns:
+            Dict section name -> (possibly truncated) text
+        """
+        budget = self.max_input_tokens - sum(self.count_static(t) for t in fixed)
+        ordered = sorted(sections, key=lambda s: s.priority)
+
+        sizes = {s.name: self.count(s.text) for s in ordered}
+        needs = {}
+        for s in ordered:
+            need = sizes[s.name]
+            needs[s.name] = min(need, s.max_tokens) if s.max_tokens is not None else need
+
+        grants = {s.name: 0 for s in ordered}
+        for s in ordered:
+            grant = min(needs[s.name], s.min_tokens, max(budget, 0))
+            grants[s.name] = grant
+            budget -= grant
+        for s in ordered:
+            extra = min(needs[s.name] - grants[s.name], max(budget, 0))
+            grants[s.name] += extra
+            budget -= extra
+
+        result = {}
+        for s in ordered:
+            if grants[s.name] >= sizes[s.name]:
+                result[s.name] = s.text
+                continue
+            result[s.name] = self.counter.truncate(s.text, grants[s.name])
+            logger.info(f"Prompt section '{s.name}' truncated to {grants[s.name]} tokens")
+        return result
+
+    def render_departments(self, reparti: List[Dict[str, str]], max_tokens: int) -> str:
+        """
+        Render the departments list within max_tokens.
+
+        Department names are never dropped; if the full list does not fit,
+        descriptions are shortened evenly.
+        """
+        key = tuple((r['nome'], r.get('descrizione', 'No description')) for r in reparti)
+        return self._rendered(key, max_tokens)
+
+    def _render_departments(self, reparti: Tuple[Tuple[str, str], ...], max_tokens: int) -> str:
+        full = "\n".join(f"- {nome}: {descrizione}" for nome, descrizione in reparti)
+        if self.count(full) <= max_tokens or not reparti:
+            return full
+
+        names_cost = sum(self.count(f"- {nome}: ") + 1 for nome, _ in reparti)
+        per_department = max(0, (max_tokens - names_cost) // len(reparti))
+        return "\n".join(
+            f"- {nome}: {self.counter.truncate(descrizione, per_department)}".rstrip(': ')
+            for nome, descrizione in reparti
+        )
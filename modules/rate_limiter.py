@@ -0,0 +1,189 @@
+"""
+Client-side rate limiting for LLM and Azure Maps quotas.
+
+Each provider gets a request bucket (RPM/RPS) and optionally a token bucket
+(TPM). Callers block until enough budget is available, so requests are
+paced just under the quota instead of discovering it through 429 errors;
+Retry-After from the server pauses the provider for the requested time.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Quote predefinite: (richieste, token, finestra in secondi). Sovrascrivibili
+# con RATE_LIMIT_<PROVIDER>_REQUESTS / _TOKENS / _PERIOD
+DEFAULT_QUOTAS = {
+    'groq': (30, 6000, 60.0),       # free tier llama-3.1-8b-instant
+    'azure_maps': (50, None, 1.0),  # Search API, richieste al secondo
+}
+# Margine sotto la quota per assorbire richieste concorrenti e orologi diversi
+HEADROOM = 0.9
+# Attesa massima prima di rinunciare a una richiesta
+DEFAULT_MAX_WAIT = 120.0
+
+
+class RateLimitTimeout(Exception):
+    """Budget not available within the maximum wait"""
+
+
+class TokenBucket:
+    """Classic token bucket: capacity units, refilled continuously over period seconds"""
+
+    def __init__(self, capacity: float, period: float):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self._level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until amount units are available"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self._level) / self.rate)
+
+    def take(self, amount: float) -> None:
+        # Il livello può andare in negativo (es. conguaglio dei token effettivi)
+        self._level -= amount
+
+    @property
+    def level(self) -> float:
+        self._refill(time.monotonic())
+        return self._level
+
+
+class RateLimiter:
+    """Request and token budget of one provider"""
+
+    def __init__(self, name: str, requests: int, tokens: Optional[int] = None, period: float = 60.0,
+                 headroom: float = HEADROOM):
+        self.name = name
+        self.period = period
+        self.requests = TokenBucket(max(1, int(requests * headroom)), period)
+        self.tokens = TokenBucket(max(1, int(tokens * headroom)), period) if tokens else None
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+        # Statistiche
+        self.granted = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.throttled = 0
+        self.tokens_used = 0
+
+    def acquire(self, tokens: int = 0, max_wait: float = DEFAULT_MAX_WAIT) -> float:
+        """
+        Block until a request with the given token estimate fits the quota.
+
+        Args:
+            tokens: Estimated tokens of the request (prompt + max completion)
+            max_wait: Give up after this many seconds
+
+        Returns:
+            Seconds waited
+
+        Raises:
+            RateLimitTimeout: If the budget is not available within max_wait
+        """
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                delay = max(self.blocked_until - now, self.requests.wait_time(1, now))
+                if self.tokens is not None and tokens:
+                    delay = max(delay, self.tokens.wait_time(tokens, now))
+                if delay <= 0:
+                    self.requests.take(1)
+                    if self.tokens is not None and tokens:
+                        self.tokens.take(tokens)
+                    waited = now - start
+                    self.granted += 1
+                    if waited > 0.001:
+                        self.waited += 1
+                        self.wait_seconds += waited
+                    return waited
+
+            if time.monotonic() - start + delay > max_wait:
+                raise RateLimitTimeout(f"{self.name}: rate limit budget not available within {max_wait:.0f}s")
+            time.sleep(min(delay, 1.0))
+
+    def reconcile(self, estimated: int, actual: Optional[int]) -> None:
+        """Correct the token bucket with the usage reported by the provider"""
+        if actual is None:
+            return
+        with self._lock:
+            self.tokens_used += actual
+            if self.tokens is not None:
+                self.tokens.take(actual - estimated)
+
+    def penalize(self, retry_after: Optional[float]) -> None:
+        """
+        Pause the provider after a 429: Retry-After, or one refill interval
+        (period / capacity). The request bucket is emptied too, so traffic
+        resumes at the sustained rate instead of with a burst.
+        """
+        pause = retry_after if retry_after is not None else self.period / max(1, self.requests.capacity)
+        with self._lock:
+            self.throttled += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+            # Il server ci considera oltre quota: svuota il bucket delle richieste
+            self.requests.take(max(0.0, self.requests.level))
+        logger.warning(f"⏸️ {self.name} throttled, pausing {pause:.1f}s")
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            data = {
+                'requests_available': round(self.requests.level, 1),
+                'requests_capacity': self.requests.capacity,
+                'period_s': self.period,
+                'granted': self.granted,
+                'waited': self.waited,
+                'wait_seconds': round(self.wait_seconds, 2),
+                'throttled': self.throttled,
+                'blocked_s': round(max(0.0, self.blocked_until - time.monotonic()), 1),
+            }
+            if self.tokens is not None:
+                data['tokens_available'] = round(self.tokens.level)
+                data['tokens_capacity'] = self.tokens.capacity
+            data['tokens_used'] = self.tokens_used
+        return data
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_registry_lock = threading.Lock()
+
+
+def get_rate_limiter(name: str) -> Optional[RateLimiter]:
+    """
+    Shared limiter of a provider (None if the provider has no quota, e.g. local Ollama).
+
+    Quotas come from DEFAULT_QUOTAS, overridable with the environment variables
+    RATE_LIMIT_<NAME>_REQUESTS, RATE_LIMIT_<NAME>_TOKENS and RATE_LIMIT_<NAME>_PERIOD.
+    """
+    with _registry_lock:
+        if name in _limiters:
+            return _limiters[name]
+
+        requests, tokens, period = DEFAULT_QUOTAS.get(name, (None, None, 60.0))
+        prefix = f"RATE_LIMIT_{name.upper()}_"
+        requests = int(os.getenv(prefix + 'REQUESTS', requests or 0)) or None
+        tokens = int(os.getenv(prefix + 'TOKENS', tokens or 0)) or None
+        period = float(os.getenv(prefix + 'PERIOD', period))
+
+        limiter = RateLimiter(name, requests, tokens, period) if requests else None
+        _limiters[name] = limiter
+        return limiter
+
+
+def get_rate_limit_stats() -> Dict[str, Dict]:
+    """Current budget usage of every active limiter"""
+    with _registry_lock:
+        limiters = [l for l in _limiters.values() if l is not None]
+    return {l.name: l.snapshot() for l in limiters}
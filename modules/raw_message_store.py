@@ -0,0 +1,119 @@
+"""
+On-disk store of raw email messages.
+
+Keeps the RFC822 bytes of each message in its own file (sharded by hash)
+so callers can hold only lightweight summaries in memory and load the full
+message, attachments included, when it is actually needed. A small LRU
+cache avoids re-parsing messages used several times in a row (analysis,
+then forwarding).
+"""
+import email
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from email.message import Message
+from typing import Optional, Union
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 16
+
+
+def message_bytes(message: Union[Message, bytes]) -> bytes:
+    """RFC822 bytes of a message"""
+    if isinstance(message, (bytes, bytearray)):
+        return bytes(message)
+    try:
+        return message.as_bytes()
+    except Exception:
+        # Header non codificabili: ricade sulla serializzazione testuale
+        return message.as_string().encode('utf-8', errors='replace')
+
+
+class RawMessageStore:
+    """Raw messages by key, parsed on demand"""
+
+    def __init__(self, directory: str, cache_size: int = DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[str, Message]' = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + '.eml')
+
+    def put(self, key: str, message: Union[Message, bytes]) -> int:
+        """
+        Store a message (atomic write).
+
+        Returns:
+            Size in bytes
+        """
+        data = message_bytes(message)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self._cache.pop(key, None)
+        return len(data)
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get(self, key: str) -> Optional[Message]:
+        """Parsed message, or None if not stored"""
+        with self._lock:
+            message = self._cache.get(key)
+            if message is not None:
+                self._cache.move_to_end(key)
+                return message
+
+        data = self.get_bytes(key)
+        if data is None:
+            return None
+        message = email.message_from_bytes(data)
+
+        with self._lock:
+            self._cache[key] = message
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return message
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            self._cache.pop(key, None)
+        try:
+            os.unlink(self._path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def clear(self) -> None:
+        """Remove every stored message"""
+        with self._lock:
+            self._cache.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
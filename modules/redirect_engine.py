@@ -10,6 +10,13 @@ from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
 import json
 import os
+import threading
+
+from modules.imap_actions import CONTROL_DEPARTMENT
+from modules.parsed_message import parse_message
+from modules.prompt_builder import PromptBuilder
+from modules.llm_schemas import GEO_TICKET, missing_fields_prompt
+from modules.rate_limiter import RateLimitTimeout, get_rate_limiter
 
 load_dotenv()
 
@@ -37,11 +44,8 @@ except ImportError:
 
 client = Client()
 
-def route_mail(body, llm):
-    run_id = str(uuid.uuid4())
-    langsmith_extra={"run_id": run_id}
-    # Define the prompts
-    prompt_base = PromptTemplate(input_variables=['topic'], template=
+# Prompt, chain and token budget are built once per LLM instead of per email
+ROUTE_PROMPT = PromptTemplate(input_variables=['topic'], template=
     """
     Ruolo: sei un assistente AI con grande esperienza nel leggere e comprendere le richieste di assistenza tecnica
     
@@ -61,20 +65,112 @@ def route_mail(body, llm):
     
     Email: {topic}
     """
-    )
+)
+
+_route_chains = {}
+_route_chains_lock = threading.Lock()
+
+
+def _get_route_chain(llm):
+    """Cached (chain, PromptBuilder, body token budget, rate limiter) for an LLM"""
+    cached = _route_chains.get(id(llm))
+    if cached is not None and cached[0] is llm:
+        return cached[1:]
+
+    with _route_chains_lock:
+        primary = getattr(llm, 'runnable', llm)  # modello principale se llm ha dei fallback
+        builder = PromptBuilder(getattr(primary, 'model_name', None) or getattr(primary, 'model', None))
+        body_budget = builder.max_input_tokens - builder.count_static(ROUTE_PROMPT.template)
+        # Stay within the provider quota (Groq free tier) instead of hitting 429s
+        limiter = get_rate_limiter('groq') if type(primary).__name__ == 'ChatGroq' else None
+        chain = ROUTE_PROMPT | llm | StrOutputParser()
+        cached = (llm, chain, builder, body_budget, limiter)
+        _route_chains[id(llm)] = cached
+    return cached[1:]
+
+
+# Valore dei campi che l'LLM non trova nell'email (vedi ROUTE_PROMPT)
+NOT_FOUND = 'not found'
+
+# Risposta usata quando la quota del provider non si libera in tempo: confidenza 0, va al controllo
+RATE_LIMITED_RESPONSE = json.dumps({
+    'summary': f'{NOT_FOUND} (LLM rate limit reached, manual review needed)',
+    'equipment': NOT_FOUND,
+    'address': NOT_FOUND,
+    'confidence': 0,
+})
+
+
+def is_found(value) -> bool:
+    """True if an extracted field has a value (not empty and not 'not found')"""
+    return bool(value) and str(value).strip().lower() != NOT_FOUND
+
+
+def route_mail(body, llm, raise_on_rate_limit=False):
+    """
+    Extract summary, equipment, address and confidence from an email.
 
-    # Define the chain
-    chain = prompt_base | llm | StrOutputParser()
+    If the provider's rate limit budget is not available in time, the
+    email is not analyzed: a zero-confidence answer sends it to control,
+    unless raise_on_rate_limit is set (queued jobs are retried instead).
+
+    Returns:
+        (LLM response string, run id)
+
+    Raises:
+        RateLimitTimeout: If the budget is not available and raise_on_rate_limit is set
+    """
+    run_id = str(uuid.uuid4())
+    chain, builder, body_budget, limiter = _get_route_chain(llm)
+
+    # Keep the email within the model's input token budget
+    body = builder.counter.truncate(body, body_budget)
+
+    if limiter:
+        try:
+            limiter.acquire(builder.max_input_tokens - body_budget + builder.count(body) + builder.max_output_tokens)
+        except RateLimitTimeout as e:
+            if raise_on_rate_limit:
+                raise
+            logging.warning(f"⏸️ {e}, forwarding to control without analysis")
+            return RATE_LIMITED_RESPONSE, run_id
 
     # Get LLM response
     llm_response = chain.invoke({"topic": body}, {"run_id": run_id})
 
-    #save the prompt
-    prompt_base.save('prompt_base.json')
-
     return llm_response, run_id
 
+def complete_route_fields(body, llm_response, missing, llm):
+    """
+    Ask the LLM only for the fields missing from a route_mail answer.
+
+    Returns:
+        JSON string with the fields recovered by the follow-up (may be '{}')
+    """
+    chain, builder, body_budget, limiter = _get_route_chain(llm)
+    body = builder.counter.truncate(body, body_budget)
+    messages = [
+        ('human', ROUTE_PROMPT.format(topic=body)),
+        ('ai', llm_response),
+        ('human', missing_fields_prompt(GEO_TICKET, missing)),
+    ]
+    if limiter:
+        try:
+            limiter.acquire(builder.max_input_tokens - body_budget + builder.count(body) + builder.max_output_tokens)
+        except RateLimitTimeout as e:
+            # Campi ancora mancanti: la risposta non valida porta l'email al controllo
+            logging.warning(f"⏸️ {e}, missing fields not requested")
+            return '{}'
+    return (llm | StrOutputParser()).invoke(messages)
+
 def redirect_mail(geocode_result, body, email_message, sql_response, response_json=None):
+    """
+    Forward an email to its area's recipients, or to the control address.
+
+    Returns:
+        The macro area it was forwarded to, or CONTROL_DEPARTMENT if it went
+        to the control address for review
+    """
     try:
         # Log parameters for debugging
         logging.info(f"redirect_mail called with: geocode_result={type(geocode_result)}, response_json={type(response_json)}")
@@ -101,9 +197,11 @@ def redirect_mail(geocode_result, body, email_message, sql_response, response_js
         if confidence_level < 90:
             logging.warning(f"Low confidence level ({confidence_level}). Forwarding to control email.")
             recipients = os.getenv('CONTROL_EMAIL', email_account)  # Use env variable or fallback to account email
+            area = CONTROL_DEPARTMENT
         else:
             macro_area = geocode_result.get('macro_area', '').lower() if geocode_result else ''
             recipients = RECIPIENTS.get(macro_area, os.getenv('CONTROL_EMAIL', email_account))  # Use env variable or fallback
+            area = geocode_result['macro_area'] if RECIPIENTS.get(macro_area) else CONTROL_DEPARTMENT
             
             # Log which recipient set is being used (for debugging)
             env_type = "TEST" if USE_TEST_RECIPIENTS else "PRODUCTION"
@@ -130,14 +228,11 @@ def redirect_mail(geocode_result, body, email_message, sql_response, response_js
         msg.attach(MIMEText(new_body, 'plain'))
 
         # Attach any PDFs from the original email
-        for part in email_message.walk():
-            if part.get_content_type() == 'application/pdf' or (part.get_content_type() == 'application/octet-stream' and part.get_filename().endswith('.pdf')):
-                pdf_attachment = part.get_payload(decode=True)
-                if pdf_attachment:
-                    filename = part.get_filename() or "attachment.pdf"
-                    part_attachment = MIMEApplication(pdf_attachment, _subtype="pdf")
-                    part_attachment.add_header('Content-Disposition', 'attachment', filename=filename)
-                    msg.attach(part_attachment)
+        for attachment in parse_message(email_message).pdf_attachments:
+            filename = attachment.filename or "attachment.pdf"
+            part_attachment = MIMEApplication(attachment.payload, _subtype="pdf")
+            part_attachment.add_header('Content-Disposition', 'attachment', filename=filename)
+            msg.attach(part_attachment)
 
         # Send the email
         with smtplib.SMTP_SSL(smtp_host, 465) as smtp:
@@ -145,6 +240,7 @@ def redirect_mail(geocode_result, body, email_message, sql_response, response_js
             # Use this form to ensure the recipient is in the "To" field and not BCC
             smtp.send_message(msg)
             logging.info(f"Email redirected to {recipients}")
+        return area
 
     except Exception as e:
         logging.error(f"An error occurred: {e}")
@@ -161,3 +257,4 @@ def redirect_mail(geocode_result, body, email_message, sql_response, response_js
             # Use the simple form of send_message
             smtp.send_message(error_msg)
             logging.info(f"Error email sent to {control_email}")
+        return CONTROL_DEPARTMENT
@@ -3,73 +3,133 @@ Module for departments management (routing configuration).
 """
 import json
 import os
-from typing import List, Dict, Optional
+import threading
+from typing import List, Dict, Optional, Iterable
+
+from modules.file_utils import atomic_write_json
+
+
+def _key(nome: str) -> str:
+    """Case-insensitive lookup key of a department name"""
+    return str(nome).strip().casefold()
 
 
 class RepartiManager:
     """Manages loading/saving departments for email routing"""
-    
+
     def __init__(self, reparti_file: str = 'reparti_config.json'):
         self.reparti_file = reparti_file
-        self._reparti = []
+        # Insertion-ordered: preserves the department order of the file
+        self._by_key: Dict[str, Dict[str, str]] = {}
+        self._list_cache: Optional[List[Dict[str, str]]] = None
+        self._lock = threading.RLock()
+        self.version = 0  # incremented on every change, used to invalidate caches
         self.load()
-    
+
+    def _changed(self) -> None:
+        self._list_cache = None
+        self.version += 1
+
     def load(self) -> List[Dict[str, str]]:
         """Load departments from JSON file"""
+        reparti = []
         if os.path.exists(self.reparti_file):
             with open(self.reparti_file) as f:
-                self._reparti = json.load(f)
-        else:
-            self._reparti = []
-        return self._reparti
-    
+                reparti = json.load(f)
+        with self._lock:
+            self._by_key = {}
+            for r in reparti:
+                self._by_key.setdefault(_key(r['nome']), r)
+            self._changed()
+            return self.get_all()
+
     def save(self) -> None:
-        """Save departments to JSON file"""
-        os.makedirs(os.path.dirname(self.reparti_file) or '.', exist_ok=True)
-        with open(self.reparti_file, 'w') as f:
-            json.dump(self._reparti, f, indent=2)
-    
-    def add_reparto(self, nome: str, descrizione: str, email: str, icon: Optional[str] = None, color: Optional[str] = None) -> bool:
-        """Add a department"""
-        if not nome or not email:
-            return False
-        
-        # Check duplicates
-        if any(r['nome'] == nome for r in self._reparti):
-            return False
-        
+        """Save departments to JSON file (atomic write-rename)"""
+        with self._lock:
+            reparti = list(self._by_key.values())
+        atomic_write_json(self.reparti_file, reparti, indent=2)
+
+    @staticmethod
+    def _make_reparto(nome: str, descrizione: str, email: str, icon: Optional[str] = None, color: Optional[str] = None) -> Dict[str, str]:
         dept_data = {
             'nome': nome,
             'descrizione': descrizione,
             'email': email
         }
-        
+
         # Add optional fields only if provided
         if icon:
             dept_data['icon'] = icon
         if color:
             dept_data['color'] = color
-        
-        self._reparti.append(dept_data)
-        return True
-    
+        return dept_data
+
+    def add_reparto(self, nome: str, descrizione: str, email: str, icon: Optional[str] = None, color: Optional[str] = None) -> bool:
+        """Add a department"""
+        if not nome or not email:
+            return False
+
+        with self._lock:
+            # Check duplicates (case-insensitive)
+            key = _key(nome)
+            if key in self._by_key:
+                return False
+
+            self._by_key[key] = self._make_reparto(nome, descrizione, email, icon, color)
+            self._changed()
+            return True
+
+    def replace_all(self, reparti: Iterable[Dict[str, str]]) -> int:
+        """
+        Replace all departments in one step.
+
+        Entries without name or email are skipped; for duplicate names
+        (case-insensitive) the first one wins.
+
+        Returns:
+            Number of departments stored
+        """
+        by_key = {}
+        for r in reparti:
+            if not r.get('nome') or not r.get('email'):
+                continue
+            by_key.setdefault(_key(r['nome']), self._make_reparto(
+                r['nome'], r.get('descrizione', ''), r['email'], r.get('icon'), r.get('color')
+            ))
+
+        with self._lock:
+            if list(by_key.values()) != list(self._by_key.values()):
+                self._by_key = by_key
+                self._changed()
+            return len(self._by_key)
+
     def remove_reparto(self, nome: str) -> bool:
         """Remove a department by name"""
-        original_len = len(self._reparti)
-        self._reparti = [r for r in self._reparti if r['nome'] != nome]
-        return len(self._reparti) < original_len
-    
+        with self._lock:
+            if self._by_key.pop(_key(nome), None) is None:
+                return False
+            self._changed()
+            return True
+
     def get_reparto(self, nome: str) -> Optional[Dict[str, str]]:
-        """Get department by name"""
-        for r in self._reparti:
-            if r['nome'] == nome:
-                return r
-        return None
-    
+        """Get department by name (case-insensitive)"""
+        return self._by_key.get(_key(nome))
+
+    def __contains__(self, nome: str) -> bool:
+        return _key(nome) in self._by_key
+
+    def __len__(self) -> int:
+        return len(self._by_key)
+
     def get_all(self) -> List[Dict[str, str]]:
         """Get all departments"""
-        return self._reparti.copy()
-    
+        with self._lock:
+            if self._list_cache is None:
+                self._list_cache = list(self._by_key.values())
+            return self._list_cache.copy()
+
     def clear(self) -> None:
         """Clear departments list"""
-        self._reparti = []
+        with self._lock:
+            self._by_key = {}
+            self._changed()
@@ -1,16 +1,30 @@
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
 from dotenv import load_dotenv
+
+from modules.ticket_sink import TABLE
 load_dotenv()
 
 
+def _sql_literal(value):
+    # Solo per la visualizzazione: nel database i ticket vanno con parametri (TicketSink)
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "''") + "'"
+
 
 def json_to_sql(json_response):
+    """
+    Readable INSERT of a ticket, included in the forwarded email.
+
+    Values are quoted and escaped; the ticket itself is stored with a
+    parameterized query by modules.ticket_sink.
+    """
     # Estrai i dati JSON
     problema = json_response.get('summary')
     oggetto = json_response.get('equipment')
     dove = json_response.get('address')
     confidence = json_response.get('confidence')
     # Crea la stringa SQL
-    sql_string = f"INSERT INTO (problema, oggetto, dove, confidenza) VALUES ('{problema}', '{oggetto}', '{dove}', '{confidence}')"
-    return sql_string
\ No newline at end of file
+    values = ', '.join(_sql_literal(v) for v in (problema, oggetto, dove, confidence))
+    return f"INSERT INTO {TABLE} (problema, oggetto, dove, confidenza) VALUES ({values})"
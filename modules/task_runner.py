@@ -0,0 +1,139 @@
+"""
+Background task runner for the Tkinter GUI.
+
+Blocking work (IMAP, PDF parsing, LLM calls, SMTP) runs on a thread pool;
+completions are queued and dispatched by `poll()`, which the GUI calls
+from the Tk main loop via `after()`, so callbacks can touch widgets
+safely. A CancelToken groups the tasks of one batch: cancelling it drops
+the tasks that have not started yet; tasks already running still report
+their outcome, since their side effects (e.g. a sent email) have happened.
+"""
+import logging
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+
+
+class TaskCancelled(Exception):
+    """The task's batch was cancelled before it ran"""
+
+
+class CancelToken:
+    """Cancellation flag shared by the tasks of one batch"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._futures: List[Future] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self) -> None:
+        """Raise TaskCancelled if the batch was cancelled (for long tasks)"""
+        if self._event.is_set():
+            raise TaskCancelled()
+
+    def _track(self, future: Future) -> None:
+        with self._lock:
+            self._futures.append(future)
+
+    def cancel(self) -> None:
+        """Stop the batch: queued tasks never run, running ones finish and report normally"""
+        self._event.set()
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+
+class TaskRunner:
+    """Thread pool whose callbacks run on the thread calling poll()"""
+
+    def __init__(self, max_workers: int = DEFAULT_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gui-worker')
+        self._done: 'queue.Queue' = queue.Queue()
+
+    def submit(
+        self,
+        fn: Callable[..., Any],
+        *args,
+        on_done: Optional[Callable[[Any], None]] = None,
+        on_error: Optional[Callable[[Exception], None]] = None,
+        on_cancel: Optional[Callable[[], None]] = None,
+        token: Optional[CancelToken] = None
+    ) -> Future:
+        """
+        Run fn(*args) in the background.
+
+        Args:
+            fn: Blocking function
+            on_done: Called with the result, from poll()
+            on_error: Called with the exception, from poll()
+            on_cancel: Called from poll() if the task never ran because the token was cancelled
+            token: Batch the task belongs to
+        """
+        def run():
+            if token is not None:
+                token.check()
+            return fn(*args)
+
+        future = self._executor.submit(run)
+        if token is not None:
+            token._track(future)
+        future.add_done_callback(lambda f: self._done.put((f, on_done, on_error, on_cancel, token)))
+        return future
+
+    def post(self, fn: Callable[..., Any], *args) -> None:
+        """Run fn(*args) from the next poll(); safe to call from a worker thread"""
+        self._done.put((None, partial(fn, *args), None, None, None))
+
+    def poll(self, max_callbacks: int = 50) -> int:
+        """
+        Dispatch the callbacks of finished tasks (call from the GUI thread).
+
+        Returns:
+            Number of callbacks dispatched
+        """
+        dispatched = 0
+        while dispatched < max_callbacks:
+            try:
+                future, on_done, on_error, on_cancel, token = self._done.get_nowait()
+            except queue.Empty:
+                break
+            dispatched += 1
+            try:
+                if future is None:
+                    # Callback inviato da post()
+                    on_done()
+                    continue
+                # Solo i task mai eseguiti sono annullati: un task finito riporta il suo esito
+                if future.cancelled():
+                    if on_cancel:
+                        on_cancel()
+                    continue
+                error = future.exception()
+                if error is None:
+                    if on_done:
+                        on_done(future.result())
+                elif isinstance(error, TaskCancelled):
+                    if on_cancel:
+                        on_cancel()
+                elif on_error:
+                    on_error(error)
+                else:
+                    logger.error(f"Background task failed: {error}")
+            except Exception as e:
+                logger.error(f"Error in task callback: {e}", exc_info=True)
+        return dispatched
+
+    def shutdown(self) -> None:
+        """Drop queued tasks and let running ones finish in the background"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
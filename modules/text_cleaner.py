@@ -0,0 +1,227 @@
+"""
+Email text preprocessing before prompt construction.
+
+Removes content that costs LLM tokens without helping classification:
+tracking links, quoted reply history, signatures, legal/unsubscribe
+footers and redundant whitespace.
+"""
+import logging
+import re
+from dataclasses import dataclass
+from typing import Callable, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# ----- Link -----
+_MARKDOWN_LINK_RE = re.compile(r'\[([^\]\n]*)\]\(\s*(?:https?://|mailto:)[^)\s]*(?:\s+"[^"]*")?\s*\)')
+_PAREN_URL_RE = re.compile(r'[(<\[]\s*https?://[^\s)>\]]*\s*[)>\]]')
+_BARE_URL_RE = re.compile(r'https?://[^\s<>()\[\]"]+')
+# Solo parametri e redirect di click noti: i link di tracking delle spedizioni sono contenuto
+_TRACKING_PARAM_RE = re.compile(r'utm_\w*|mc_eid|mc_cid|_hsenc|_hsmi|mkt_tok|qs|fbclid|gclid|msclkid', re.IGNORECASE)
+_CLICK_HOST_RE = re.compile(
+    r'^clicks?\.'
+    r'|(?:^|\.)(?:list-manage\.com|sendgrid\.net|mandrillapp\.com|hubspotlinks\.com|rs6\.net'
+    r'|safelinks\.protection\.outlook\.com|mailchi\.mp)$',
+    re.IGNORECASE,
+)
+_CLICK_PATH_RE = re.compile(r'/ls/click|/e3t/|/wf/click|/click(?:/|$)|unsubscribe', re.IGNORECASE)
+# Oltre questa lunghezza un URL è quasi sempre un link di tracciamento
+_MAX_URL_LENGTH = 80
+
+# ----- Cronologia citata -----
+_QUOTED_LINE_RE = re.compile(r'^[ \t]*>.*$\n?', re.MULTILINE)
+_REPLY_HEADER_RE = re.compile(
+    r'^[ \t]*(?:'
+    # L'attribuzione può andare a capo una volta (Gmail) e chiude la riga
+    r'(?P<attribution>(?:On|Il(?: giorno)?)[ \t][^\n]{1,200}(?:[ \t]|\n|\n[^\n]{0,200}[ \t])(?:wrote|ha scritto):)[ \t]*$'
+    r'|-{2,}\s*(?:Original Message|Messaggio originale)\s*-{2,}'
+    r'|(?:From|Da):\s.+\n[ \t]*(?:Sent|Inviato|Date|Data):\s'
+    r')',
+    re.MULTILINE | re.IGNORECASE,
+)
+# "Il tecnico ha scritto:" è testo: un'attribuzione contiene una data, un'ora o un indirizzo
+_ATTRIBUTION_SHAPE_RE = re.compile(
+    r'\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}|\d{4}-\d{2}-\d{2}|\b\d{1,2}\s+[a-z]{3,}\.?,?\s+\d{4}'
+    r'|\b[a-z]{3,}\.?\s+\d{1,2},?\s+\d{4}|\b\d{1,2}[:.]\d{2}\b|[\w.+-]+@[\w-]+(?:\.[\w-]+)+',
+    re.IGNORECASE,
+)
+# In un inoltro il messaggio inoltrato è il contenuto da analizzare
+_FORWARD_MARKER_RE = re.compile(r'-{2,}\s*(?:Forwarded message|Messaggio inoltrato)\s*-{2,}', re.IGNORECASE)
+
+# ----- Firme -----
+# Un delimitatore di firma conta solo tra le ultime righe del messaggio
+_SIGNATURE_MAX_LINES = 10
+_SIGNATURE_RE = re.compile(
+    r'^-- ?$'
+    r'|^[ \t]*(?:Sent from my|Get Outlook for|Scarica Outlook per)\b.*$'
+    r'|^[ \t]*Inviato da(?:l mio)? (?:iPhone|iPad|Android|Samsung|smartphone|Outlook|Posta)\b.*$',
+    re.MULTILINE | re.IGNORECASE,
+)
+
+# ----- Footer legali / newsletter -----
+# Marcatori tipici dei footer (newsletter, disclaimer)
+_FOOTER_MARKER_RE = re.compile(
+    r'unsubscribe|annull\w* (?:l[\'’]|dell[\'’])?iscrizione|disiscri|cancellati (?:qui|dalla|da questa)'
+    r'|all rights reserved|tutti i diritti riservati|©'
+    r'|you (?:are )?receiv\w* this (?:e-?mail|message)|ricevi questa (?:e-?mail|comunicazione)'
+    r'|view (?:this email )?in (?:your )?browser|visualizza (?:questa email )?nel browser'
+    r'|manage (?:your )?preferences|gestisci (?:le tue )?preferenze'
+    r'|do not reply|non rispondere a questo'
+    r'|this (?:e-?mail|message) (?:and any attachments )?(?:is|are|may be) confidential'
+    r'|questo messaggio .{0,80}riservat',
+    re.IGNORECASE,
+)
+# Riferimenti legali: compaiono anche nelle richieste reali (es. GDPR), contano solo insieme ai precedenti
+_LEGAL_MARKER_RE = re.compile(
+    r'privacy policy|informativa sulla privacy|policy sulla privacy'
+    r'|ai sensi del (?:d\.? ?lgs|regolamento)|gdpr',
+    re.IGNORECASE,
+)
+# Paragrafi più lunghi sono probabilmente contenuto reale
+_MAX_BOILERPLATE_PARAGRAPH = 600
+# Marcatori distinti richiesti, almeno uno di footer: uno solo ("GDPR", "Privacy policy") è contenuto
+_MIN_BOILERPLATE_MARKERS = 2
+
+# ----- Spazi -----
+_PARAGRAPH_SPLIT_RE = re.compile(r'\n[ \t]*\n')
+_INLINE_SPACES_RE = re.compile(r'[ \t\u00a0\u200b\u200c\u034f]+')
+_LINE_EDGES_RE = re.compile(r' *\n *')
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+_PUNCT_ONLY_LINE_RE = re.compile(r'^[\s|•·\-–—*_=#]*$\n?', re.MULTILINE)
+
+
+@dataclass
+class CleanResult:
+    """Cleaned text with token accounting"""
+    text: str
+    original_tokens: int
+    cleaned_tokens: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return max(0, self.original_tokens - self.cleaned_tokens)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (about 4 characters per token)"""
+    return (len(text) + 3) // 4 if text else 0
+
+
+def _is_tracking_url(url: str) -> bool:
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return False
+    return bool(
+        _CLICK_HOST_RE.search(parts.hostname or '')
+        or _CLICK_PATH_RE.search(parts.path)
+        or any(_TRACKING_PARAM_RE.fullmatch(name) for name, _ in parse_qsl(parts.query, keep_blank_values=True))
+    )
+
+
+def _drop_url(match: re.Match) -> str:
+    url = match.group(0)
+    if len(url) > _MAX_URL_LENGTH or _is_tracking_url(url):
+        return ''
+    return url
+
+
+def strip_links(text: str) -> str:
+    """Remove tracking URLs, keeping link text and short plain URLs"""
+    text = _MARKDOWN_LINK_RE.sub(r'\1', text)
+    text = _PAREN_URL_RE.sub('', text)
+    return _BARE_URL_RE.sub(_drop_url, text)
+
+
+def _reply_header(text: str) -> Optional[re.Match]:
+    for match in _REPLY_HEADER_RE.finditer(text):
+        attribution = match.group('attribution')
+        if attribution is None or _ATTRIBUTION_SHAPE_RE.search(attribution):
+            return match
+    return None
+
+
+def strip_quoted_history(text: str) -> str:
+    """Remove the quoted reply chain ("On ... wrote:" and '>' lines)"""
+    match = None if _FORWARD_MARKER_RE.search(text) else _reply_header(text)
+    if match and text[:match.start()].strip():
+        text = text[:match.start()]
+    return _QUOTED_LINE_RE.sub('', text)
+
+
+def strip_signature(text: str) -> str:
+    """Cut the text at a signature delimiter ("-- ", "Sent from my ...") near its end"""
+    lines = text.rstrip().split('\n')
+    tail = sum(len(line) + 1 for line in lines[:-_SIGNATURE_MAX_LINES]) if len(lines) > _SIGNATURE_MAX_LINES else 0
+    match = _SIGNATURE_RE.search(text, tail)
+    if match and text[:match.start()].strip():
+        return text[:match.start()]
+    return text
+
+
+def _is_boilerplate(paragraph: str) -> bool:
+    if len(paragraph) > _MAX_BOILERPLATE_PARAGRAPH:
+        return False
+    footer = {m.group(0).lower() for m in _FOOTER_MARKER_RE.finditer(paragraph)}
+    legal = {m.group(0).lower() for m in _LEGAL_MARKER_RE.finditer(paragraph)}
+    return bool(footer) and len(footer) + len(legal) >= _MIN_BOILERPLATE_MARKERS
+
+
+def strip_boilerplate(text: str) -> str:
+    """
+    Drop the legal disclaimer / newsletter footer at the end of the text.
+
+    Only the trailing paragraphs are candidates, and each needs several
+    markers, at least one of them footer-specific (a GDPR request cites
+    only legal references). The first paragraph is always kept.
+    """
+    paragraphs = _PARAGRAPH_SPLIT_RE.split(text)
+    end = len(paragraphs)
+    while end > 1 and _is_boilerplate(paragraphs[end - 1]):
+        end -= 1
+    return '\n\n'.join(paragraphs[:end])
+
+
+def normalize_whitespace(text: str) -> str:
+    """Collapse repeated spaces and blank lines"""
+    text = _INLINE_SPACES_RE.sub(' ', text.replace('\r\n', '\n').replace('\r', '\n'))
+    text = _LINE_EDGES_RE.sub('\n', text)
+    text = _PUNCT_ONLY_LINE_RE.sub('\n', text)
+    return _BLANK_LINES_RE.sub('\n\n', text).strip()
+
+
+def clean_email_text(text: str, count_tokens: Optional[Callable[[str], int]] = None) -> CleanResult:
+    """
+    Remove content that is useless for classification before building a prompt.
+
+    Args:
+        text: Email body (plain text)
+        count_tokens: Token counter of the target model (default: estimate_tokens)
+
+    Returns:
+        CleanResult with the cleaned text and token counts
+    """
+    if not text:
+        return CleanResult(text="", original_tokens=0, cleaned_tokens=0)
+
+    count_tokens = count_tokens or estimate_tokens
+    original_tokens = count_tokens(text)
+
+    cleaned = text.replace('\r\n', '\n')
+    cleaned = strip_quoted_history(cleaned)
+    cleaned = strip_signature(cleaned)
+    cleaned = strip_links(cleaned)
+    cleaned = normalize_whitespace(cleaned)
+    cleaned = strip_boilerplate(cleaned)
+    cleaned = normalize_whitespace(cleaned)
+
+    # Non restituire mai un testo vuoto (es. email composta solo da citazioni)
+    if not cleaned:
+        cleaned = normalize_whitespace(text)
+
+    return CleanResult(
+        text=cleaned,
+        original_tokens=original_tokens,
+        cleaned_tokens=count_tokens(cleaned),
+    )
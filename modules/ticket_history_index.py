@@ -0,0 +1,274 @@
+"""
+Vector index of past routed tickets for retrieval-augmented routing.
+
+Embeddings of routed emails are appended to a flat float32 file that is
+memory-mapped for search, with one metadata line per vector in a JSONL
+file. Updates are incremental: only new or re-routed emails are embedded,
+deletions are tombstones, and the files are compacted when most rows are
+dead. Search is an exact dot product over the memory-mapped matrix, which
+stays fast up to hundreds of thousands of tickets.
+"""
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from modules.embeddings import get_embedder
+from modules.text_cleaner import clean_email_text
+
+logger = logging.getLogger(__name__)
+
+# Caratteri del corpo considerati per l'embedding
+MAX_TEXT_CHARS = 2000
+# Compatta i file quando le righe eliminate superano questa frazione
+COMPACT_DEAD_RATIO = 0.5
+
+
+def ticket_text(subject: str, body: str, cleaned: bool = False) -> str:
+    """Text embedded for a ticket (subject + cleaned body)"""
+    if not cleaned:
+        body = clean_email_text(body or '').text
+    return f"{subject or ''}\n{(body or '')[:MAX_TEXT_CHARS]}"
+
+
+@dataclass
+class SimilarTicket:
+    """Past ticket returned by a search"""
+    score: float
+    id: str
+    department: str
+    confidence: Any
+    summary: str
+    subject: str
+
+
+class TicketHistoryIndex:
+    """Incremental, memory-mapped embedding index of routed emails"""
+
+    def __init__(self, directory: str = 'ticket_index', embedder=None):
+        self.directory = directory
+        self.vectors_file = os.path.join(directory, 'vectors.f32')
+        self.meta_file = os.path.join(directory, 'meta.jsonl')
+        self.header_file = os.path.join(directory, 'index.json')
+        self._embedder = embedder
+        self._lock = threading.RLock()
+        self._matrix: Optional[np.memmap] = None
+        self._meta: List[Dict[str, Any]] = []
+        self._row_by_id: Dict[str, int] = {}
+        self._alive = np.zeros(0, dtype=bool)
+        self.dim = 0
+        self._load()
+
+    @property
+    def embedder(self):
+        if self._embedder is None:
+            self._embedder = get_embedder()
+        return self._embedder
+
+    def __len__(self) -> int:
+        return len(self._row_by_id)
+
+    # ----- Persistenza -----
+
+    def _load(self) -> None:
+        header = {}
+        if os.path.exists(self.header_file):
+            with open(self.header_file, encoding='utf-8') as f:
+                header = json.load(f)
+        if header.get('embedder') != self.embedder.name:
+            if header:
+                logger.info(f"Embedder changed ({header.get('embedder')} -> {self.embedder.name}), "
+                            f"rebuilding ticket index")
+            self._reset()
+            return
+
+        self.dim = header['dim']
+        meta = []
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        meta.append(json.loads(line))
+
+        size = os.path.getsize(self.vectors_file) if os.path.exists(self.vectors_file) else 0
+        rows = size // (4 * self.dim)
+        self._meta = []
+        self._row_by_id = {}
+        orphans = 0
+        for entry in meta:
+            if 'delete' in entry:
+                self._row_by_id.pop(entry['delete'], None)
+            elif len(self._meta) < rows:
+                self._row_by_id[entry['id']] = len(self._meta)
+                self._meta.append(entry)
+            else:
+                orphans += 1
+        self._alive = np.zeros(len(self._meta), dtype=bool)
+        self._alive[list(self._row_by_id.values())] = True
+
+        # Crash a metà di _append: i nuovi ticket devono ripartire dalla riga len(self._meta)
+        if size != len(self._meta) * 4 * self.dim:
+            logger.warning(f"Ticket index: dropping {size // 4 - len(self._meta) * self.dim} "
+                           f"vector values without metadata")
+            with open(self.vectors_file, 'r+b') as f:
+                f.truncate(len(self._meta) * 4 * self.dim)
+        if orphans:
+            logger.warning(f"Ticket index: dropping {orphans} metadata lines without vectors")
+            self._rewrite_meta()
+        logger.info(f"Ticket index loaded: {len(self)} tickets ({self.directory})")
+
+    def _rewrite_meta(self) -> None:
+        """Rewrite meta.jsonl from the loaded rows (entries, then tombstones of dead ids)"""
+        deleted = {entry['id'] for entry in self._meta} - set(self._row_by_id)
+        with open(self.meta_file, 'w', encoding='utf-8') as f:
+            for entry in self._meta:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            for email_id in sorted(deleted):
+                f.write(json.dumps({'delete': email_id}, ensure_ascii=False) + '\n')
+
+    def _reset(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self.dim = self.embedder.embed(['dim'])[0].shape[0]
+        for path in (self.vectors_file, self.meta_file):
+            open(path, 'wb').close()
+        with open(self.header_file, 'w', encoding='utf-8') as f:
+            json.dump({'embedder': self.embedder.name, 'dim': self.dim}, f)
+        self._matrix = None
+        self._meta = []
+        self._row_by_id = {}
+        self._alive = np.zeros(0, dtype=bool)
+
+    def _mapped(self) -> Optional[np.memmap]:
+        if self._matrix is None or self._matrix.shape[0] != len(self._meta):
+            self._matrix = np.memmap(self.vectors_file, dtype=np.float32, mode='r',
+                                     shape=(len(self._meta), self.dim)) if self._meta else None
+        return self._matrix
+
+    def _append(self, entries: List[Dict[str, Any]], vectors: np.ndarray) -> None:
+        with open(self.vectors_file, 'ab') as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with open(self.meta_file, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+        start = len(self._meta)
+        self._meta.extend(entries)
+        self._alive = np.concatenate([self._alive, np.ones(len(entries), dtype=bool)])
+        for offset, entry in enumerate(entries):
+            old = self._row_by_id.get(entry['id'])
+            if old is not None:
+                self._alive[old] = False
+            self._row_by_id[entry['id']] = start + offset
+
+    def _delete(self, ids: Iterable[str]) -> None:
+        ids = [i for i in ids if i in self._row_by_id]
+        if not ids:
+            return
+        with open(self.meta_file, 'a', encoding='utf-8') as f:
+            for email_id in ids:
+                f.write(json.dumps({'delete': email_id}, ensure_ascii=False) + '\n')
+                self._alive[self._row_by_id.pop(email_id)] = False
+
+    def compact(self) -> None:
+        """Rewrite the files keeping only live rows"""
+        with self._lock:
+            matrix = self._mapped()
+            rows = sorted(self._row_by_id.values())
+            vectors = np.array(matrix[rows]) if rows else np.zeros((0, self.dim), dtype=np.float32)
+            entries = [self._meta[r] for r in rows]
+            self._matrix = None  # rilascia il memmap prima di riscrivere
+            self._reset()
+            if entries:
+                self._append(entries, vectors)
+            logger.info(f"Ticket index compacted: {len(entries)} tickets")
+
+    # ----- Aggiornamento -----
+
+    @staticmethod
+    def _department(email: Dict[str, Any]) -> Optional[str]:
+        # Dove l'email è stata davvero inoltrata; il suggerimento dell'AI solo se manca
+        return email.get('forwardedToDepartment') or email.get('suggestedDepartment') or None
+
+    def _is_routed(self, email: Dict[str, Any]) -> bool:
+        return bool(self._department(email)) and email.get('status') != 'not_processed'
+
+    def sync(self, emails: List[Dict[str, Any]]) -> int:
+        """
+        Bring the index in line with the stored emails.
+
+        Routed emails that are new or whose department changed are embedded
+        and appended; emails no longer routed or stored are removed. The
+        label is the department the email was forwarded to, falling back to
+        the AI suggestion for emails not forwarded yet.
+
+        Returns:
+            Number of emails embedded
+        """
+        with self._lock:
+            routed = {e['id']: e for e in emails if e.get('id') and self._is_routed(e)}
+
+            changed = [
+                e for email_id, e in routed.items()
+                if email_id not in self._row_by_id
+                or self._meta[self._row_by_id[email_id]]['department'] != self._department(e)
+            ]
+            self._delete([email_id for email_id in list(self._row_by_id) if email_id not in routed])
+
+            if changed:
+                vectors = self.embedder.embed([ticket_text(e.get('subject'), e.get('body')) for e in changed])
+                self._append([{
+                    'id': e['id'],
+                    'department': self._department(e),
+                    'confidence': e.get('confidence'),
+                    'summary': e.get('aiSummary') or '',
+                    'subject': e.get('subject') or '',
+                } for e in changed], vectors)
+                logger.info(f"Ticket index: {len(changed)} tickets embedded, {len(self)} total")
+
+            if self._meta and 1 - len(self) / len(self._meta) > COMPACT_DEAD_RATIO:
+                self.compact()
+            return len(changed)
+
+    # ----- Ricerca -----
+
+    def search(self, text: str, k: int = 3, min_score: float = 0.0,
+               exclude_id: Optional[str] = None) -> List[SimilarTicket]:
+        """
+        Most similar past tickets.
+
+        Args:
+            text: Query text (see ticket_text)
+            k: Max results
+            min_score: Minimum cosine similarity
+            exclude_id: Id of the email being analyzed, which must not match itself
+        """
+        with self._lock:
+            matrix = self._mapped()
+            if matrix is None or not len(self):
+                return []
+            query = self.embedder.embed([text])[0]
+            scores = np.asarray(matrix @ query)
+            scores[~self._alive] = -np.inf
+            if exclude_id in self._row_by_id:
+                scores[self._row_by_id[exclude_id]] = -np.inf
+            k = min(k, len(self))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            results = []
+            for row in top:
+                if scores[row] < min_score:
+                    break
+                entry = self._meta[row]
+                results.append(SimilarTicket(
+                    score=float(scores[row]),
+                    id=entry['id'],
+                    department=entry['department'],
+                    confidence=entry.get('confidence'),
+                    summary=entry.get('summary', ''),
+                    subject=entry.get('subject', ''),
+                ))
+            return results
@@ -5,11 +5,93 @@ Uses direct Groq/Ollama APIs without Langchain dependencies.
 import json
 import logging
 import os
-from typing import Dict, List, Optional, Tuple
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 from email.message import Message
 
+from modules.text_cleaner import clean_email_text
+from modules.prompt_builder import PromptBuilder, PromptSection
+from modules.json_stream import IncrementalJSONParser
+from modules.department_index import DepartmentIndex, get_department_index
+from modules.ticket_history_index import SimilarTicket, TicketHistoryIndex, ticket_text
+from modules.llm_schemas import DEPARTMENT_ROUTING, missing_fields_prompt, parse_json_lenient
+from modules.rate_limiter import DEFAULT_MAX_WAIT, RateLimitTimeout, get_rate_limiter
+from modules.prom_metrics import cache_hit
+
 logger = logging.getLogger(__name__)
 
+SYSTEM_PROMPT = """You are an AI assistant expert in classifying support tickets.
+Analyze the provided email and determine which department should handle it.
+
+IMPORTANT: Evaluate confidence CAREFULLY based on:
+- Clear technical terms or product mentions = 90-100% confidence
+- General support requests with some context = 70-85% confidence  
+- Marketing/promotional emails = 60-80% confidence
+- Unclear or ambiguous requests = 40-65% confidence
+- Completely unclear or spam = 10-40% confidence
+
+Respond ONLY with valid JSON in the format:
+{
+    "reparto_suggerito": "exact_department_name",
+    "confidence": 75,
+    "summary": "Brief problem summary (max 100 characters)",
+    "reasoning": "Choice reasoning (max 150 characters)"
+}"""
+
+USER_PROMPT_TEMPLATE = """Available departments:
+{reparti_desc}
+{examples}
+Email to analyze:
+{content}
+
+Choose one of the departments listed above. If confidence < 70%, indicate need for human review."""
+
+EXAMPLES_TEMPLATE = """
+Similar past tickets and the department that handled them:
+{examples}
+"""
+
+# Campi sufficienti per instradare (il prompt li chiede per primi)
+ROUTING_FIELDS = ('reparto_suggerito', 'confidence')
+
+# Ticket storici: quanti esempi mostrare e soglie di similarità (coseno)
+HISTORY_EXAMPLES = 3
+HISTORY_MIN_SIMILARITY = 0.3
+HISTORY_DIRECT_ROUTE_SIMILARITY = 0.97
+
+
+@dataclass
+class PromptContext:
+    """Prompt of one email and the routing data gathered while building it"""
+    messages: List[Dict[str, str]]
+    tokens_saved: int
+    candidates: List[Dict[str, str]]
+    similar: List[SimilarTicket] = field(default_factory=list)
+    direct_route: Optional[Dict] = None
+
+
+class LLMProviderError(Exception):
+    """Provider-side failure (HTTP error, timeout, connection) worth failing over"""
+    
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+    
+    @property
+    def is_rate_limit(self) -> bool:
+        return self.status_code == 429
+
+
+def _retry_after(response) -> Optional[float]:
+    """Seconds from the Retry-After header (None if missing or a date)"""
+    value = response.headers.get("Retry-After") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
 
 class TicketProcessorSimple:
     """
@@ -17,16 +99,34 @@ class TicketProcessorSimple:
     Compatible with Groq and Ollama (OpenAI-compatible format).
     """
     
-    def __init__(self, api_key: str, provider: str = "groq", model: str = None, api_base: str = None):
+    def __init__(
+        self,
+        api_key: str,
+        provider: str = "groq",
+        model: str = None,
+        api_base: str = None,
+        max_input_tokens: int = None,
+        timeout: float = 30,
+        rate_limit_wait: float = DEFAULT_MAX_WAIT,
+        shortlist_size: int = 15,
+        history_index: Optional[TicketHistoryIndex] = None
+    ):
         """
         Args:
             api_key: Provider API key (or "ollama" for local Ollama)
             provider: "groq" or "ollama"
             model: Model name (default: llama-3.1-8b-instant for Groq, llama3.1 for Ollama)
             api_base: API base URL (optional, for custom Ollama)
+            max_input_tokens: Prompt token budget (optional, default from prompt_builder)
+            timeout: HTTP timeout in seconds
+            rate_limit_wait: Max seconds to wait for the provider's rate limit budget
+            shortlist_size: Max departments described in the prompt (closest by embedding)
+            history_index: Optional index of past routed tickets, used for few-shot
+                examples and to route near-duplicates without calling the LLM
         """
         self.api_key = api_key
         self.provider = provider.lower()
+        self.timeout = timeout
         
         if model:
             self.model = model
@@ -42,13 +142,325 @@ class TicketProcessorSimple:
             self.api_base = "http://localhost:11434/v1"
         else:
             self.api_base = "https://api.groq.com/openai/v1"
+        
+        # Token budget and tokenizer of the target model
+        self.prompt_builder = PromptBuilder(self.model, max_input_tokens=max_input_tokens)
+        
+        # Shared request/token quota of the provider (None for local Ollama)
+        self.rate_limiter = get_rate_limiter(self.provider)
+        self.rate_limit_wait = rate_limit_wait
+        
+        # Large catalogs: only the closest departments go into the prompt
+        self.shortlist_size = shortlist_size
+        
+        self.history_index = history_index
+        
+        # Full departments block of the last index (see prepare_departments)
+        self._departments: Tuple[Optional[DepartmentIndex], str] = (None, "")
+    
+    def prepare_departments(self, reparti: List[Dict[str, str]]) -> None:
+        """
+        Build the department index (and the full prompt block, or the
+        embeddings for large catalogs) once; later calls passing the same
+        list object reuse them.
+        """
+        index = get_department_index(reparti)
+        if len(index) > self.shortlist_size:
+            index.build()
+        else:
+            self._departments_block(index, "")
+    
+    def _departments_block(self, index: DepartmentIndex, query: str) -> Tuple[str, List[Dict[str, str]]]:
+        """
+        Departments prompt block for an email.
+        
+        Returns:
+            Tuple (rendered block, departments included in it)
+        """
+        builder = self.prompt_builder
+        if len(index) > self.shortlist_size:
+            candidates = index.shortlist(query, self.shortlist_size)
+            return builder.render_departments(candidates, builder.max_input_tokens // 2), candidates
+        
+        cached_index, rendered = self._departments
+        if index is not cached_index:
+            rendered = builder.render_departments(index.reparti, builder.max_input_tokens // 2)
+            self._departments = (index, rendered)
+        return rendered, index.reparti
+    
+    def _similar_tickets(
+        self,
+        query: str,
+        reparti: List[Dict[str, str]],
+        email_id: Optional[str] = None
+    ) -> List[SimilarTicket]:
+        """Past tickets similar to the email (never the email itself), limited to departments that still exist"""
+        if self.history_index is None:
+            return []
+        index = get_department_index(reparti)
+        try:
+            hits = self.history_index.search(query, k=HISTORY_EXAMPLES, min_score=HISTORY_MIN_SIMILARITY,
+                                             exclude_id=email_id)
+        except Exception as e:
+            logger.warning(f"Ticket history search failed: {e}")
+            return []
+        return [h for h in hits if h.department in index]
+    
+    def _history_route(self, subject: str, body: str, similar: List[SimilarTicket]) -> Optional[Dict]:
+        """
+        Routing result copied from a near-duplicate past ticket.
+        
+        The confidence is the past ticket's own, never above the similarity;
+        the summary is the past ticket's, or the start of this email if it
+        has none.
+        """
+        if not similar or similar[0].score < HISTORY_DIRECT_ROUTE_SIMILARITY:
+            return None
+        top = similar[0]
+        similarity = min(100, round(top.score * 100))
+        try:
+            confidence = min(similarity, int(top.confidence))
+        except (TypeError, ValueError):
+            confidence = similarity
+        first_line = next((line.strip() for line in body.splitlines() if line.strip()), '')
+        summary = top.summary or ' — '.join(p for p in (subject, first_line) if p)
+        logger.info(f"📚 Near-duplicate of past ticket ({top.score:.2f}), routing to {top.department} without LLM")
+        return {
+            'reparto_suggerito': top.department,
+            'confidence': confidence,
+            'summary': summary[:100],
+            'reasoning': f"Same as past ticket '{top.subject[:80]}' (similarity {top.score:.2f})",
+            'routed_by': 'history',
+        }
+    
+    def _build_messages(
+        self,
+        subject: str,
+        body: str,
+        pdf_content: str,
+        reparti: List[Dict[str, str]],
+        email_id: Optional[str] = None
+    ) -> PromptContext:
+        """
+        Build chat messages within the model's token budget.
+        
+        Departments may use up to half of the budget; the rest is shared by
+        subject, body, PDF content and similar past tickets in this order of
+        priority. With more than shortlist_size departments only the most
+        similar ones are listed. If the email is a near-duplicate of a past
+        ticket, no messages are built and direct_route is set instead.
+        """
+        builder = self.prompt_builder
+        
+        # Strip tracking links, quoted history, signatures and footers
+        cleaned = clean_email_text(body, count_tokens=builder.count)
+        logger.info(
+            f"Preprocessing: {cleaned.original_tokens} -> {cleaned.cleaned_tokens} tokens "
+            f"({cleaned.tokens_saved} saved)"
+        )
+        
+        query = ticket_text(subject, cleaned.text, cleaned=True)
+        similar = self._similar_tickets(query, reparti, email_id)
+        direct_route = self._history_route(subject, cleaned.text, similar)
+        if self.history_index is not None:
+            cache_hit('history_route', direct_route is not None)
+        if direct_route:
+            return PromptContext([], cleaned.tokens_saved, [], similar, direct_route)
+        
+        reparti_desc, candidates = self._departments_block(get_department_index(reparti), query)
+        examples = "\n".join(f"- [{h.department}] {h.subject} — {h.summary}".rstrip(" —") for h in similar)
+        
+        parts = builder.allocate(
+            fixed=[SYSTEM_PROMPT, USER_PROMPT_TEMPLATE, EXAMPLES_TEMPLATE, reparti_desc],
+            sections=[
+                PromptSection('subject', subject or '', priority=0, min_tokens=100, max_tokens=100),
+                PromptSection('body', cleaned.text, priority=1, min_tokens=512),
+                PromptSection('pdf', (pdf_content or '').strip(), priority=2),
+                PromptSection('examples', examples, priority=3, max_tokens=300),
+            ]
+        )
+        
+        # Combine content
+        full_content = f"Subject: {parts['subject']}\n\n{parts['body']}"
+        if parts['pdf']:
+            full_content += f"\n\nPDF Attachment:\n{parts['pdf']}"
+        
+        user_prompt = USER_PROMPT_TEMPLATE.format(
+            reparti_desc=reparti_desc,
+            examples=EXAMPLES_TEMPLATE.format(examples=parts['examples']) if parts['examples'] else "",
+            content=full_content
+        )
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt}
+        ]
+        return PromptContext(messages, cleaned.tokens_saved, candidates, similar)
+    
+    def _headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+    
+    def _chat_payload(
+        self,
+        messages: List[Dict[str, str]],
+        stream: bool = False,
+        fields: Optional[List[str]] = None
+    ) -> Dict:
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": 0,
+            "max_tokens": self.prompt_builder.max_output_tokens,
+        }
+        
+        # Constrained decoding: Ollama accepts the full JSON schema,
+        # Groq supports response_format to force JSON
+        if self.provider == "ollama":
+            payload["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": DEPARTMENT_ROUTING.name,
+                    "schema": DEPARTMENT_ROUTING.json_schema(only=fields)
+                }
+            }
+        elif self.provider == "groq":
+            payload["response_format"] = {"type": "json_object"}
+        if stream:
+            payload["stream"] = True
+        return payload
+    
+    def _complete_missing_fields(
+        self,
+        messages: List[Dict[str, str]],
+        result_text: str,
+        result: Dict,
+        missing: List[str]
+    ) -> Dict:
+        """Ask again only for the fields missing from the first answer"""
+        logger.warning(f"Missing fields {missing}, requesting only those")
+        followup = messages + [
+            {"role": "assistant", "content": result_text},
+            {"role": "user", "content": missing_fields_prompt(DEPARTMENT_ROUTING, missing)}
+        ]
+        response, _ = self._post_chat(followup, fields=missing)
+        extra = parse_json_lenient(response.json()["choices"][0]["message"]["content"])
+        merged = dict(result)
+        merged.update({k: v for k, v in extra.items() if k in missing})
+        return merged
+    
+    def _parse_with_retry(self, messages: List[Dict[str, str]], result_text: str) -> Dict:
+        """Tolerant parse; a single follow-up request covers missing fields"""
+        result, missing = DEPARTMENT_ROUTING.parse(result_text)
+        if missing:
+            result, _ = DEPARTMENT_ROUTING.validate(
+                self._complete_missing_fields(messages, result_text, result, missing)
+            )
+        return result
+    
+    @staticmethod
+    def _validate_department(result: Dict, reparti: List[Dict[str, str]], candidates: List[Dict[str, str]]) -> Dict:
+        """Replace an unknown department with the best candidate, lowering confidence"""
+        reparto = get_department_index(reparti).get(result['reparto_suggerito'])
+        if reparto:
+            result['reparto_suggerito'] = reparto['nome']
+        else:
+            logger.warning(f"Department '{result['reparto_suggerito']}' not found")
+            # Fallback to first (most similar when shortlisted)
+            if candidates:
+                result['reparto_suggerito'] = candidates[0]['nome']
+                result['confidence'] = max(0, result.get('confidence', 50) - 30)
+        return result
+    
+    def _finalize_result(self, result: Dict, reparti: List[Dict[str, str]], ctx: PromptContext) -> Optional[Dict]:
+        # LOG DETTAGLIATO PER DEBUG CONFIDENCE
+        logger.info(f"🔍 PARSED JSON RESULT: {json.dumps(result, indent=2)}")
+        logger.info(f"🔍 CONFIDENCE VALUE: {result.get('confidence')} (type: {type(result.get('confidence'))})")
+        
+        # Validate
+        result, missing = DEPARTMENT_ROUTING.validate(result)
+        if missing:
+            logger.error(f"Incomplete response (missing {missing}): {result}")
+            return None
+        
+        self._validate_department(result, reparti, ctx.candidates)
+        result['tokens_saved'] = ctx.tokens_saved
+        if ctx.similar:
+            result['similar_tickets'] = [
+                {'id': h.id, 'department': h.department, 'score': round(h.score, 3)} for h in ctx.similar
+            ]
+        
+        logger.info(f"✅ Analysis: {result['reparto_suggerito']} ({result['confidence']}%)")
+        return result
+    
+    def _post_chat(
+        self,
+        messages: List[Dict[str, str]],
+        stream: bool = False,
+        fields: Optional[List[str]] = None
+    ) -> Tuple[object, int]:
+        """
+        POST to /chat/completions within the provider's rate limit.
+        
+        A 429 pauses the shared limiter for Retry-After and is retried once if
+        the pause fits in rate_limit_wait.
+        
+        Returns:
+            Tuple (response, estimated tokens charged to the limiter)
+        
+        Raises:
+            LLMProviderError: On HTTP errors, timeouts and connection errors
+        """
+        import requests
+        
+        builder = self.prompt_builder
+        estimated = sum(builder.count_static(m["content"]) if m["role"] == "system" else builder.count(m["content"])
+                        for m in messages) \
+            + builder.max_output_tokens
+        
+        for attempt in range(2):
+            if self.rate_limiter:
+                try:
+                    self.rate_limiter.acquire(estimated, max_wait=self.rate_limit_wait)
+                except RateLimitTimeout as e:
+                    raise LLMProviderError(str(e), status_code=429) from e
+            
+            try:
+                response = requests.post(
+                    f"{self.api_base}/chat/completions",
+                    headers=self._headers(),
+                    json=self._chat_payload(messages, stream=stream, fields=fields),
+                    timeout=self.timeout,
+                    stream=stream
+                )
+            except requests.Timeout as e:
+                raise LLMProviderError(f"{self.provider} timeout: {e}") from e
+            except requests.ConnectionError as e:
+                raise LLMProviderError(f"{self.provider} connection error: {e}") from e
+            
+            if response.status_code == 200:
+                return response, estimated
+            
+            retry_after = _retry_after(response)
+            if response.status_code == 429 and self.rate_limiter:
+                self.rate_limiter.penalize(retry_after)
+                if attempt == 0 and (retry_after or 0) <= self.rate_limit_wait:
+                    continue
+            raise LLMProviderError(
+                f"API error {response.status_code}: {response.text}",
+                status_code=response.status_code,
+                retry_after=retry_after
+            )
     
     def analyze_email(
         self, 
         subject: str, 
         body: str, 
         pdf_content: str,
-        reparti: List[Dict[str, str]]
+        reparti: List[Dict[str, str]],
+        raise_on_error: bool = False,
+        email_id: Optional[str] = None
     ) -> Optional[Dict]:
         """
         Analyze email with LLM and suggest department.
@@ -58,80 +470,19 @@ class TicketProcessorSimple:
             body: Email body
             pdf_content: Content extracted from PDF attachment
             reparti: Departments list [{"nome": "...", "descrizione": "...", "email": "..."}]
+            raise_on_error: Raise LLMProviderError on provider failures instead of returning None
+            email_id: Id of a stored email, excluded from the similar past tickets
         
         Returns:
             Dict with: reparto_suggerito, confidence, summary, reasoning
         """
         try:
-            import requests
-            
-            # Combine content
-            full_content = f"Subject: {subject}\n\n{body}"
-            if pdf_content and pdf_content.strip():
-                full_content += f"\n\nPDF Attachment:\n{pdf_content[:2000]}"  # Limit length
-            
-            # Build departments description
-            reparti_desc = "\n".join([
-                f"- {r['nome']}: {r.get('descrizione', 'No description')}"
-                for r in reparti
-            ])
+            ctx = self._build_messages(subject, body, pdf_content, reparti, email_id)
+            if ctx.direct_route:
+                return self._finalize_result(ctx.direct_route, reparti, ctx)
             
-            # Prompt
-            system_prompt = """You are an AI assistant expert in classifying support tickets.
-Analyze the provided email and determine which department should handle it.
-
-IMPORTANT: Evaluate confidence CAREFULLY based on:
-- Clear technical terms or product mentions = 90-100% confidence
-- General support requests with some context = 70-85% confidence  
-- Marketing/promotional emails = 60-80% confidence
-- Unclear or ambiguous requests = 40-65% confidence
-- Completely unclear or spam = 10-40% confidence
-
-Respond ONLY with valid JSON in the format:
-{
-    "reparto_suggerito": "exact_department_name",
-    "confidence": 75,
-    "summary": "Brief problem summary (max 100 characters)",
-    "reasoning": "Choice reasoning (max 150 characters)"
-}"""
-
-            user_prompt = f"""Available departments:
-{reparti_desc}
-
-Email to analyze:
-{full_content[:3000]}
-
-Choose one of the departments listed above. If confidence < 70%, indicate need for human review."""
-
             # Chiamata API
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            payload = {
-                "model": self.model,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "temperature": 0,
-            }
-            
-            # Groq supports response_format to force JSON
-            if self.provider == "groq":
-                payload["response_format"] = {"type": "json_object"}
-            
-            response = requests.post(
-                f"{self.api_base}/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"API error {response.status_code}: {response.text}")
-                return None
+            response, estimated_tokens = self._post_chat(ctx.messages)
             
             logger.info(f"API response status: {response.status_code}")
             logger.info(f"API response: {response.text[:500]}")  # Log first 500 chars
@@ -139,43 +490,21 @@ Choose one of the departments listed above. If confidence < 70%, indicate need f
             response_json = response.json()
             logger.info(f"Response JSON keys: {response_json.keys()}")
             
+            if self.rate_limiter:
+                usage = response_json.get("usage") or {}
+                self.rate_limiter.reconcile(estimated_tokens, usage.get("total_tokens"))
+            
             result_text = response_json["choices"][0]["message"]["content"]
             logger.info(f"Result text: {result_text}")
             
-            # Remove markdown code blocks if present (Ollama often wraps in ```json ... ```)
-            result_text = result_text.strip()
-            if result_text.startswith("```json"):
-                result_text = result_text[7:]  # Remove ```json
-            if result_text.startswith("```"):
-                result_text = result_text[3:]  # Remove ```
-            if result_text.endswith("```"):
-                result_text = result_text[:-3]  # Remove trailing ```
-            result_text = result_text.strip()
-            
-            result = json.loads(result_text)
-            
-            # LOG DETTAGLIATO PER DEBUG CONFIDENCE
-            logger.info(f"🔍 PARSED JSON RESULT: {json.dumps(result, indent=2)}")
-            logger.info(f"🔍 CONFIDENCE VALUE: {result.get('confidence')} (type: {type(result.get('confidence'))})")
-            
-            # Validate
-            required = ['reparto_suggerito', 'confidence', 'summary']
-            if not all(k in result for k in required):
-                logger.error(f"Incomplete response: {result}")
-                return None
-            
-            # Validate department exists
-            reparto_nomi = [r['nome'].lower() for r in reparti]
-            if result['reparto_suggerito'].lower() not in reparto_nomi:
-                logger.warning(f"Department '{result['reparto_suggerito']}' not found")
-                # Fallback to first
-                if reparti:
-                    result['reparto_suggerito'] = reparti[0]['nome']
-                    result['confidence'] = max(0, result.get('confidence', 50) - 30)
-            
-            logger.info(f"✅ Analysis: {result['reparto_suggerito']} ({result['confidence']}%)")
-            return result
+            result = self._parse_with_retry(ctx.messages, result_text)
+            return self._finalize_result(result, reparti, ctx)
             
+        except LLMProviderError as e:
+            logger.error(str(e))
+            if raise_on_error:
+                raise
+            return None
         except json.JSONDecodeError as e:
             logger.error(f"JSON parsing error: {e}")
             return None
@@ -183,16 +512,104 @@ Choose one of the departments listed above. If confidence < 70%, indicate need f
             logger.error(f"Analysis error: {e}", exc_info=True)
             return None
     
+    def _stream_chat(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        """
+        Stream a chat completion (server-sent events).
+        
+        Yields:
+            Content deltas as they are generated
+        """
+        response, _ = self._post_chat(messages, stream=True)
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                choices = chunk.get("choices") or []
+                if not choices:
+                    continue
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+    
+    def analyze_email_stream(
+        self,
+        subject: str,
+        body: str,
+        pdf_content: str,
+        reparti: List[Dict[str, str]],
+        email_id: Optional[str] = None,
+        raise_on_error: bool = False
+    ) -> Iterator[Tuple[str, Optional[Dict]]]:
+        """
+        Analyze email with a streamed completion.
+        
+        The routing decision is yielded as soon as reparto_suggerito and
+        confidence are complete, while summary and reasoning are still
+        being generated.
+        
+        Yields:
+            ('route', {'reparto_suggerito', 'confidence'}) at most once, then
+            ('final', analysis_result) with the same content as analyze_email
+            (None on error)
+        
+        Raises:
+            LLMProviderError: On provider failures, if raise_on_error is set
+        """
+        try:
+            ctx = self._build_messages(subject, body, pdf_content, reparti, email_id)
+            if ctx.direct_route:
+                route = {k: ctx.direct_route[k] for k in ROUTING_FIELDS}
+                yield 'route', route
+                yield 'final', self._finalize_result(ctx.direct_route, reparti, ctx)
+                return
+            
+            parser = IncrementalJSONParser()
+            result_text = ""
+            routed = False
+            start = time.monotonic()
+            
+            for delta in self._stream_chat(ctx.messages):
+                result_text += delta
+                if routed or not parser.feed(delta):
+                    continue
+                if all(k in parser.fields for k in ROUTING_FIELDS) \
+                        and isinstance(parser.fields['confidence'], (int, float)):
+                    route = {k: parser.fields[k] for k in ROUTING_FIELDS}
+                    self._validate_department(route, reparti, ctx.candidates)
+                    routed = True
+                    logger.info(
+                        f"⚡ Early route after {time.monotonic() - start:.2f}s: "
+                        f"{route['reparto_suggerito']} ({route['confidence']}%)"
+                    )
+                    yield 'route', route
+            
+            logger.info(f"Result text: {result_text}")
+            result = self._parse_with_retry(ctx.messages, result_text)
+            yield 'final', self._finalize_result(result, reparti, ctx)
+            
+        except LLMProviderError as e:
+            logger.error(str(e))
+            if raise_on_error:
+                raise
+            yield 'final', None
+        except json.JSONDecodeError as e:
+            logger.error(f"JSON parsing error: {e}")
+            yield 'final', None
+        except Exception as e:
+            logger.error(f"Analysis error: {e}", exc_info=True)
+            yield 'final', None
+    
     def get_reparto_details(
         self, 
         reparto_nome: str, 
         reparti: List[Dict[str, str]]
     ) -> Optional[Dict[str, str]]:
         """Find department details by name"""
-        for r in reparti:
-            if r['nome'].lower() == reparto_nome.lower():
-                return r
-        return None
+        return get_department_index(reparti).get(reparto_nome)
     
     def process_ticket(
         self,
@@ -200,16 +617,35 @@ Choose one of the departments listed above. If confidence < 70%, indicate need f
         subject: str,
         body: str,
         pdf_content: str,
-        reparti: List[Dict[str, str]]
+        reparti: List[Dict[str, str]],
+        on_route: Optional[Callable[[Dict, Dict], None]] = None,
+        email_id: Optional[str] = None
     ) -> Tuple[Optional[Dict], Optional[Dict]]:
         """
         Process ticket: analyze and determine routing.
         
+        Args:
+            on_route: Optional callback (route, department_details) called as soon
+                as the department is known; enables the streamed completion. Only
+                for previews (the GUI shows the department while the summary is
+                generated): forwarding needs the summary and waits for the result
+            email_id: Id of a stored email, excluded from the similar past tickets
+        
         Returns:
             Tuple (analysis_result, department_details) or (None, None) on error
         """
         try:
-            analysis = self.analyze_email(subject, body, pdf_content, reparti)
+            if on_route is None:
+                analysis = self.analyze_email(subject, body, pdf_content, reparti, email_id=email_id)
+            else:
+                analysis = None
+                for event, data in self.analyze_email_stream(subject, body, pdf_content, reparti, email_id):
+                    if event == 'route':
+                        reparto = self.get_reparto_details(data['reparto_suggerito'], reparti)
+                        if reparto:
+                            on_route(data, reparto)
+                    else:
+                        analysis = data
             
             if not analysis:
                 return None, None
@@ -0,0 +1,365 @@
+"""
+In-memory time-series store for throughput and latency dashboards.
+
+Every series keeps three fixed-size ring buffers (per-minute for the last
+day, per-hour for the last 30 days, per-day for the last year), so memory
+is bounded regardless of uptime. Each slot stores count/sum/min/max and,
+for latency series, a log-scale histogram that allows percentiles on any
+window.
+
+Series come in three kinds: counters (increment, summarized as a rate),
+gauges (sampled values such as confidence, summarized as an average) and
+latency observations (observe, with percentiles).
+"""
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Risoluzione -> (secondi per slot, numero di slot)
+RESOLUTIONS = {
+    'minute': (60, 24 * 60),
+    'hour': (3600, 30 * 24),
+    'day': (86400, 366),
+}
+
+# Istogramma log-scala: da 1 ms a ~41 s, 3 bucket per ottava (errore < 26%); i valori
+# oltre finiscono nell'ultimo bucket e i percentili li riportano come ~52 s
+HISTOGRAM_MIN = 0.001
+HISTOGRAM_BUCKETS_PER_OCTAVE = 3
+HISTOGRAM_BUCKETS = 48
+
+# Limiti al numero di serie (combinazioni metrica/etichette). Ogni serie ha
+# 2526 slot (1440 + 720 + 366): ~100 KB per contatore o gauge (40 B per slot),
+# ~590 KB per serie con istogramma (+192 B per slot); al massimo ~80 MB
+MAX_SERIES = 500
+MAX_HISTOGRAM_SERIES = 64
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _bucket(value: float) -> int:
+    if value <= HISTOGRAM_MIN:
+        return 0
+    index = int(math.log2(value / HISTOGRAM_MIN) * HISTOGRAM_BUCKETS_PER_OCTAVE) + 1
+    return min(index, HISTOGRAM_BUCKETS - 1)
+
+
+def _bucket_upper(index: int) -> float:
+    return HISTOGRAM_MIN * 2 ** (index / HISTOGRAM_BUCKETS_PER_OCTAVE)
+
+
+def _percentile(histogram: np.ndarray, pct: float) -> Optional[float]:
+    total = histogram.sum()
+    if not total:
+        return None
+    index = int(np.searchsorted(np.cumsum(histogram), math.ceil(total * pct / 100)))
+    return round(_bucket_upper(index), 6)
+
+
+class RingSeries:
+    """Fixed-interval ring buffer of aggregated samples"""
+
+    def __init__(self, interval: int, slots: int, histogram: bool):
+        self.interval = interval
+        self.slots = slots
+        self.epoch = np.full(slots, -1, dtype=np.int64)  # slot start / interval
+        self.count = np.zeros(slots, dtype=np.int64)
+        self.sum = np.zeros(slots, dtype=np.float64)
+        self.min = np.zeros(slots, dtype=np.float64)
+        self.max = np.zeros(slots, dtype=np.float64)
+        self.histogram = np.zeros((slots, HISTOGRAM_BUCKETS), dtype=np.int32) if histogram else None
+
+    def _slot(self, ts: float) -> int:
+        epoch = int(ts // self.interval)
+        slot = epoch % self.slots
+        if self.epoch[slot] != epoch:
+            # Slot riutilizzato: azzera i dati di un giro precedente
+            self.epoch[slot] = epoch
+            self.count[slot] = 0
+            self.sum[slot] = 0.0
+            if self.histogram is not None:
+                self.histogram[slot] = 0
+        return slot
+
+    def add(self, value: float, ts: float, bucket: Optional[int] = None) -> None:
+        slot = self._slot(ts)
+        if self.count[slot] == 0:
+            self.min[slot] = self.max[slot] = value
+        else:
+            self.min[slot] = min(self.min[slot], value)
+            self.max[slot] = max(self.max[slot], value)
+        self.count[slot] += 1
+        self.sum[slot] += value
+        if self.histogram is not None and bucket is not None:
+            self.histogram[slot, bucket] += 1
+
+    def _valid(self, start: float, end: float) -> np.ndarray:
+        first, last = int(start // self.interval), int(end // self.interval)
+        return (self.epoch >= first) & (self.epoch <= last) & (self.epoch >= 0)
+
+    def points(self, start: float, end: float) -> List[Dict]:
+        """One point per non-empty slot in [start, end], oldest first"""
+        slots = np.nonzero(self._valid(start, end))[0]
+        slots = slots[np.argsort(self.epoch[slots])]
+        points = []
+        for slot in slots:
+            count = int(self.count[slot])
+            point = {
+                't': int(self.epoch[slot] * self.interval),
+                'count': count,
+                'sum': round(float(self.sum[slot]), 6),
+                'min': round(float(self.min[slot]), 6),
+                'max': round(float(self.max[slot]), 6),
+                'avg': round(float(self.sum[slot]) / count, 6) if count else None,
+            }
+            if self.histogram is not None:
+                point['p50'] = _percentile(self.histogram[slot], 50)
+                point['p95'] = _percentile(self.histogram[slot], 95)
+            points.append(point)
+        return points
+
+    def summary(self, start: float, end: float) -> Dict:
+        """Aggregate of all slots in [start, end]"""
+        mask = self._valid(start, end)
+        count = int(self.count[mask].sum())
+        result = {
+            'count': count,
+            'sum': round(float(self.sum[mask].sum()), 6),
+            'avg': round(float(self.sum[mask].sum()) / count, 6) if count else None,
+            'min': round(float(self.min[mask][self.count[mask] > 0].min()), 6) if count else None,
+            'max': round(float(self.max[mask][self.count[mask] > 0].max()), 6) if count else None,
+        }
+        if self.histogram is not None:
+            histogram = self.histogram[mask].sum(axis=0)
+            result['p50'] = _percentile(histogram, 50)
+            result['p95'] = _percentile(histogram, 95)
+            result['p99'] = _percentile(histogram, 99)
+        return result
+
+
+COUNTER, GAUGE, HISTOGRAM = 'counter', 'gauge', 'histogram'
+
+
+class _Series:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.histogram = kind == HISTOGRAM
+        self.rings = {name: RingSeries(interval, slots, self.histogram)
+                      for name, (interval, slots) in RESOLUTIONS.items()}
+
+
+class TimeSeriesStore:
+    """Counters and latency observations by metric and labels"""
+
+    def __init__(self, max_series: int = MAX_SERIES, max_histogram_series: int = MAX_HISTOGRAM_SERIES):
+        self.max_series = max_series
+        self.max_histogram_series = max_histogram_series
+        self._series: Dict[Tuple[str, Labels], _Series] = {}
+        self._histogram_series = 0
+        self._lock = threading.Lock()
+        self._dropped = 0
+
+    @staticmethod
+    def _labels(labels: Dict[str, object]) -> Labels:
+        return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+    def _get(self, metric: str, labels: Labels, kind: str) -> Optional[_Series]:
+        key = (metric, labels)
+        series = self._series.get(key)
+        if series is None:
+            histogram = kind == HISTOGRAM
+            if len(self._series) >= self.max_series or (
+                    histogram and self._histogram_series >= self.max_histogram_series):
+                self._dropped += 1
+                if self._dropped == 1:
+                    logger.warning(f"⚠️ Time-series limit reached, dropping new series ({metric} {dict(labels)})")
+                return None
+            series = self._series[key] = _Series(kind)
+            self._histogram_series += histogram
+        elif series.kind != kind:
+            raise ValueError(f"{metric} is a {series.kind}, not a {kind}")
+        return series
+
+    def increment(self, metric: str, value: float = 1, ts: Optional[float] = None, **labels) -> None:
+        """Add value to a counter (e.g. emails processed)"""
+        ts = ts if ts is not None else time.time()
+        with self._lock:
+            series = self._get(metric, self._labels(labels), COUNTER)
+            if series is not None:
+                for ring in series.rings.values():
+                    ring.add(value, ts)
+
+    def gauge(self, metric: str, value: float, ts: Optional[float] = None, **labels) -> None:
+        """Record a sampled value, averaged rather than summed (e.g. confidence)"""
+        ts = ts if ts is not None else time.time()
+        with self._lock:
+            series = self._get(metric, self._labels(labels), GAUGE)
+            if series is not None:
+                for ring in series.rings.values():
+                    ring.add(value, ts)
+
+    def observe(self, metric: str, value: float, ts: Optional[float] = None, **labels) -> None:
+        """Record a measurement with percentiles (e.g. latency in seconds)"""
+        ts = ts if ts is not None else time.time()
+        bucket = _bucket(value)
+        with self._lock:
+            series = self._get(metric, self._labels(labels), HISTOGRAM)
+            if series is not None:
+                for ring in series.rings.values():
+                    ring.add(value, ts, bucket=bucket)
+
+    @contextmanager
+    def timer(self, metric: str, **labels):
+        """Observe the duration of a block in seconds (also when it raises)"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(metric, time.monotonic() - start, **labels)
+
+    def series(self) -> List[Dict]:
+        """Known metrics and label sets"""
+        with self._lock:
+            return [{'metric': m, 'labels': dict(l), 'kind': s.kind, 'histogram': s.histogram}
+                    for (m, l), s in sorted(self._series.items(), key=lambda item: item[0])]
+
+    def memory_bytes(self) -> int:
+        """Memory held by the ring buffers"""
+        with self._lock:
+            return sum(
+                sum(a.nbytes for a in (r.epoch, r.count, r.sum, r.min, r.max, r.histogram) if a is not None)
+                for s in self._series.values() for r in s.rings.values()
+            )
+
+    def _matching(self, metric: str, labels: Dict[str, str]) -> List[Tuple[Labels, _Series]]:
+        wanted = {k: str(v) for k, v in labels.items() if v is not None}
+        return [(l, s) for (m, l), s in self._series.items()
+                if m == metric and all(dict(l).get(k) == v for k, v in wanted.items())]
+
+    def query(
+        self,
+        metric: str,
+        resolution: str = 'minute',
+        window: float = 3600,
+        group_by: Optional[str] = None,
+        end: Optional[float] = None,
+        **labels
+    ) -> Dict[str, List[Dict]]:
+        """
+        Points of a metric over the last window seconds.
+
+        Args:
+            metric: Metric name
+            resolution: 'minute', 'hour' or 'day'
+            window: Seconds back from end
+            group_by: Label to split the result by (default: one merged group)
+            end: End timestamp (default: now)
+            **labels: Label filters (e.g. department='IT')
+
+        Returns:
+            Dict group -> points; with several series in a group, points of
+            the same timestamp are merged (percentiles from merged histograms)
+        """
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"Unknown resolution '{resolution}' (use {', '.join(RESOLUTIONS)})")
+        end = end if end is not None else time.time()
+        start = end - window
+
+        with self._lock:
+            groups: Dict[str, List[RingSeries]] = {}
+            for label_set, series in self._matching(metric, labels):
+                group = dict(label_set).get(group_by, '') if group_by else 'all'
+                groups.setdefault(group, []).append(series.rings[resolution])
+
+            result = {}
+            for group, rings in groups.items():
+                if len(rings) == 1:
+                    result[group] = rings[0].points(start, end)
+                    continue
+                merged: Dict[int, Dict] = {}
+                histograms: Dict[int, np.ndarray] = {}
+                for ring in rings:
+                    mask = np.nonzero(ring._valid(start, end))[0]
+                    for point in ring.points(start, end):
+                        m = merged.setdefault(point['t'], {'t': point['t'], 'count': 0, 'sum': 0.0,
+                                                            'min': point['min'], 'max': point['max']})
+                        m['count'] += point['count']
+                        m['sum'] = round(m['sum'] + point['sum'], 6)
+                        m['min'] = min(m['min'], point['min'])
+                        m['max'] = max(m['max'], point['max'])
+                    if ring.histogram is not None:
+                        for slot in mask:
+                            t = int(ring.epoch[slot] * ring.interval)
+                            histograms[t] = histograms.get(t, 0) + ring.histogram[slot]
+                for t, m in merged.items():
+                    m['avg'] = round(m['sum'] / m['count'], 6) if m['count'] else None
+                    if t in histograms:
+                        m['p50'] = _percentile(histograms[t], 50)
+                        m['p95'] = _percentile(histograms[t], 95)
+                result[group] = [merged[t] for t in sorted(merged)]
+            return result
+
+    def summary(self, metric: str, window: float = 3600, group_by: Optional[str] = None,
+                end: Optional[float] = None, **labels) -> Dict[str, Dict]:
+        """
+        Aggregate of a metric over the last window seconds, with rate per minute.
+
+        Counters report their sum per minute; gauges and latency series
+        report samples per minute, gauges also min/max of the values.
+        Uses the finest resolution that covers the window.
+        """
+        end = end if end is not None else time.time()
+        start = end - window
+        resolution = next(name for name, (interval, slots) in RESOLUTIONS.items()
+                          if interval * slots >= window or name == 'day')
+
+        with self._lock:
+            groups: Dict[str, Tuple[str, List[RingSeries]]] = {}
+            for label_set, series in self._matching(metric, labels):
+                group = dict(label_set).get(group_by, '') if group_by else 'all'
+                groups.setdefault(group, (series.kind, []))[1].append(series.rings[resolution])
+
+            result = {}
+            for group, (kind, rings) in groups.items():
+                parts = [ring.summary(start, end) for ring in rings]
+                count = sum(p['count'] for p in parts)
+                total = sum(p['sum'] for p in parts)
+                summary = {
+                    'count': count,
+                    'sum': round(total, 6),
+                    'avg': round(total / count, 6) if count else None,
+                    # Contatori: somma al minuto; gauge e misure: campioni al minuto
+                    'per_minute': round((total if kind == COUNTER else count) / (window / 60), 3),
+                }
+                if kind == GAUGE:
+                    values = [p for p in parts if p['count']]
+                    summary['min'] = min(p['min'] for p in values) if values else None
+                    summary['max'] = max(p['max'] for p in values) if values else None
+                if kind == HISTOGRAM:
+                    mask_hist = sum(ring.histogram[ring._valid(start, end)].sum(axis=0) for ring in rings)
+                    summary['p50'] = _percentile(mask_hist, 50)
+                    summary['p95'] = _percentile(mask_hist, 95)
+                    summary['p99'] = _percentile(mask_hist, 99)
+                result[group] = summary
+            return result
+
+
+_store: Optional[TimeSeriesStore] = None
+_store_lock = threading.Lock()
+
+
+def get_timeseries() -> TimeSeriesStore:
+    """Process-wide time-series store"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = TimeSeriesStore()
+    return _store
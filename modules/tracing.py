@@ -0,0 +1,258 @@
+"""
+Lightweight tracing for the processing pipeline.
+
+`span(stage)` times a block and records it in a per-stage latency
+histogram; inside a `trace(email_id)` block the spans are also collected
+into a per-email breakdown, so a slow ticket shows where its time went
+(IMAP, PDF, LLM, geocoding, SMTP...). Recording is a lock-protected
+bucket increment; histograms are only converted to Prometheus text when
+someone asks for them.
+"""
+import contextvars
+import logging
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Sottobucket lineari per ogni potenza di 2: errore relativo < 1/32 (~3%)
+SUB_BUCKETS = 32
+# Bucket esportati in formato Prometheus (secondi)
+PROMETHEUS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Tracce complete conservate per /api/traces
+RECENT_TRACES = 200
+# Tracce più lente di così vengono loggate con il dettaglio degli stage
+SLOW_TRACE_SECONDS = 30.0
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram: log-linear buckets with bounded relative error.
+
+    Buckets are sparse (only ranges actually observed take memory), so the
+    histogram covers microseconds to hours at constant precision.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    @staticmethod
+    def _index(value: float) -> int:
+        if value <= 0:
+            return -(1 << 30)
+        mantissa, exponent = math.frexp(value)  # mantissa in [0.5, 1)
+        return exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+
+    @staticmethod
+    def _upper(index: int) -> float:
+        exponent, sub = divmod(index, SUB_BUCKETS)
+        return math.ldexp(0.5 + (sub + 1) / (2 * SUB_BUCKETS), exponent)
+
+    def record(self, value: float) -> None:
+        index = self._index(value)
+        with self._lock:
+            self._buckets[index] = self._buckets.get(index, 0) + 1
+            self.count += 1
+            self.sum += value
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self._lock:
+            if not self.count:
+                return None
+            rank = math.ceil(self.count * pct / 100)
+            seen = 0
+            for index in sorted(self._buckets):
+                seen += self._buckets[index]
+                if seen >= rank:
+                    return min(self._upper(index), self.max)
+        return self.max
+
+    def cumulative(self, bounds=PROMETHEUS_BUCKETS) -> List[int]:
+        """Cumulative counts for each upper bound (Prometheus 'le' buckets)"""
+        with self._lock:
+            items = sorted(self._buckets.items())
+        result, seen, i = [], 0, 0
+        for bound in bounds:
+            while i < len(items) and self._upper(items[i][0]) <= bound:
+                seen += items[i][1]
+                i += 1
+            result.append(seen)
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        p50, p95, p99 = self.percentile(50), self.percentile(95), self.percentile(99)
+        return {
+            'count': self.count,
+            'sum_s': round(self.sum, 6),
+            'avg_ms': round(self.sum / self.count * 1000, 2) if self.count else None,
+            'min_ms': round(self.min * 1000, 2) if self.count else None,
+            'max_ms': round(self.max * 1000, 2) if self.count else None,
+            'p50_ms': round(p50 * 1000, 2) if p50 is not None else None,
+            'p95_ms': round(p95 * 1000, 2) if p95 is not None else None,
+            'p99_ms': round(p99 * 1000, 2) if p99 is not None else None,
+        }
+
+
+@dataclass
+class Span:
+    """Timed stage of a trace"""
+    stage: str
+    start: float
+    duration: float = 0.0
+    error: Optional[str] = None
+    attrs: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class Trace:
+    """Spans of one email, correlated by id (email id, LangSmith run_id...)"""
+    trace_id: str
+    start: float
+    attrs: Dict[str, Any] = field(default_factory=dict)
+    spans: List[Span] = field(default_factory=list)
+    duration: float = 0.0
+    started_at: float = field(default_factory=time.time)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'id': self.trace_id,
+            'started_at': round(self.started_at, 3),
+            'duration_ms': round(self.duration * 1000, 2),
+            'attrs': self.attrs,
+            'spans': [{
+                'stage': s.stage,
+                'offset_ms': round((s.start - self.start) * 1000, 2),
+                'duration_ms': round(s.duration * 1000, 2),
+                'error': s.error,
+                **({'attrs': s.attrs} if s.attrs else {}),
+            } for s in self.spans],
+        }
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar('current_trace', default=None)
+
+
+class Tracer:
+    """Per-stage histograms, error counts and recent traces"""
+
+    def __init__(self, recent: int = RECENT_TRACES, slow_trace: float = SLOW_TRACE_SECONDS):
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.errors: Dict[str, int] = {}
+        self.recent: Deque[Dict[str, Any]] = deque(maxlen=recent)
+        self.slow_trace = slow_trace
+        self._lock = threading.Lock()
+
+    def histogram(self, stage: str) -> LatencyHistogram:
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(stage, LatencyHistogram())
+        return histogram
+
+    def record(self, stage: str, duration: float, error: Optional[str] = None) -> None:
+        """Record a stage duration measured elsewhere"""
+        self.histogram(stage).record(duration)
+        if error is not None:
+            with self._lock:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+
+    @contextmanager
+    def span(self, stage: str, **attrs):
+        """
+        Time a pipeline stage.
+
+        Args:
+            stage: Stage name (fetch, pdf, llm, geocode, smtp...)
+            **attrs: Extra details stored in the current trace (not in the histogram)
+
+        Yields:
+            The Span; set span.error to count a failure that did not raise
+        """
+        trace = _current_trace.get()
+        span = Span(stage, time.monotonic(), attrs=attrs)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.duration = time.monotonic() - span.start
+            self.record(stage, span.duration, span.error)
+            if trace is not None:
+                trace.spans.append(span)
+
+    @contextmanager
+    def trace(self, trace_id: str, **attrs):
+        """Collect the spans of one email; the finished trace goes to recent"""
+        trace = Trace(str(trace_id), time.monotonic(), attrs=attrs)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            _current_trace.reset(token)
+            trace.duration = time.monotonic() - trace.start
+            self.recent.append(trace.to_dict())
+            if trace.duration >= self.slow_trace:
+                breakdown = ', '.join(f"{s.stage}={s.duration:.2f}s" for s in trace.spans)
+                logger.warning(f"🐢 Slow ticket {trace.trace_id[:50]} ({trace.duration:.1f}s): {breakdown}")
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Histogram summary per stage"""
+        with self._lock:
+            stages = dict(self.histograms)
+            errors = dict(self.errors)
+        return {stage: {**h.snapshot(), 'errors': errors.get(stage, 0)} for stage, h in sorted(stages.items())}
+
+    def traces(self, limit: int = 50, trace_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Most recent traces first, optionally only those with a given id"""
+        recent = list(self.recent)[::-1]
+        if trace_id is not None:
+            recent = [t for t in recent if t['id'] == trace_id or trace_id in t['attrs'].values()]
+        return recent[:limit]
+
+    def render_prometheus(self, prefix: str = 'mailsupport') -> str:
+        """Stage histograms and error counters in Prometheus text format"""
+        with self._lock:
+            stages = sorted(self.histograms.items())
+            errors = dict(self.errors)
+        name = f"{prefix}_stage_duration_seconds"
+        lines = [f"# HELP {name} Duration of pipeline stages",
+                 f"# TYPE {name} histogram"]
+        for stage, histogram in stages:
+            for bound, count in zip(PROMETHEUS_BUCKETS, histogram.cumulative()):
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+        name = f"{prefix}_stage_errors_total"
+        lines += [f"# HELP {name} Pipeline stages that raised",
+                  f"# TYPE {name} counter"]
+        for stage, _ in stages:
+            lines.append(f'{name}{{stage="{stage}"}} {errors.get(stage, 0)}')
+        return '\n'.join(lines) + '\n'
+
+
+tracer = Tracer()
+span = tracer.span
+trace = tracer.trace
+
+
+def set_trace_attribute(key: str, value: Any) -> None:
+    """Attach a correlation attribute (e.g. run_id) to the current trace"""
+    current = _current_trace.get()
+    if current is not None:
+        current.attrs[key] = value
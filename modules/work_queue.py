@@ -0,0 +1,427 @@
+"""
+Shared work queue with lease/ack semantics.
+
+Fetchers put fetched emails on the queue; any number of worker processes,
+on one or more nodes, claim them. A claim is a lease: the worker renews it
+with heartbeats while it works and acknowledges the job (with a result) or
+rejects it when done. If the worker dies, the lease expires and the job
+becomes claimable again, so each job is held by one worker at a time and a
+crash delays it instead of losing it. Results go back to the fetcher that
+owns the mailbox, which files the source messages.
+
+The default backend is a SQLite file (shared through the local filesystem);
+other backends implement WorkQueue and are registered by URL scheme.
+"""
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+READY = 'ready'
+LEASED = 'leased'
+DONE = 'done'
+DEAD = 'dead'
+
+DEFAULT_LEASE = 120.0
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+@dataclass
+class Job:
+    """A claimed unit of work"""
+    id: int
+    key: str
+    mailbox: str
+    payload: bytes
+    attempts: int
+    worker: Optional[str] = None
+    lease_until: Optional[float] = None
+    state: str = READY
+    result: Optional[str] = None
+    error: Optional[str] = None
+
+
+class LeaseLost(Exception):
+    """The job's lease expired and another worker may have claimed it"""
+
+
+class RetryableError(Exception):
+    """Transient failure (e.g. LLM provider down): the job is nacked and claimed again later"""
+
+
+class WorkQueue(ABC):
+    """Queue of jobs claimed with expiring leases"""
+
+    @abstractmethod
+    def put(self, key: str, mailbox: str, payload: bytes) -> bool:
+        """Add a job; returns False if a job with this key already exists"""
+
+    @abstractmethod
+    def claim(self, worker: str, limit: int = 1, lease: float = DEFAULT_LEASE) -> List[Job]:
+        """Lease up to limit ready jobs (or jobs whose lease expired) to worker"""
+
+    @abstractmethod
+    def heartbeat(self, worker: str, job_ids: List[int], lease: float = DEFAULT_LEASE) -> List[int]:
+        """Extend the leases still held by worker; returns the ids renewed"""
+
+    @abstractmethod
+    def ack(self, job: Job, result: Optional[str] = None) -> None:
+        """Complete a job (raises LeaseLost if the worker no longer holds it)"""
+
+    @abstractmethod
+    def nack(self, job: Job, error: str, delay: float = 0.0) -> str:
+        """Reject a job: ready again after delay, or dead after max attempts; returns the new state"""
+
+    @abstractmethod
+    def release(self, job: Job) -> None:
+        """Give a job back without counting the attempt (worker shutting down)"""
+
+    @abstractmethod
+    def collect(self, mailbox: str, limit: int = 500) -> List[Job]:
+        """Remove and return the done/dead jobs of a mailbox"""
+
+    @abstractmethod
+    def stats(self) -> Dict[str, int]:
+        """Jobs per state"""
+
+    def close(self) -> None:
+        pass
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    mailbox TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    available_at REAL NOT NULL,
+    result TEXT,
+    error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, available_at);
+CREATE INDEX IF NOT EXISTS jobs_mailbox ON jobs (mailbox, state);
+"""
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """WorkQueue on a SQLite file; claims are serialized by an immediate transaction"""
+
+    def __init__(self, path: str = 'work_queue.db', max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        """
+        Args:
+            path: Database file, shared by all the processes using the queue
+            max_attempts: Claims after which a failing job is dead
+        """
+        self.path = path
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+
+    def _transaction(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        # IMMEDIATE: il lock di scrittura è preso subito, quindi due processi
+        # non possono leggere gli stessi job liberi prima di marcarli
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(self._conn)
+                self._conn.execute('COMMIT')
+                return result
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def put(self, key: str, mailbox: str, payload: bytes) -> bool:
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT OR IGNORE INTO jobs (key, mailbox, payload, state, available_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)', (key, mailbox, payload, READY, now, now))
+        return cursor.rowcount == 1
+
+    def claim(self, worker: str, limit: int = 1, lease: float = DEFAULT_LEASE) -> List[Job]:
+        def claim_jobs(conn):
+            now = time.time()
+            rows = conn.execute(
+                'SELECT id, key, mailbox, payload, attempts FROM jobs '
+                'WHERE (state = ? AND available_at <= ?) OR (state = ? AND lease_until < ?) '
+                'ORDER BY available_at, id LIMIT ?',
+                (READY, now, LEASED, now, limit)).fetchall()
+            jobs = []
+            for job_id, key, mailbox, payload, attempts in rows:
+                conn.execute('UPDATE jobs SET state = ?, worker = ?, lease_until = ?, attempts = ?, updated_at = ? '
+                             'WHERE id = ?', (LEASED, worker, now + lease, attempts + 1, now, job_id))
+                jobs.append(Job(job_id, key, mailbox, payload, attempts + 1, worker, now + lease, LEASED))
+            return jobs
+        return self._transaction(claim_jobs)
+
+    def heartbeat(self, worker: str, job_ids: List[int], lease: float = DEFAULT_LEASE) -> List[int]:
+        if not job_ids:
+            return []
+
+        def renew(conn):
+            now = time.time()
+            renewed = []
+            for job_id in job_ids:
+                cursor = conn.execute(
+                    'UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND state = ? AND worker = ?',
+                    (now + lease, now, job_id, LEASED, worker))
+                if cursor.rowcount:
+                    renewed.append(job_id)
+            return renewed
+        return self._transaction(renew)
+
+    def _finish(self, job: Job, **fields) -> None:
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        with self._lock:
+            cursor = self._conn.execute(
+                f'UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ? AND state = ? AND worker = ?',
+                (*fields.values(), time.time(), job.id, LEASED, job.worker))
+        if cursor.rowcount == 0:
+            raise LeaseLost(f"job {job.key} is no longer leased to {job.worker}")
+
+    def ack(self, job: Job, result: Optional[str] = None) -> None:
+        self._finish(job, state=DONE, result=result, error=None, worker=None, lease_until=None)
+
+    def nack(self, job: Job, error: str, delay: float = 0.0) -> str:
+        state = DEAD if job.attempts >= self.max_attempts else READY
+        self._finish(job, state=state, error=error, worker=None, lease_until=None,
+                     available_at=time.time() + delay)
+        return state
+
+    def release(self, job: Job) -> None:
+        self._finish(job, state=READY, worker=None, lease_until=None, attempts=max(0, job.attempts - 1),
+                     available_at=time.time())
+
+    def collect(self, mailbox: str, limit: int = 500) -> List[Job]:
+        def take(conn):
+            rows = conn.execute(
+                'SELECT id, key, mailbox, attempts, state, result, error FROM jobs '
+                'WHERE mailbox = ? AND state IN (?, ?) ORDER BY id LIMIT ?',
+                (mailbox, DONE, DEAD, limit)).fetchall()
+            conn.executemany('DELETE FROM jobs WHERE id = ?', [(r[0],) for r in rows])
+            return [Job(job_id, key, box, b'', attempts, state=state, result=result, error=error)
+                    for job_id, key, box, attempts, state, result, error in rows]
+        return self._transaction(take)
+
+    def stats(self) -> Dict[str, int]:
+        now = time.time()
+        with self._lock:
+            counts = dict(self._conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+            expired = self._conn.execute('SELECT COUNT(*) FROM jobs WHERE state = ? AND lease_until < ?',
+                                         (LEASED, now)).fetchone()[0]
+        counts['expired_leases'] = expired
+        return counts
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+# Schema URL -> costruttore (path dopo lo schema)
+_BACKENDS: Dict[str, Callable[[str], WorkQueue]] = {
+    'sqlite': SQLiteWorkQueue,
+}
+
+
+def register_backend(scheme: str, factory: Callable[[str], WorkQueue]) -> None:
+    """Make create_work_queue accept URLs like '<scheme>://...'"""
+    _BACKENDS[scheme] = factory
+
+
+def create_work_queue(url: str) -> WorkQueue:
+    """
+    Work queue from a URL: 'sqlite:///relative/queue.db', 'sqlite:////absolute/queue.db'
+    (or a plain file path).
+
+    Raises:
+        ValueError: If no backend is registered for the URL scheme
+    """
+    scheme, sep, rest = url.partition('://')
+    if not sep:
+        return SQLiteWorkQueue(url)
+    factory = _BACKENDS.get(scheme)
+    if factory is None:
+        raise ValueError(f"Unknown work queue backend '{scheme}' (available: {', '.join(sorted(_BACKENDS))})")
+    # Come SQLAlchemy: sqlite:///rel/path -> rel/path, sqlite:////abs/path -> /abs/path
+    return factory(rest[1:] if scheme == 'sqlite' and rest.startswith('/') else rest)
+
+
+def default_worker_id() -> str:
+    """host:pid:random, unique per worker process"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class QueueWorker:
+    """
+    Claims jobs and runs them on a thread pool, renewing their leases.
+
+    The handler gets the Job and returns the result string stored by ack();
+    if it raises, the job is nacked with the error.
+    """
+
+    def __init__(
+        self,
+        queue: WorkQueue,
+        handler: Callable[[Job], Optional[str]],
+        threads: int = 2,
+        lease: float = DEFAULT_LEASE,
+        worker_id: Optional[str] = None,
+        poll_interval: float = 1.0,
+        retry_delay: float = 30.0
+    ):
+        """
+        Args:
+            queue: Shared work queue
+            handler: Processes one job
+            threads: Jobs processed concurrently by this worker
+            lease: Seconds a claim lasts without heartbeat (heartbeats every lease/3)
+            worker_id: Identity of this worker (default host:pid:random)
+            poll_interval: Seconds between claims when the queue is empty
+            retry_delay: Seconds before a failed job can be claimed again
+        """
+        self.queue = queue
+        self.handler = handler
+        self.threads = threads
+        self.lease = lease
+        self.worker_id = worker_id or default_worker_id()
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.processed = 0
+        self.failed = 0
+        self._held: Dict[int, Job] = {}
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(threads)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='queue-worker')
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def _run_job(self, job: Job) -> None:
+        try:
+            try:
+                result = self.handler(job)
+            except Exception as e:
+                if isinstance(e, RetryableError):
+                    logger.warning(f"⚠️ Job {job.key} will be retried (attempt {job.attempts}): {e}")
+                else:
+                    logger.error(f"❌ Job {job.key} failed (attempt {job.attempts}): {e}", exc_info=True)
+                state = self.queue.nack(job, f"{type(e).__name__}: {e}", delay=self.retry_delay)
+                with self._lock:
+                    self.failed += 1
+                if state == DEAD:
+                    logger.error(f"💀 Job {job.key} gave up after {job.attempts} attempts")
+            else:
+                self.queue.ack(job, result)
+                with self._lock:
+                    self.processed += 1
+        except LeaseLost as e:
+            logger.warning(f"⚠️ {e}: result discarded")
+        finally:
+            with self._lock:
+                self._held.pop(job.id, None)
+            self._slots.release()
+
+    def _claim_loop(self) -> None:
+        while not self._stop.is_set():
+            # Si reclama solo quando c'è un thread libero: i job in coda restano agli altri worker
+            self._slots.acquire()
+            if self._stop.is_set():
+                self._slots.release()
+                break
+            try:
+                jobs = self.queue.claim(self.worker_id, 1, self.lease)
+            except Exception as e:
+                logger.error(f"Error claiming jobs: {e}")
+                jobs = []
+            if not jobs:
+                self._slots.release()
+                self._stop.wait(self.poll_interval)
+                continue
+            job = jobs[0]
+            if self._stop.is_set():
+                # stop() è arrivato durante il claim: il job torna subito in coda
+                self._give_back(job)
+                break
+            with self._lock:
+                self._held[job.id] = job
+            try:
+                self._executor.submit(self._run_job, job)
+            except RuntimeError:
+                # Executor già chiuso
+                with self._lock:
+                    self._held.pop(job.id, None)
+                self._give_back(job)
+                break
+
+    def _give_back(self, job: Job) -> None:
+        try:
+            self.queue.release(job)
+        except LeaseLost:
+            pass
+        except Exception as e:
+            logger.error(f"Error releasing job {job.key}: {e}")
+        finally:
+            self._slots.release()
+
+    def _heartbeat_loop(self) -> None:
+        while not self._stop.wait(self.lease / 3):
+            with self._lock:
+                held = list(self._held)
+            try:
+                renewed = set(self.queue.heartbeat(self.worker_id, held, self.lease))
+            except Exception as e:
+                logger.error(f"Error renewing leases: {e}")
+                continue
+            lost = [job_id for job_id in held if job_id not in renewed]
+            if lost:
+                logger.warning(f"⚠️ Leases lost for jobs {lost}")
+
+    def start(self) -> None:
+        for target, name in ((self._claim_loop, 'queue-claim'), (self._heartbeat_loop, 'queue-heartbeat')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"👷 Worker {self.worker_id} started with {self.threads} threads")
+
+    def stop(self, wait: bool = True) -> None:
+        """Stop claiming; running jobs finish (wait=True) or are released"""
+        self._stop.set()
+        self._slots.release()  # sblocca il ciclo di claim
+        # Nessun claim dopo la chiusura dell'executor: un job appena reclamato torna in coda
+        for thread in self._threads:
+            if thread.name == 'queue-claim':
+                thread.join(timeout=self.poll_interval + 30)
+        if wait:
+            self._executor.shutdown(wait=True)
+            return
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            held = list(self._held.values())
+        for job in held:
+            try:
+                self.queue.release(job)
+            except LeaseLost:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            held = len(self._held)
+        return {'worker': self.worker_id, 'processed': self.processed, 'failed': self.failed,
+                'in_progress': held, 'queue': self.queue.stats()}
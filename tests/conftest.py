@@ -0,0 +1,5 @@
+import os
+import sys
+
+# I moduli si importano come in main_loop_v2.py (dalla radice del repository)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
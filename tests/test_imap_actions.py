@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+
+import pytest
+
+from modules.imap_actions import ImapActions, encode_mailbox, uid_set
+
+
+@pytest.mark.parametrize('uids, expected', [
+    ([1, 2, 3, 5, 7, 8], '1:3,5,7:8'),
+    (['8', '7', '7', '10'], '7:8,10'),
+    ([42], '42'),
+    ([], ''),
+])
+def test_uid_set(uids, expected):
+    assert uid_set(uids) == expected
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('Routed/IT', 'Routed/IT'),
+    ('Ricerca & Sviluppo', 'Ricerca &- Sviluppo'),
+    ('Räksmörgås', 'R&AOQ-ksm&APY-rg&AOU-s'),
+    ('Qualità', 'Qualit&AOA-'),
+])
+def test_encode_mailbox(name, expected):
+    assert encode_mailbox(name) == expected
+
+
+class FakeImap:
+    """IMAP connection that records UID commands and fails those matching fail_on"""
+
+    def __init__(self):
+        self.fail_on = set()
+        self.commands = []
+        self.capabilities = ('IMAP4REV1',)
+
+    def select(self, mailbox):
+        return 'OK', [b'12']
+
+    def response(self, code):
+        return code, [b'7']
+
+    def capability(self):
+        return 'OK', [b'IMAP4rev1 MOVE UIDPLUS']
+
+    def list(self, directory, pattern):
+        return 'OK', [b'(\\Noselect) "/" ""']
+
+    def create(self, mailbox):
+        return 'OK', [b'']
+
+    def uid(self, command, *args):
+        self.commands.append((command, args[0], args[-1]))
+        if any(command == c and target in args[-1] for c, target in self.fail_on):
+            return 'NO', [b'failed']
+        return 'OK', [b'']
+
+
+@pytest.fixture
+def imap():
+    return FakeImap()
+
+
+@pytest.fixture
+def actions(imap):
+    acknowledged = []
+
+    @contextmanager
+    def connection():
+        yield imap
+
+    actions = ImapActions('imap.example.com', 'user', 'secret', connection=connection,
+                          on_acknowledged=acknowledged.extend)
+    actions.acknowledged = acknowledged
+    return actions
+
+
+def test_actions_are_batched_per_folder(actions, imap):
+    for uid, department in (('1', 'IT'), ('2', 'IT'), ('3', 'Sales')):
+        actions.route(uid, department)
+    assert actions.flush() == {'Routed/IT': 2, 'Routed/Sales': 1}
+    assert ('STORE', '1:3', '(\\Seen)') in imap.commands
+    assert ('MOVE', '1:2', '"Routed/IT"') in imap.commands
+    assert actions.acknowledged == ['1', '2', '3']
+
+
+def test_failed_move_is_requeued_and_not_acknowledged(actions, imap):
+    actions.route('1', 'IT')
+    actions.route('2', 'Sales')
+    imap.fail_on.add(('MOVE', 'Sales'))
+    assert actions.flush() == {'Routed/IT': 1}
+    # Il flag di 2 è stato applicato, lo spostamento no: solo 1 è confermato
+    assert actions.acknowledged == ['1']
+    assert actions.pending() == 1
+
+    imap.fail_on.clear()
+    imap.commands.clear()
+    assert actions.flush() == {'Routed/Sales': 1}
+    assert imap.commands == [('MOVE', '2', '"Routed/Sales"')]
+    assert actions.acknowledged == ['1', '2']
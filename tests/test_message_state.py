@@ -0,0 +1,68 @@
+import pytest
+
+from modules.message_state import (ACKNOWLEDGED, ANALYZED, FAILED, FETCHED, FORWARDED, QUEUED, InvalidTransition,
+                                   MessageStateStore)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = MessageStateStore(str(tmp_path / 'state.db'), mailbox='acme:INBOX', max_attempts=2)
+    store.open(1)
+    yield store
+    store.close()
+
+
+def test_message_goes_through_the_pipeline(store):
+    assert store.fetched(10, '<a@example.com>')
+    store.set(10, ANALYZED)
+    store.set(10, FORWARDED, department='IT')
+    assert store.unacknowledged() == [('10', FORWARDED, 'IT')]
+    assert store.acknowledge(['10']) == 1
+    assert store.state(10) == ACKNOWLEDGED
+    # Già archiviato: un nuovo fetch non lo rielabora
+    assert not store.fetched(10)
+
+
+def test_queued_message_is_forwarded_or_failed(store):
+    store.fetched(11)
+    store.set(11, QUEUED)
+    with pytest.raises(InvalidTransition):
+        store.set(11, ANALYZED)
+    store.set(11, FAILED, error='LLM down')
+    assert store.in_state(FAILED) == [11]
+
+
+def test_invalid_transitions_are_rejected(store):
+    with pytest.raises(InvalidTransition):
+        store.set(12, FORWARDED)  # mai scaricato
+    store.fetched(12)
+    with pytest.raises(InvalidTransition):
+        store.set(12, ACKNOWLEDGED)
+    store.set(12, FORWARDED)
+    with pytest.raises(InvalidTransition):
+        store.set(12, FETCHED)
+    assert store.state(12) == FORWARDED
+
+
+def test_unfinished_message_fails_after_max_attempts(store):
+    assert store.fetched(13)
+    assert store.fetched(13)  # ripresa dopo un crash
+    assert not store.fetched(13)
+    assert store.state(13) == FAILED
+
+
+def test_uidvalidity_change_resets_the_mailbox(store, tmp_path):
+    store.fetched(20)
+    store.advance(20)
+    assert store.open(1) == 20
+
+    assert store.open(2) == 0
+    assert store.state(20) is None
+    assert store.fetched(20)
+
+    reopened = MessageStateStore(str(tmp_path / 'state.db'), mailbox='acme:INBOX')
+    try:
+        assert (reopened.uidvalidity, reopened.watermark) == (2, 0)
+        assert reopened.state(20) == FETCHED
+    finally:
+        reopened.close()
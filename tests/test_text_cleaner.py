@@ -0,0 +1,64 @@
+from modules.text_cleaner import (clean_email_text, strip_boilerplate, strip_links, strip_quoted_history,
+                                  strip_signature)
+
+
+def test_order_complaint_survives():
+    body = ("Buongiorno,\n\nho 3 ordini cancellati senza preavviso e nessun rimborso.\n\n"
+            "Grazie, Mario Rossi")
+    assert "ho 3 ordini cancellati" in clean_email_text(body).text
+
+
+def test_gdpr_request_survives():
+    body = ("Buongiorno,\n\nchiedo la cancellazione dei miei dati personali ai sensi del "
+            "Regolamento UE 2016/679 (GDPR) e l'informativa sulla privacy aggiornata.")
+    cleaned = clean_email_text(body).text
+    assert "ai sensi del Regolamento UE 2016/679 (GDPR)" in cleaned
+
+
+def test_footer_is_removed():
+    body = ("La caldaia in via Roma 12 perde acqua.\n\n"
+            "© 2024 ACME S.p.A. Tutti i diritti riservati.\n\n"
+            "Non rispondere a questo messaggio. Gestisci le tue preferenze o annulla l'iscrizione.")
+    assert strip_boilerplate(body) == "La caldaia in via Roma 12 perde acqua."
+
+
+def test_boilerplate_in_the_middle_is_kept():
+    body = ("Privacy policy e GDPR: vorrei sapere chi tratta i miei dati.\n\n"
+            "Il modulo è in allegato.")
+    assert strip_boilerplate(body) == body
+
+
+def test_reply_attribution_needs_date_or_address():
+    body = "Il tecnico ha scritto: la pompa va sostituita.\nPotete intervenire domani?"
+    assert strip_quoted_history(body) == body
+
+
+def test_reply_history_is_removed():
+    body = ("Confermo l'intervento.\n\n"
+            "Il giorno lun 3 giu 2024 alle ore 10:15 Mario Rossi <mario@example.com>\n"
+            "ha scritto:\nTesto precedente")
+    assert strip_quoted_history(body).strip() == "Confermo l'intervento."
+
+
+def test_reply_attribution_must_start_the_line():
+    body = "Come detto, Il 3/6/2024 il collega ha scritto: serve un sopralluogo."
+    assert strip_quoted_history(body) == body
+
+
+def test_signature_delimiter_only_near_the_end():
+    body = "Log:\n-- \n" + "\n".join(f"riga {i}" for i in range(20)) + "\n-- \nMario"
+    cleaned = strip_signature(body)
+    assert cleaned.startswith("Log:\n-- \nriga 0")
+    assert not cleaned.rstrip().endswith("Mario")
+
+
+def test_shipment_tracking_link_is_kept():
+    body = "Non riesco a tracciare: https://www.brt.it/tracking?code=123"
+    assert strip_links(body) == body
+
+
+def test_click_tracking_links_are_removed():
+    body = ("Offerta: https://example.com/promo?utm_source=newsletter\n"
+            "Dettagli: https://acme.us1.list-manage.com/track/click?u=1\n"
+            "Disiscriviti: https://acme.com/unsubscribe")
+    assert strip_links(body) == "Offerta: \nDettagli: \nDisiscriviti: "
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+
+from modules.embeddings import HashingEmbedder
+from modules.ticket_history_index import TicketHistoryIndex, ticket_text
+
+
+def _email(email_id, subject, body, suggested, forwarded=None):
+    return {'id': email_id, 'subject': subject, 'body': body, 'status': 'forwarded',
+            'suggestedDepartment': suggested, 'forwardedToDepartment': forwarded}
+
+
+def _index(tmp_path):
+    return TicketHistoryIndex(str(tmp_path / 'index'), embedder=HashingEmbedder(64))
+
+
+def test_label_is_the_forwarded_department(tmp_path):
+    index = _index(tmp_path)
+    email = _email('a', 'Fattura errata', 'La fattura di marzo ha un importo sbagliato',
+                   'Technical Support', 'Administration')
+    index.sync([email])
+    hits = index.search(ticket_text(email['subject'], email['body']), k=1)
+    assert hits[0].department == 'Administration'
+    # Stesso inoltro: nessun nuovo embedding
+    assert index.sync([email]) == 0
+
+
+def test_search_excludes_the_email_itself(tmp_path):
+    index = _index(tmp_path)
+    emails = [_email('a', 'Caldaia guasta', 'La caldaia perde acqua', 'Technical Support'),
+              _email('b', 'Caldaia rotta', 'La caldaia perde acqua dal tubo', 'Technical Support')]
+    index.sync(emails)
+    query = ticket_text(emails[0]['subject'], emails[0]['body'])
+    assert index.search(query, k=1)[0].id == 'a'
+    assert [h.id for h in index.search(query, k=2, exclude_id='a')] == ['b']
+
+
+def test_vectors_without_metadata_are_truncated_on_load(tmp_path):
+    index = _index(tmp_path)
+    index.sync([_email('a', 'Ordine', 'Ordine non arrivato', 'Sales')])
+    # Crash tra la scrittura dei vettori e quella dei metadati, con una riga parziale
+    with open(index.vectors_file, 'ab') as f:
+        f.write(np.ones(64 + 10, dtype=np.float32).tobytes())
+
+    reloaded = _index(tmp_path)
+    assert os.path.getsize(reloaded.vectors_file) == 64 * 4
+    reloaded.sync([_email('a', 'Ordine', 'Ordine non arrivato', 'Sales'),
+                   _email('b', 'Password', 'Non riesco ad accedere al portale', 'IT')])
+    query = ticket_text('Password', 'Non riesco ad accedere al portale')
+    hit = _index(tmp_path).search(query, k=1)[0]
+    assert hit.id == 'b' and hit.score > 0.99
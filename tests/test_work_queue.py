@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from modules.work_queue import DEAD, DONE, LEASED, READY, LeaseLost, SQLiteWorkQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = SQLiteWorkQueue(str(tmp_path / 'queue.db'), max_attempts=2)
+    yield queue
+    queue.close()
+
+
+def test_job_is_claimed_by_one_worker(queue, tmp_path):
+    assert queue.put('INBOX:1', 'INBOX', b'raw')
+    assert not queue.put('INBOX:1', 'INBOX', b'raw')
+    # Un secondo processo sullo stesso file
+    other = SQLiteWorkQueue(str(tmp_path / 'queue.db'))
+    try:
+        jobs = queue.claim('w1', limit=5)
+        assert [j.key for j in jobs] == ['INBOX:1'] and jobs[0].attempts == 1
+        assert other.claim('w2', limit=5) == []
+    finally:
+        other.close()
+
+
+def test_expired_lease_is_claimed_again(queue):
+    queue.put('INBOX:1', 'INBOX', b'raw')
+    first = queue.claim('w1', lease=0.01)[0]
+    time.sleep(0.05)
+    second = queue.claim('w2')[0]
+    assert second.id == first.id and second.attempts == 2
+    assert queue.heartbeat('w1', [first.id]) == []
+    with pytest.raises(LeaseLost):
+        queue.ack(first, 'IT')
+    queue.ack(second, 'IT')
+    [done] = queue.collect('INBOX')
+    assert (done.state, done.result) == (DONE, 'IT')
+
+
+def test_nack_is_dead_after_max_attempts(queue):
+    queue.put('INBOX:1', 'INBOX', b'raw')
+    assert queue.nack(queue.claim('w1')[0], 'LLM down') == READY
+    assert queue.nack(queue.claim('w1')[0], 'LLM down') == DEAD
+    assert queue.claim('w1') == []
+    [dead] = queue.collect('INBOX')
+    assert (dead.state, dead.error, dead.attempts) == (DEAD, 'LLM down', 2)
+    assert queue.collect('INBOX') == []
+
+
+def test_nack_delay_postpones_the_job(queue):
+    queue.put('INBOX:1', 'INBOX', b'raw')
+    queue.nack(queue.claim('w1')[0], 'busy', delay=60)
+    assert queue.claim('w1') == []
+
+
+def test_release_does_not_count_the_attempt(queue):
+    queue.put('INBOX:1', 'INBOX', b'raw')
+    queue.release(queue.claim('w1')[0])
+    job = queue.claim('w2')[0]
+    assert job.attempts == 1 and job.worker == 'w2'
+    assert queue.stats()[LEASED] == 1